@@ -1,66 +1,147 @@
+import argparse
+import json
+import os
+import shutil
+import pickle
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+import numpy as np
 from PIL import Image
+from instrumentation import stage
+from png_stream import PNGReader, PNGWriter, unfilter_row
 Image.MAX_IMAGE_PIXELS = None # Disable DecompressionBombError
 
+def read_community_labels(filepath: str = './data/community_labels.txt') -> list[str]:
+    # One label per line, in partition order (largest community first)
+    if not os.path.exists(filepath):
+        return []
+    with open(filepath, 'r', encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip()]
+
+def rgba_to_hex(color: str) -> str:
+    r, g, b = (int(part) for part in color.strip()[5:-1].split(',')[:3])
+    return f'#{r:02X}{g:02X}{b:02X}'
+
+def legend_entries(num_communities: int = 10, colors_path: str = './data/colors.txt', partition_path: str = './data/partition_list.pkl',
+                   labels_path: str = './data/community_labels.txt', color_key_path: str = './data/color_key.json') -> list[tuple[str, str]]:
+    # The style stage records what the colours stand for; images styled before it did are coloured by partition
+    color_key = {'color_by': 'partition'}
+    if os.path.exists(color_key_path):
+        with open(color_key_path, 'r', encoding='utf-8') as key_file:
+            color_key = json.load(key_file)
+    if color_key['color_by'] != 'partition':
+        return [(label, rgba_to_hex(color)) for label, color in color_key.get('legend', [])]
+
+    # The colour of partition i is line i of colors.txt, as written by graph_psych's style stage
+    with open(colors_path, 'r', encoding='utf-8') as color_file:
+        colors = [line for line in color_file if line.strip()]
+    with open(partition_path, 'rb') as partition_file:
+        partition_list = pickle.load(partition_file)
+    labels = read_community_labels(labels_path)
+
+    entries = []
+    for i in range(min(num_communities, len(partition_list), len(colors))):
+        label = labels[i] if i < len(labels) else f"Community {i + 1} ({len(partition_list[i])} articles)"
+        entries.append((label, rgba_to_hex(colors[i])))
+    return entries
+
 def create_legend(community_label_colors: list[tuple[str,str]], filename: str ='./data/legend.png') -> None:
 
     fig, ax = plt.subplots(figsize=(10, 5))  # Adjust figure size as needed
     fig.patch.set_alpha(0.0)  # Transparent background
     ax.axis('off')
-    
-    
-    patches = [mpatches.Patch(color=color, label=label) for label, color in community_labels_colors]
-    
+
+
+    patches = [mpatches.Patch(color=color, label=label) for label, color in community_label_colors]
+
     # Adjust fontsize for clarity, frameon=False removes the legend background
     legend = plt.legend(handles=patches, loc='upper left', fontsize=50, frameon=False)
-    
+
     for text in legend.get_texts():
         text.set_color("white")
-    
+
     plt.savefig(filename, bbox_inches='tight', transparent=True, dpi=300)
     plt.close()
 
 
+def composite_over(background: np.ndarray, overlay: np.ndarray) -> np.ndarray:
+    # Porter-Duff "over" on straight (not premultiplied) RGB or RGBA rows
+    overlay_alpha = overlay[..., 3:4].astype(np.float32) / 255
+    if background.shape[-1] == 3:
+        blended = overlay[..., :3] * overlay_alpha + background * (1 - overlay_alpha)
+        return np.round(blended).astype(np.uint8)
+    background_alpha = background[..., 3:4].astype(np.float32) / 255
+    alpha = overlay_alpha + background_alpha * (1 - overlay_alpha)
+    color = (overlay[..., :3] * overlay_alpha + background[..., :3] * background_alpha * (1 - overlay_alpha)) / np.maximum(alpha, 1e-6)
+    return np.round(np.concatenate((color, alpha * 255), axis=-1)).astype(np.uint8)
 
+def merge_legend_in_memory(plot_image_path: str, legend_image_path: str, output_path: str, margin: int = 50) -> None:
+    plot_img = Image.open(plot_image_path).convert("RGBA")
+    legend_img = Image.open(legend_image_path)
+    plot_img.alpha_composite(legend_img.convert("RGBA"), (plot_img.width - legend_img.width - margin, margin))
+    plot_img.save(output_path)
 
+def merge_legend_with_plot(plot_image_path: str, legend_image_path: str, output_path: str, margin: int = 50) -> None:
+    # Only the rows under the legend are unfiltered and composited; every other scanline is copied
+    # through still filtered, so memory depends on the legend's size and not on the canvas's. Time
+    # still grows with the canvas: a zlib stream cannot be spliced, so every row is decompressed
+    # and compressed again
+    try:
+        reader = PNGReader(plot_image_path)
+    except ValueError as e:
+        print(f"{e} Compositing in memory instead.")
+        merge_legend_in_memory(plot_image_path, legend_image_path, output_path, margin)
+        return
 
+    with reader, Image.open(legend_image_path) as legend_img:
+        legend = np.asarray(legend_img.convert("RGBA"))
+        # Legend in the top-right corner, cropped if the plot is smaller than the legend
+        x_position = max(reader.width - legend.shape[1] - margin, 0)
+        y_position = margin
+        legend = legend[:max(reader.height - y_position, 0), :reader.width - x_position]
+        bottom = y_position + len(legend)
 
+        previous = np.zeros(reader.width * reader.channels, dtype=np.uint8)
+        with PNGWriter(output_path, reader.width, reader.height, reader.channels) as writer:
+            for row, line in enumerate(reader.filtered_rows()):
+                if row > bottom:
+                    writer.write_filtered(line, 1)
+                    continue
+                pixels = unfilter_row(line[0], np.frombuffer(line, dtype=np.uint8, offset=1), previous, reader.channels)
+                previous = pixels
+                if row < y_position:
+                    writer.write_filtered(line, 1)
+                    continue
+                pixels = pixels.reshape(reader.width, reader.channels)
+                if row < bottom:
+                    pixels = pixels.copy()
+                    right = x_position + legend.shape[1]
+                    pixels[x_position:right] = composite_over(pixels[x_position:right], legend[row - y_position])
+                # The row below the legend may be filtered against the row above it, so it is
+                # re-encoded too; writer rows only reference their own pixels
+                writer.write_rows(pixels[None])
 
-def merge_legend_with_plot(plot_image_path: str, legend_image_path: str, output_path: str) -> None:
-    
-    plot_img = Image.open(plot_image_path)
-    legend_img = Image.open(legend_image_path)
-    
-    # Calculate the position for the legend: top-right corner
-    plot_width, plot_height = plot_img.size
-    legend_width, legend_height = legend_img.size
-    x_position = plot_width - legend_width - 50  # Adjust margins as needed
-    y_position = 50  # Margin from the top
-    
-    transparent_overlay = Image.new("RGBA", plot_img.size, (0, 0, 0, 0))
-    transparent_overlay.paste(legend_img, (x_position, y_position), legend_img)
-    combined = Image.alpha_composite(plot_img.convert("RGBA"), transparent_overlay)
-    combined.save(output_path)
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Add a community legend to the rendered graph.")
+    parser.add_argument('--top-partitions', type=int, default=10, help="number of largest communities listed in the legend")
+    parser.add_argument('--labels', default='./data/community_labels.txt',
+                        help="community labels, one per line in partition order; unlabelled communities get a generic name")
+    return parser.parse_args(argv)
 
 def main():
-    community_labels_colors = [
-        ("Sensory and Cognitive Processes", "#FF5733"),  # Red
-        ("Mental Health and Clinical Psychology", "#33FF57"),  # Lime
-        ("Educational Psychology and Development", "#3357FF"),  # Blue
-        ("Neuroscience and Neurology", "#F933FF"),  # Magenta
-        ("Social Psychology and Society", "#33FFF9"),  # Cyan
-        ("Language, Cognition, and Neuroscience", "#F9FF33"),  # Yellow
-        ("Education and Developmental Psychology", "#FF8333"),  # Orange
-        ("Applied Psychology and Organizational Behavior", "#8333FF"),  # Purple
-        ("Cognitive Processes and Experimental Psychology", "#33FF83"),  # Green
-        ("Integrative Psychology, Arts and Humanities", "#FF3333")   # Bright Red
-    ]
-
-    create_legend(community_labels_colors)
-
-    merge_legend_with_plot('./data/graph.png', './data/legend.png', './data/annotated_graph.png')
+    args = parse_args()
+
+    with stage('legend'):
+        entries = legend_entries(args.top_partitions, labels_path=args.labels)
+        if not entries:
+            print("The colour mapping of the image has no legend; copying graph.png unchanged.")
+            shutil.copyfile('./data/graph.png', './data/annotated_graph.png')
+            return
+        create_legend(entries)
+
+    with stage('merge_legend'):
+        merge_legend_with_plot('./data/graph.png', './data/legend.png', './data/annotated_graph.png')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
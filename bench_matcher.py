@@ -0,0 +1,50 @@
+# Micro-benchmark for the journal filter in doi_retrieval: items/second for the original
+# nested keyword scan versus the precompiled JournalMatcher in both match modes.
+
+import random
+import string
+import sys
+import time
+from doi_retrieval import read_keywords
+from journal_matcher import JournalMatcher
+
+def legacy_match(item, keywords) -> bool:
+    journal_titles = set(item.get("container-title", []) + item.get("short-container-title", []))
+    if any(keyword.lower() in title.lower() for title in journal_titles for keyword in keywords):
+        return any(journal in journal_titles for journal in keywords)
+    return False
+
+def make_items(keywords, num_items, match_share = 0.1, num_other_journals = 5000, seed = 0) -> list[dict]:
+    rng = random.Random(seed)
+    other_journals = [
+        " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10))).title() for _ in range(rng.randint(2, 6)))
+        for _ in range(num_other_journals)
+    ]
+    items = []
+    for _ in range(num_items):
+        journal = rng.choice(keywords) if rng.random() < match_share else rng.choice(other_journals)
+        items.append({"container-title": [journal], "short-container-title": [journal[:20]]})
+    return items
+
+def items_per_second(match, items) -> float:
+    start = time.perf_counter()
+    for item in items:
+        match(item)
+    return len(items) / (time.perf_counter() - start)
+
+def main():
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    keywords = read_keywords("./data/keywords.txt")
+    items = make_items(keywords, num_items)
+
+    results = {"legacy": items_per_second(lambda item: legacy_match(item, keywords), items)}
+    for mode in ("exact", "fuzzy"):
+        matcher = JournalMatcher(keywords, mode)
+        results[mode] = items_per_second(
+            lambda item: matcher.matches(item["container-title"]) or matcher.matches(item["short-container-title"]), items)
+
+    for name, rate in results.items():
+        print(f"{name:>7}: {rate:>14,.0f} items/s ({rate / results['legacy']:.1f}x)")
+
+if __name__ == '__main__':
+    main()
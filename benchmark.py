@@ -0,0 +1,278 @@
+# Per-stage benchmarks on synthetic corpora (see synthetic_corpus.py). Every case runs in a fresh
+# interpreter, so its peak RSS is its own, and only the benchmarked call is timed: the artifacts it
+# needs are prepared first through the pipeline's stage cache. Results are appended to a JSON history
+# and compared with earlier runs of the same case, scale and settings to flag regressions.
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from doi_retrieval import load_manifest, merge_shard_results, process_files, read_and_filter_data, read_keywords
+from graph_psych import (build_stages, generate_colors_exact, get_layout, get_node_ids, get_partition, membership_array, parse_args as pipeline_parse_args,
+                         plot_graph, set_colors, truncate_graph)
+from instrumentation import peak_rss_mb, stage
+from metadata_store import METADATA_DIR
+from node_index import load_edge_arrays
+from stage_cache import run_stages
+from synthetic_corpus import corpus_size, default_config, generate_corpus
+from tile_renderer import EDGE_MODES
+
+BENCHMARK_DIR = './data/benchmark'
+HISTORY_PATH = './data/benchmark_history.json'
+START_YEAR = 2014
+END_YEAR = 2023
+SCALES = {
+    'tiny': {'shards': 2, 'items_per_shard': 2000},
+    'small': {'shards': 4, 'items_per_shard': 10000},
+    'medium': {'shards': 8, 'items_per_shard': 50000},
+    'large': {'shards': 16, 'items_per_shard': 200000},
+}
+
+def prepare_edges(options: dict) -> list[str]:
+    # Shard results are cached by process_files, so only the first case of a scale parses the corpus
+    keywords = read_keywords(options['keywords'])
+    shard_files = process_files([options['corpus']], keywords, START_YEAR, END_YEAR, cache_dir='./data/shard_cache')
+    merge_shard_results(shard_files, './data/dois.txt', './data/edges.csv', METADATA_DIR)
+    return shard_files
+
+def prepare_stages(options: dict, targets: list[str]) -> None:
+    # The pipeline's own stages, with its default settings, produce the inputs of the graph cases
+    prepare_edges(options)
+    args = pipeline_parse_args(['--layout', options['layout'], '--edge-mode', options['edge_mode']])
+    run_stages(build_stages(args), targets)
+
+def load(path: str):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def case_read_and_filter_data(options: dict):
+    keywords = read_keywords(options['keywords'])
+    shard = sorted(f for f in os.listdir(options['corpus']) if f.endswith('.json.gz'))[0]
+
+    def run():
+        _, edges, _ = read_and_filter_data(os.path.join(options['corpus'], shard), keywords, START_YEAR, END_YEAR)
+        return {'items': options['items_per_shard'], 'edges': len(edges)}
+    return run
+
+def case_process_files(options: dict):
+    keywords = read_keywords(options['keywords'])
+    cache_dir = './data/benchmark_shard_cache'
+    if os.path.exists(cache_dir):
+        for name in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+
+    def run():
+        process_files([options['corpus']], keywords, START_YEAR, END_YEAR, cache_dir=cache_dir)
+        shards = load_manifest(cache_dir)['shards'].values()
+        return {'items': options['corpus_items'], 'edges': sum(entry['edges'] for entry in shards)}
+    return run
+
+def case_node_ids(options: dict):
+    prepare_stages(options, ['deadends'])
+
+    def run():
+        node_ids = get_node_ids('./data/links.csv', './data/node_index_benchmark')
+        return {'items': len(node_ids), 'edges': len(load_edge_arrays('./data/node_index_benchmark')[0])}
+    return run
+
+def case_get_partition(options: dict):
+    prepare_stages(options, ['graph'])
+    graph = load('./data/graph.pkl')
+
+    def run():
+        get_partition(graph, seed=0)
+        return {'items': graph.vcount(), 'edges': graph.ecount()}
+    return run
+
+def case_get_layout(options: dict):
+    prepare_stages(options, ['graph'] + (['partition'] if options['layout'] == 'multilevel' else []))
+    graph = load('./data/graph.pkl')
+    membership = membership_array(load('./data/partition_dict.pkl'), graph.vcount()) if options['layout'] == 'multilevel' else None
+
+    def run():
+        get_layout(graph, options['layout'], membership)
+        return {'items': graph.vcount(), 'edges': graph.ecount()}
+    return run
+
+def case_set_colors(options: dict):
+    prepare_stages(options, ['partition'])
+    graph = load('./data/graph.pkl')
+    partition_list = load('./data/partition_list.pkl')
+    membership = membership_array(load('./data/partition_dict.pkl'), graph.vcount())
+    node_colors, edge_colors = generate_colors_exact(len(partition_list))
+    graph = truncate_graph(graph, membership, list(range(10)))
+
+    def run():
+        set_colors(graph, membership, node_colors, edge_colors)
+        return {'items': graph.vcount(), 'edges': graph.ecount()}
+    return run
+
+def case_plot_graph(options: dict):
+    prepare_stages(options, ['style', 'layout'])
+    graph = load('./data/graph_styled.pkl')
+    layout = load('./data/layout.pkl')
+
+    def run():
+        plot_graph(graph, layout, options['width'], options['height'], edge_mode=options['edge_mode'])
+        return {'items': graph.vcount(), 'edges': graph.ecount()}
+    return run
+
+CASES = {
+    'read_and_filter_data': case_read_and_filter_data,
+    'process_files': case_process_files,
+    'node_ids': case_node_ids,
+    'get_partition': case_get_partition,
+    'get_layout': case_get_layout,
+    'set_colors': case_set_colors,
+    'plot_graph': case_plot_graph,
+}
+
+def run_case(name: str, options: dict) -> dict:
+    # Runs inside the benchmark subprocess and measures the call as a stage of its own, so the peak
+    # RSS is that of the call; the peak while loading the case's inputs is reported separately
+    run = CASES[name](options)
+    setup_rss = peak_rss_mb()
+    with stage(name, log_path=None) as record:
+        record.update(run())
+    return {
+        'seconds': record['wall_seconds'],
+        'cpu_seconds': record['cpu_seconds'] + record['children_cpu_seconds'],
+        'items': record['items'],
+        'edges': record['edges'],
+        'items_per_s': record['items_per_s'],
+        'edges_per_s': record['edges_per_s'],
+        'setup_rss_mb': setup_rss,
+        'peak_rss_mb': record['peak_rss_mb'],
+        'children_peak_rss_mb': record.get('children_peak_rss_mb', 0.0),
+    }
+
+def spawn_case(name: str, options: dict, workdir: str) -> dict | None:
+    result_path = os.path.join(workdir, f'{name}.result.json')
+    log_path = os.path.join(workdir, f'{name}.log')
+    if os.path.exists(result_path):
+        os.remove(result_path)
+    with open(log_path, 'w', encoding='utf-8') as log:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', name, '--options', json.dumps(options),
+                                  '--result', os.path.abspath(result_path)], cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    if process.returncode != 0 or not os.path.exists(result_path):
+        print(f"{name} failed with exit code {process.returncode}, see {log_path}")
+        return None
+    with open(result_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def settings_digest(options: dict) -> str:
+    # Runs are only compared when they measured the same corpus with the same settings
+    relevant = {key: value for key, value in options.items() if key not in ('corpus', 'keywords')}
+    return hashlib.blake2b(json.dumps(relevant, sort_keys=True).encode('utf-8'), digest_size=8).hexdigest()
+
+def load_history(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_history(history: list[dict], path: str) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(history, file, indent=1)
+    os.replace(path + '.tmp', path)
+
+def find_regressions(result: dict, history: list[dict], baseline_runs: int, tolerance: float) -> list[str]:
+    previous = [entry for run in history for entry in run['results']
+                if (entry['case'], entry['scale'], entry['settings']) == (result['case'], result['scale'], result['settings'])][-baseline_runs:]
+    if not previous:
+        return []
+    problems = []
+    for metric in ('items_per_s', 'edges_per_s'):
+        baseline = statistics.median(entry[metric] for entry in previous)
+        if baseline > 0 and result[metric] < baseline * (1 - tolerance):
+            problems.append(f"{metric} {result[metric]:,.0f} vs {baseline:,.0f}")
+    baseline = statistics.median(entry['peak_rss_mb'] for entry in previous)
+    if result['peak_rss_mb'] > baseline * (1 + tolerance):
+        problems.append(f"peak RSS {result['peak_rss_mb']:,.0f} MB vs {baseline:,.0f} MB")
+    return problems
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic corpora.")
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['tiny', 'small'])
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case; the fastest is recorded")
+    parser.add_argument('--history', default=HISTORY_PATH, help="JSON file the results are appended to")
+    parser.add_argument('--no-history', action='store_true', help="compare with the history but do not record this run")
+    parser.add_argument('--baseline-runs', type=int, default=5, help="previous runs whose median is the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="relative slowdown or RSS growth flagged as a regression")
+    parser.add_argument('--keywords', default='./data/keywords.txt')
+    parser.add_argument('--layout', default='drl', help="layout algorithm benchmarked by get_layout")
+    parser.add_argument('--edge-mode', choices=EDGE_MODES, default='strokes', help="edge mode benchmarked by plot_graph")
+    parser.add_argument('--width', type=int, default=3840, help="canvas width for plot_graph")
+    parser.add_argument('--height', type=int, default=2160, help="canvas height for plot_graph")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    if args.run_case:
+        result = run_case(args.run_case, json.loads(args.options))
+        with open(args.result, 'w', encoding='utf-8') as file:
+            json.dump(result, file)
+        return
+
+    keywords = read_keywords(args.keywords)
+    history = load_history(args.history)
+    run = {'time': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'commit': git_commit(), 'results': []}
+    regressions = []
+    for scale in args.scales:
+        workdir = os.path.abspath(os.path.join(BENCHMARK_DIR, scale))
+        os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+        config = default_config(**SCALES[scale])
+        generate_corpus(os.path.join(workdir, 'crossref'), config, keywords)
+        options = {
+            'corpus': os.path.join(workdir, 'crossref'),
+            'keywords': os.path.abspath(args.keywords),
+            'corpus_config': config,
+            'corpus_items': corpus_size(config),
+            'items_per_shard': config['items_per_shard'],
+            'layout': args.layout,
+            'edge_mode': args.edge_mode,
+            'width': args.width,
+            'height': args.height,
+        }
+        for case in args.cases:
+            results = [spawn_case(case, options, workdir) for _ in range(args.repeat)]
+            results = [result for result in results if result is not None]
+            if not results:
+                continue
+            result = min(results, key=lambda result: result['seconds'])
+            result.update({'case': case, 'scale': scale, 'settings': settings_digest(options)})
+            problems = find_regressions(result, history, args.baseline_runs, args.tolerance)
+            print(f"{scale:>6} {case:<20} {result['seconds']:>9.2f} s {result['items_per_s']:>12,.0f} items/s "
+                  f"{result['edges_per_s']:>12,.0f} edges/s {result['peak_rss_mb']:>8,.0f} MB"
+                  + (f"  REGRESSION: {'; '.join(problems)}" if problems else ""))
+            regressions.extend(f"{scale}/{case}: {problem}" for problem in problems)
+            run['results'].append(result)
+
+    if not args.no_history and run['results']:
+        history.append(run)
+        save_history(history, args.history)
+    if regressions:
+        print(f"{len(regressions)} regressions against the median of the last {args.baseline_runs} runs:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# Columnar snapshot of the Crossref dump. Every shard is parsed once into a partition holding only
+# the fields the pipeline uses (DOI, type, container titles, year, title, subjects, references);
+# journal/year filters then run as vectorized scans over the partitions instead of re-parsing JSON.
+# Shards are tracked by signature, so new shards (e.g. from extend_crossref.py) are added
+# incrementally.
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from doi_retrieval import (MANIFEST_SAVE_INTERVAL, SOURCE_DIRS, get_publication_year, iter_items, list_shards, load_manifest,
+                           merge_shard_results, read_keywords, save_manifest, shard_signature, write_shard_results)
+from graph_store import gather_incident_edges
+from instrumentation import Progress, measure_task, stage, summarize_tasks
+from journal_matcher import MATCH_MODES, compile_matcher
+from metadata_store import METADATA_DIR, NO_YEAR
+from node_index import build_string_table, normalize_doi
+
+SNAPSHOT_DIR = './data/crossref_snapshot'
+SNAPSHOT_FORMAT = 1
+
+def reference_year(value) -> int:
+    match = re.search(r'\d{4}', value) if value else None
+    return int(match.group()) if match else NO_YEAR
+
+def interned(values: list[str], vocabulary: dict[str, int]) -> list[int]:
+    return [vocabulary.setdefault(value, len(vocabulary)) for value in values]
+
+def csr_offsets(lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+def string_columns(name: str, strings: list[str]) -> dict:
+    offsets, data = build_string_table(strings)
+    return {f'{name}_offsets': offsets, f'{name}_strings': data}
+
+def decode_strings(offsets: np.ndarray, data: np.ndarray, rows=None) -> list[str]:
+    data = data.tobytes()
+    rows = range(len(offsets) - 1) if rows is None else rows
+    return [data[offsets[row]:offsets[row + 1]].decode('utf-8') for row in rows]
+
+def partition_path(snapshot_dir: str, file_path: str) -> str:
+    return os.path.join(snapshot_dir, hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16] + '.npz')
+
+def snapshot_shard(params) -> tuple[str, dict]:
+    file_path, output_path = params
+    with measure_task(file=file_path) as task:
+        task['items'] = write_partition(file_path, output_path)
+    return output_path, task
+
+def write_partition(file_path: str, output_path: str) -> int:
+    types, journals, subjects = {}, {}, {}
+    dois, type_codes, years, titles = [], [], [], []
+    container_ids, container_lengths = [], []
+    subject_ids, subject_lengths = [], []
+    ref_dois, ref_years, ref_lengths = [], [], []
+
+    for item in iter_items(file_path):
+        dois.append(item.get("DOI") or "")
+        type_codes.append(interned([item.get("type") or ""], types)[0])
+        try:
+            years.append(get_publication_year(item))
+        except (IndexError, TypeError, ValueError):
+            years.append(NO_YEAR)
+        titles.append((item.get("title") or [""])[0])
+        containers = interned(item.get("container-title", []) + item.get("short-container-title", []), journals)
+        container_ids.extend(containers)
+        container_lengths.append(len(containers))
+        item_subjects = interned(item.get("subject", []), subjects)
+        subject_ids.extend(item_subjects)
+        subject_lengths.append(len(item_subjects))
+        references = [ref for ref in item.get("reference", []) if ref.get("DOI")]
+        ref_dois.extend(ref["DOI"] for ref in references)
+        ref_years.extend(reference_year(ref.get("year")) for ref in references)
+        ref_lengths.append(len(references))
+
+    columns = {
+        'type': np.array(type_codes, dtype=np.int16),
+        'year': np.clip(np.array(years, dtype=np.int64), -1, np.iinfo(np.int16).max).astype(np.int16),
+        'container_offsets': csr_offsets(container_lengths),
+        'containers': np.array(container_ids, dtype=np.int32),
+        'subject_offsets': csr_offsets(subject_lengths),
+        'subjects': np.array(subject_ids, dtype=np.int32),
+        'ref_offsets': csr_offsets(ref_lengths),
+        'ref_year': np.clip(np.array(ref_years, dtype=np.int64), -1, np.iinfo(np.int16).max).astype(np.int16),
+        **string_columns('doi', dois),
+        **string_columns('title', titles),
+        **string_columns('ref_doi', ref_dois),
+        **string_columns('type_name', list(types)),
+        **string_columns('journal', list(journals)),
+        **string_columns('subject_name', list(subjects)),
+    }
+    with open(output_path + '.tmp', 'wb') as file:
+        np.savez_compressed(file, **columns)
+    os.replace(output_path + '.tmp', output_path)
+    return len(dois)
+
+def build_snapshot(directories: list[str] = SOURCE_DIRS, snapshot_dir: str = SNAPSHOT_DIR, hash_shards: bool = False,
+                   workers: int | None = None) -> list[str]:
+    os.makedirs(snapshot_dir, exist_ok=True)
+    manifest = load_manifest(snapshot_dir)
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        manifest = {"format": SNAPSHOT_FORMAT, "shards": {}}
+
+    files = list_shards(directories)
+    signatures = {file: shard_signature(file, hash_shards) for file in files}
+    for file, entry in list(manifest["shards"].items()):
+        if file not in signatures:
+            if os.path.exists(entry["partition"]):
+                os.remove(entry["partition"])
+            del manifest["shards"][file]
+    stale = [file for file in files if manifest["shards"].get(file, {}).get("signature") != signatures[file]
+             or not os.path.exists(manifest["shards"][file]["partition"])]
+    print(f"{len(files) - len(stale)} of {len(files)} shards already in the snapshot, converting {len(stale)}.")
+
+    progress = Progress(len(stale), "Converting shards")
+    with stage("snapshot_shards", units=sum(signatures[file]["size"] for file in stale), shards=len(stale)) as record, \
+         ProcessPoolExecutor(max_workers=workers or multiprocessing.cpu_count()) as executor:
+        futures = {executor.submit(snapshot_shard, (file, partition_path(snapshot_dir, file))): file for file in stale}
+        tasks = []
+        for completed, future in enumerate(as_completed(futures), start=1):
+            file = futures[future]
+            try:
+                output_path, task = future.result()
+            except (json.JSONDecodeError, OSError, EOFError) as e:
+                print(f"Error opening or reading file: {file}, {str(e)}")
+                progress.update()
+                # The old partition holds what the shard contained before it changed
+                previous = manifest["shards"].pop(file, None)
+                if previous and os.path.exists(previous["partition"]):
+                    os.remove(previous["partition"])
+                continue
+            tasks.append(task)
+            progress.update(items=task["items"])
+            manifest["shards"][file] = {"signature": signatures[file], "partition": output_path, "items": task["items"]}
+            if completed % MANIFEST_SAVE_INTERVAL == 0:
+                save_manifest(manifest, snapshot_dir)
+        record.update(items=sum(task["items"] for task in tasks), shard_tasks=summarize_tasks(tasks))
+    save_manifest(manifest, snapshot_dir)
+    return [manifest["shards"][file]["partition"] for file in files
+            if manifest["shards"].get(file, {}).get("signature") == signatures[file]]
+
+def filter_partition(path: str, matcher, start_year: int, end_year: int, stats: dict | None = None) -> tuple[list[str], list[tuple[str, str]], dict]:
+    # Same result as read_and_filter_data on the original shard
+    with np.load(path) as partition:
+        columns = dict(partition)
+    num_items = len(columns['year'])
+    if stats is not None:
+        stats['items'] = num_items
+
+    # Journal titles are matched once per distinct title, then mapped onto the rows
+    journal_match = np.fromiter((matcher.match_title(name) for name in decode_strings(columns['journal_offsets'], columns['journal_strings'])),
+                                dtype=bool)
+    container_rows = np.repeat(np.arange(num_items), np.diff(columns['container_offsets']))
+    matched = np.zeros(num_items, dtype=bool)
+    matched[container_rows[journal_match[columns['containers']]]] = True
+
+    type_names = decode_strings(columns['type_name_offsets'], columns['type_name_strings'])
+    article = type_names.index("journal-article") if "journal-article" in type_names else -1
+    year = columns['year']
+    keep = np.flatnonzero((columns['type'] == article) & matched & (year != NO_YEAR) & (year >= start_year) & (year <= end_year)
+                          & (np.diff(columns['doi_offsets']) > 0))
+
+    dois = [normalize_doi(doi) for doi in decode_strings(columns['doi_offsets'], columns['doi_strings'], keep)]
+    titles = decode_strings(columns['title_offsets'], columns['title_strings'], keep)
+    subject_names = decode_strings(columns['subject_name_offsets'], columns['subject_name_strings'])
+    subject_offsets, subject_ids = columns['subject_offsets'], columns['subjects']
+
+    ref_positions = gather_incident_edges(np.arange(len(columns['ref_year'])), columns['ref_offsets'], keep)
+    ref_owner = np.repeat(np.arange(len(keep)), np.diff(columns['ref_offsets'])[keep])
+    ref_years = columns['ref_year'][ref_positions]
+    in_window = (ref_years >= start_year) & (ref_years <= end_year)
+    ref_positions, ref_owner, ref_years = ref_positions[in_window], ref_owner[in_window], ref_years[in_window]
+    ref_dois = [normalize_doi(doi) for doi in decode_strings(columns['ref_doi_offsets'], columns['ref_doi_strings'], ref_positions)]
+
+    metadata = {}
+    edges = []
+    ref_index = 0
+    for position, (row, doi, title) in enumerate(zip(keep.tolist(), dois, titles)):
+        if doi:
+            metadata[doi] = (title, [subject_names[i] for i in subject_ids[subject_offsets[row]:subject_offsets[row + 1]].tolist()], int(year[row]))
+        while ref_index < len(ref_dois) and ref_owner[ref_index] == position:
+            # A DOI that is nothing but a prefix normalizes to an empty string and is dropped, as in read_and_filter_data
+            if doi and ref_dois[ref_index]:
+                metadata.setdefault(ref_dois[ref_index], (None, None, int(ref_years[ref_index])))
+                edges.append((doi, ref_dois[ref_index]))
+            ref_index += 1
+    return [doi for doi in dois if doi], edges, metadata
+
+def filter_partition_task(params) -> tuple[str, dict]:
+    path, keywords, start_year, end_year, match_mode, output_path = params
+    with measure_task(file=path) as task:
+        dois, edges, metadata = filter_partition(path, compile_matcher(tuple(keywords), match_mode), start_year, end_year, task)
+        write_shard_results(dois, edges, metadata, output_path)
+        task.update(dois=len(dois), edges=len(edges))
+    return output_path, task
+
+def filter_snapshot(partitions: list[str], keywords: list[str], start_year: int, end_year: int, match_mode: str = "exact",
+                    snapshot_dir: str = SNAPSHOT_DIR, workers: int | None = None) -> list[str]:
+    # Results are written in the shard cache format, so doi_retrieval's merge produces the outputs
+    results_dir = os.path.join(snapshot_dir, 'filtered')
+    os.makedirs(results_dir, exist_ok=True)
+    tasks = [(path, keywords, start_year, end_year, match_mode, os.path.join(results_dir, os.path.basename(path)[:-4] + '.jsonl.gz'))
+             for path in partitions]
+    progress = Progress(len(tasks), "Filtering partitions")
+    results = []
+    with stage("filter_partitions", units=len(tasks)) as record, ProcessPoolExecutor(max_workers=workers or multiprocessing.cpu_count()) as executor:
+        for _, task in executor.map(filter_partition_task, tasks):
+            results.append(task)
+            progress.update(items=task["items"])
+        record.update(items=sum(task["items"] for task in results), edges=sum(task["edges"] for task in results),
+                      shard_tasks=summarize_tasks(results))
+    return [task[-1] for task in tasks]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convert the Crossref dump into a columnar snapshot once, then filter it quickly.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help="add new or changed shards to the snapshot")
+    build.add_argument('directories', nargs='*', default=SOURCE_DIRS, help="directories with Crossref .json.gz shards")
+    build.add_argument('--hash-shards', action='store_true', help="detect changed shards by content hash, not only size and mtime")
+    filter_parser = subparsers.add_parser('filter', help="write dois.txt, edges.csv and the metadata store from the snapshot")
+    filter_parser.add_argument('--keywords', default='./data/keywords.txt', help="file with one journal title per line")
+    filter_parser.add_argument('--start-year', type=int, default=2014)
+    filter_parser.add_argument('--end-year', type=int, default=2023)
+    filter_parser.add_argument('--match-mode', choices=MATCH_MODES, default='exact')
+    for subparser in (build, filter_parser):
+        subparser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+        subparser.add_argument('--workers', type=int, default=None)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    time_start = time.time()
+    if args.command == 'build':
+        partitions = build_snapshot(args.directories, args.snapshot_dir, args.hash_shards, args.workers)
+        print(f"Snapshot of {len(partitions)} shards in {args.snapshot_dir}. Total time: {time.time() - time_start:.2f} seconds.")
+        return
+
+    partitions = [entry["partition"] for _, entry in sorted(load_manifest(args.snapshot_dir)["shards"].items())]
+    results = filter_snapshot(partitions, read_keywords(args.keywords), args.start_year, args.end_year, args.match_mode,
+                              args.snapshot_dir, args.workers)
+    with stage("merge_shard_results") as record:
+        num_dois, num_edges = merge_shard_results(results, "./data/dois.txt", "./data/edges.csv", METADATA_DIR)
+        record.update(items=num_dois, edges=num_edges)
+    print(f"Processed {num_dois} DOIs and {num_edges} edges matching the target journals from {len(partitions)} snapshot partitions. "
+          f"Total time: {time.time() - time_start:.2f} seconds.")
+
+if __name__ == '__main__':
+    main()
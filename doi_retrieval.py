@@ -1,84 +1,301 @@
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing
 import gzip
 import json
 import os
 import time
 import csv
-import pickle
 import re
+import hashlib
+from instrumentation import Progress, measure_task, stage, summarize_tasks
+from journal_matcher import JournalMatcher, compile_matcher
+from metadata_store import METADATA_DIR, MetadataBuilder
+from node_index import normalize_doi
 
-def read_and_filter_data(file_path, keywords, start_year, end_year, ) -> tuple[list[str], list[tuple[str, str]], dict[str, tuple[str, list[str]]]]:
-    try:
-        with gzip.open(file_path, 'rt', encoding='utf-8') as file:
-            data = json.load(file)
-    except (json.JSONDecodeError, OSError) as e:
-        print(f"Error opening or reading file: {file_path}, {str(e)}")
-        return []
+STREAM_CHUNK_SIZE = 1 << 20
+# The original dump and the shards added by extend_crossref.py
+SOURCE_DIRS = ['./crossref_data/', './data/crossref_data']
+ITEMS_ARRAY = re.compile(r'"items"\s*:\s*\[')
+
+def iter_items(file_path, streaming: bool = True, chunk_size: int = STREAM_CHUNK_SIZE):
+    # Decodes the "items" array of a Crossref shard one record at a time, so only the
+    # current record and one chunk of text are held in memory regardless of shard size
+    with gzip.open(file_path, 'rt', encoding='utf-8') as file:
+        if not streaming:
+            yield from json.load(file).get("items", [])
+            return
 
+        decoder = json.JSONDecoder()
+        buffer = ""
+        match = None
+        while match is None:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+            match = ITEMS_ARRAY.search(buffer)
+            if match is None:
+                # keep a short tail in case the key is split across chunks
+                buffer = buffer[-16:]
+        position = match.end()
+        exhausted = False
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                if position >= len(buffer):
+                    raise json.JSONDecodeError("Incomplete record", buffer, position)
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                chunk = file.read(chunk_size)
+                exhausted = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield item
+
+def get_publication_year(item) -> int | None:
+    date_parts = item.get("published", {}).get("date-parts", [[None]])
+    publication_year = date_parts[0][0] if date_parts and date_parts[0] else None
+    if publication_year is None:
+        raise ValueError("Date-parts is missing or incorrectly formatted.")
+    return int(publication_year)
+
+def read_and_filter_data(file_path, keywords, start_year, end_year, streaming = True, match_mode = "exact", raise_errors = False, stats = None) -> tuple[list[str], list[tuple[str, str]], dict[str, tuple[str, list[str]]]]:
+    # The matcher is compiled once per worker process and reused for every shard it handles.
+    # If a stats dict is passed, the number of items read is stored in it.
+    matcher = keywords if isinstance(keywords, JournalMatcher) else compile_matcher(tuple(keywords), match_mode)
     dois = []
     edges = []
     metadata = {}
+    num_items = 0
+
+    try:
+        for item in iter_items(file_path, streaming):
+            num_items += 1
+            # Cheap checks first: type, journal and year decide whether the rest of the record is read at all
+            if item.get("type") != "journal-article":
+                continue
 
-    for item in data.get("items", []):
-        if item.get("type") != "journal-article":
-            continue
+            if not (matcher.matches(item.get("container-title", [])) or matcher.matches(item.get("short-container-title", []))):
+                continue
 
-        journal_titles = set(item.get("container-title", []) + item.get("short-container-title", []))
-        if any(keyword.lower() in title.lower() for title in journal_titles for keyword in keywords) or :
             try:
-                date_parts = item.get("published", {}).get("date-parts", [[None]])
-                publication_year = date_parts[0][0] if date_parts and date_parts[0] else None
-                if publication_year is None:
-                    raise ValueError("Date-parts is missing or incorrectly formatted.")
-            except (IndexError, ValueError) as e:
+                publication_year = get_publication_year(item)
+            except (IndexError, TypeError, ValueError) as e:
                 print(f"Warning: Could not extract publication year for DOI: {item.get('DOI', 'Unknown')}: {str(e)}")
                 continue
 
-            if publication_year and int(start_year) <= int(publication_year) <= int(end_year):
-                if any(journal in journal_titles for journal in keywords):
-                    doi = item.get("DOI")
-                    title = item.get("title", [""])[0]
-                    subjects = item.get("subject", [])
-                    if doi:
-                        dois.append(doi)
-                        metadata[doi] = (title, subjects, publication_year)
-                        for ref in item.get("reference", []):
-                            ref_doi = ref.get("DOI")
-                            ref_year = ref.get("year")
-                            if ref_doi and ref_year:
-                                match = re.search(r'\d{4}', ref_year)
-                                if match:
-                                    ref_year_clean = int(match.group())
-                                    if start_year <= ref_year_clean <= end_year:
-                                        metadata[ref_doi] = ("", "", ref_year_clean)
-                                        edges.append((doi, ref_doi))
+            if not int(start_year) <= publication_year <= int(end_year):
+                continue
+
+            doi = normalize_doi(item.get("DOI") or "")
+            if not doi:
+                continue
+            title = (item.get("title") or [""])[0]
+            subjects = item.get("subject", [])
+            dois.append(doi)
+            metadata[doi] = (title, subjects, publication_year)
+            for ref in item.get("reference", []):
+                ref_doi = normalize_doi(ref.get("DOI") or "")
+                ref_year = ref.get("year")
+                if ref_doi and ref_year:
+                    match = re.search(r'\d{4}', ref_year)
+                    if match:
+                        ref_year_clean = int(match.group())
+                        if start_year <= ref_year_clean <= end_year:
+                            # Placeholder for a DOI only known as a reference; never replaces a full record
+                            metadata.setdefault(ref_doi, (None, None, ref_year_clean))
+                            edges.append((doi, ref_doi))
+    except (json.JSONDecodeError, OSError, EOFError) as e:
+        if raise_errors:
+            raise
+        print(f"Error opening or reading file: {file_path}, {str(e)}")
+
+    if stats is not None:
+        stats["items"] = num_items
     return dois, edges, metadata
 
-def helper_task(params) -> tuple[list[str], list[str]]:
-    return read_and_filter_data(*params)
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_SAVE_INTERVAL = 50
+# Part of the cache parameters, so shard caches written in an older record format are rebuilt
+CACHE_FORMAT = 3
+
+def filter_params(keywords, start_year, end_year, match_mode) -> dict:
+    keywords_digest = hashlib.sha1("\n".join(sorted(keywords)).encode("utf-8")).hexdigest()
+    return {"format": CACHE_FORMAT, "keywords_sha1": keywords_digest, "start_year": int(start_year), "end_year": int(end_year), "match_mode": match_mode}
 
-def process_files(directory, keywords, start_year, end_year) -> list[str]:
-    files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.json.gz')]
-    with ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-        tasks = [(file, keywords, start_year, end_year) for file in files]
-        results = list(executor.map(helper_task, tasks))
+def params_digest(params) -> str:
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
 
-    all_dois = [doi for sublist in results for doi in sublist[0]]
-    all_edges = [edge for sublist in results for edge in sublist[1]]
-    flattened_edges = [edge for sublist in all_edges for edge in sublist]
-    metadata = {doi: info for sublist in results for doi, info in sublist[2].items()}
-    return all_dois, flattened_edges, metadata
+def shard_signature(file_path, hash_shards = False) -> dict:
+    stat = os.stat(file_path)
+    signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if hash_shards:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        signature["sha256"] = digest.hexdigest()
+    return signature
 
-def save_dois_to_text_file(dois, filename) -> None:
-    with open(filename, "w") as file:
+def shard_cache_path(cache_dir, file_path, digest) -> str:
+    # Shards from different directories share names (0.json.gz, 1.json.gz, ...), so key on the full path
+    path_digest = hashlib.sha1(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{path_digest[:16]}-{digest[:12]}.jsonl.gz")
+
+def load_manifest(cache_dir) -> dict:
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {"params": {}, "shards": {}}
+    with open(manifest_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def save_manifest(manifest, cache_dir) -> None:
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILENAME)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, separators=(",", ":"))
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def is_cached(entry, signature, digest) -> bool:
+    return (entry is not None and entry["signature"] == signature and entry["params"] == digest
+            and os.path.exists(entry["cache"]))
+
+def write_shard_results(dois, edges, metadata, filename) -> None:
+    # One compact JSON array per line: "d" matched DOI, "e" edge, "m" metadata of a matched
+    # article, "r" placeholder (year only) for a DOI seen as a reference
+    with gzip.open(filename + ".tmp", 'wt', encoding='utf-8') as file:
         for doi in dois:
-            file.write(doi + "\n")
+            file.write(json.dumps(["d", doi], separators=(",", ":")) + "\n")
+        for source, target in edges:
+            file.write(json.dumps(["e", source, target], separators=(",", ":")) + "\n")
+        for doi, (title, subjects, year) in metadata.items():
+            record = ["r", doi, year] if title is None else ["m", doi, title, subjects, year]
+            file.write(json.dumps(record, separators=(",", ":")) + "\n")
+    os.replace(filename + ".tmp", filename)
+
+def iter_shard_records(filename):
+    with gzip.open(filename, 'rt', encoding='utf-8') as file:
+        for line in file:
+            yield json.loads(line)
+
+def process_shard(params) -> tuple[str, dict]:
+    # Results go straight to the shard's cache file; only the path, counts and timings travel back to the parent
+    file_path, keywords, start_year, end_year, match_mode, cache_file = params
+    with measure_task(file=file_path) as task:
+        dois, edges, metadata = read_and_filter_data(file_path, keywords, start_year, end_year, True, match_mode, raise_errors=True, stats=task)
+        write_shard_results(dois, edges, metadata, cache_file)
+        task.update(dois=len(dois), edges=len(edges))
+    return cache_file, task
+
+def list_shards(directories) -> list[str]:
+    # Absolute paths, so "crossref_data" and "./crossref_data/" name the same shard in the manifests
+    return sorted(os.path.abspath(os.path.join(directory, f)) for directory in directories if os.path.isdir(directory)
+                  for f in os.listdir(directory) if f.endswith('.json.gz'))
+
+def process_files(directories, keywords, start_year, end_year, match_mode = "exact", cache_dir = "./data/shard_cache", hash_shards = False) -> list[str]:
+    os.makedirs(cache_dir, exist_ok=True)
+    params = filter_params(keywords, start_year, end_year, match_mode)
+    digest = params_digest(params)
+    manifest = load_manifest(cache_dir)
+    manifest["params"][digest] = params
+
+    files = list_shards(directories)
+    signatures = {file: shard_signature(file, hash_shards) for file in files}
+    cached = [file for file in files if is_cached(manifest["shards"].get(file), signatures[file], digest)]
+    cached_set = set(cached)
+    stale = [file for file in files if file not in cached_set]
+    print(f"{len(cached)} of {len(files)} shards unchanged, parsing {len(stale)} new or changed shards.")
 
-def save_edges_to_csv_file(edges, filename) -> None:
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerows(edges)
+    # Shards that disappeared from the directory are dropped from the manifest, together with their cache files
+    for file, entry in manifest["shards"].items():
+        if file not in signatures and os.path.exists(entry["cache"]):
+            os.remove(entry["cache"])
+    manifest["shards"] = {file: entry for file, entry in manifest["shards"].items() if file in signatures}
+
+    # Progress and the ETA of the whole pool are measured in shards; the log's units are bytes, so
+    # the next run's estimate scales with how much data is stale
+    progress = Progress(len(stale), "Parsing shards")
+    with stage("parse_shards", units=sum(signatures[file]["size"] for file in stale), shards=len(stale)) as record, \
+         ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        futures = {}
+        for file in stale:
+            cache_file = shard_cache_path(cache_dir, file, digest)
+            task = (file, keywords, start_year, end_year, match_mode, cache_file)
+            futures[executor.submit(process_shard, task)] = file
+
+        tasks = []
+        for completed, future in enumerate(as_completed(futures), start=1):
+            file = futures[future]
+            try:
+                cache_file, task = future.result()
+            except (json.JSONDecodeError, OSError, EOFError) as e:
+                print(f"Error opening or reading file: {file}, {str(e)}")
+                progress.update()
+                # The old entry describes a different file or other parameters, so it must not be merged
+                previous = manifest["shards"].pop(file, None)
+                if previous and os.path.exists(previous["cache"]):
+                    os.remove(previous["cache"])
+                continue
+            tasks.append(task)
+            progress.update(items=task["items"])
+            previous = manifest["shards"].get(file)
+            if previous and previous["cache"] != cache_file and os.path.exists(previous["cache"]):
+                os.remove(previous["cache"])
+            manifest["shards"][file] = {"signature": signatures[file], "params": digest, "cache": cache_file,
+                                        "dois": task["dois"], "edges": task["edges"]}
+            if completed % MANIFEST_SAVE_INTERVAL == 0:
+                save_manifest(manifest, cache_dir)
+        record.update(items=sum(task["items"] for task in tasks), edges=sum(task["edges"] for task in tasks),
+                      shard_tasks=summarize_tasks(tasks))
+    save_manifest(manifest, cache_dir)
+
+    return [manifest["shards"][file]["cache"] for file in files if is_cached(manifest["shards"].get(file), signatures[file], digest)]
+
+def edge_key(source, target) -> bytes:
+    # 16 bytes per remembered edge instead of a tuple of two DOI strings; a collision is practically impossible
+    return hashlib.blake2b(f"{source}\0{target}".encode("utf-8"), digest_size=16).digest()
+
+def merge_shard_results(shard_files, dois_filename, edges_filename, metadata_dir = METADATA_DIR) -> tuple[int, int]:
+    # Streams every shard file once; only the metadata columns and the seen sets grow with the corpus.
+    # An article can be in several shards (e.g. updated by extend_crossref.py) and list a reference
+    # more than once, so DOIs and edges are written once.
+    num_dois = 0
+    num_edges = 0
+    seen_dois = set()
+    seen_edges = set()
+    duplicate_edges = 0
+    metadata = MetadataBuilder()
+    with open(dois_filename, "w") as dois_file, open(edges_filename, 'w', newline='') as edges_file:
+        writer = csv.writer(edges_file)
+        for shard_file in shard_files:
+            for record in iter_shard_records(shard_file):
+                if record[0] == "d":
+                    if record[1] not in seen_dois:
+                        seen_dois.add(record[1])
+                        dois_file.write(record[1] + "\n")
+                        num_dois += 1
+                elif record[0] == "e":
+                    key = edge_key(record[1], record[2])
+                    if key in seen_edges:
+                        duplicate_edges += 1
+                        continue
+                    seen_edges.add(key)
+                    writer.writerow(record[1:])
+                    num_edges += 1
+                elif record[0] == "m":
+                    metadata.add(record[1], record[2], record[3], record[4])
+                else:
+                    metadata.add_placeholder(record[1], record[2])
+    metadata.save(metadata_dir)
+    if duplicate_edges:
+        print(f"Dropped {duplicate_edges} duplicate edges")
+    return num_dois, num_edges
 
 def read_keywords(filename, encoding = "utf-8") -> list[str]:
     with open(filename, "r") as file:
@@ -90,30 +307,26 @@ def read_target_years(filename) -> tuple[str, str]:
         end = file.readline().strip()
     return start, end
 
-def pickle_metadata(metadata, filename) -> None:
-    with open(filename, 'wb') as file:
-        pickle.dump(metadata, file)
-
 def main():
     time_start = time.time()
-    directory = "./crossref_data/"
     keywords_file = "./data/keywords.txt"
     output_file_dois = "./data/dois.txt"
     output_file_edges = "./data/edges.csv"
-    output_file_metadata = "./data/metadata.pkl"
+    output_dir_metadata = METADATA_DIR
     
     keywords = read_keywords(keywords_file)
     start_year = 2014
     end_year = 2023
+    match_mode = "exact" # "fuzzy" also accepts journals whose title contains any keyword
     
-    all_dois, edges, metadata = process_files(directory, keywords, int(start_year), int(end_year))
-
-    save_dois_to_text_file(all_dois, output_file_dois)
-    save_edges_to_csv_file(edges, output_file_edges)
-    pickle_metadata(metadata, output_file_metadata)
+    with stage("process_files"):
+        shard_files = process_files(SOURCE_DIRS, keywords, int(start_year), int(end_year), match_mode)
+    with stage("merge_shard_results") as record:
+        num_dois, num_edges = merge_shard_results(shard_files, output_file_dois, output_file_edges, output_dir_metadata)
+        record.update(items=num_dois, edges=num_edges)
     time_end = time.time()
     
-    print(f"Processed {len(all_dois)} DOIs matching the target journals. Results saved to {output_file_dois} and {output_file_edges}. \n Total time: {time_end - time_start:.2f} seconds.")
+    print(f"Processed {num_dois} DOIs and {num_edges} edges matching the target journals. Results saved to {output_file_dois} and {output_file_edges}. \n Total time: {time_end - time_start:.2f} seconds.")
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,116 @@
+# Density rasterization of edges: instead of stroking every edge, segments are sampled into
+# per-class (per-community colour) count grids, which are then shaded with an alpha derived from
+# the counts. The cost grows with the number of covered pixels, not with per-edge draw calls.
+
+import numpy as np
+
+# Counts above this are lumped into the last histogram bin for histogram equalization
+HIST_CAP = 4096
+# Upper bound on the number of samples rasterized at once
+SAMPLE_BATCH = 1 << 22
+DENSITY_SCALES = ('log', 'hist')
+
+def clip_segments(segments: np.ndarray, x0: float, y0: float, x1: float, y1: float) -> tuple[np.ndarray, np.ndarray]:
+    # Liang-Barsky clipping of (ax, ay, bx, by) rows against the rectangle [x0, x1] x [y0, y1]
+    ax, ay, bx, by = segments.T
+    dx, dy = bx - ax, by - ay
+    start = np.zeros(len(segments))
+    end = np.ones(len(segments))
+    keep = np.ones(len(segments), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, ax - x0), (dx, x1 - ax), (-dy, ay - y0), (dy, y1 - ay)):
+            ratio = q / p
+            start = np.where(p < 0, np.maximum(start, ratio), start)
+            end = np.where(p > 0, np.minimum(end, ratio), end)
+            keep &= ~((p == 0) & (q < 0))
+    keep &= start <= end
+    clipped = np.stack((ax + start * dx, ay + start * dy, ax + end * dx, ay + end * dy), axis=1)
+    return clipped[keep], keep
+
+def rasterize(clipped: np.ndarray, size: int) -> np.ndarray:
+    # One sample per pixel column (or row, for steep segments) along the major axis, taken at the
+    # column centre, so a segment never hits the same pixel twice. Returns flat pixel indices.
+    steep = np.abs(clipped[:, 3] - clipped[:, 1]) > np.abs(clipped[:, 2] - clipped[:, 0])
+    ua, va, ub, vb = np.where(steep[:, None], clipped[:, [1, 0, 3, 2]], clipped).T
+    low = np.minimum(ua, ub)
+    high = np.maximum(ua, ub)
+    du = ub - ua
+    slope = np.where(du != 0, (vb - va) / np.where(du != 0, du, 1), 0)
+    first = np.floor(low).astype(np.int64)
+    steps = np.floor(high).astype(np.int64) - first + 1
+
+    # Per segment values are expanded with np.repeat, which is cheaper than gathering per sample
+    column = np.arange(steps.sum()) + np.repeat(first - (np.cumsum(steps) - steps), steps)
+    u = np.clip(column + 0.5, np.repeat(low, steps), np.repeat(high, steps))
+    row = np.floor(np.repeat(va - slope * ua, steps) + np.repeat(slope, steps) * u).astype(np.int64)
+    np.clip(row, 0, size - 1, out=row)
+    return np.where(np.repeat(steep, steps), column * size + row, row * size + column)
+
+def count_segments(segments: np.ndarray, classes: np.ndarray, x0: float, y0: float, size: int) -> tuple[np.ndarray, np.ndarray]:
+    # Returns sorted keys (class * size^2 + pixel) and how many edges of that class cross the pixel
+    clipped, keep = clip_segments(segments - (x0, y0, x0, y0), 0, 0, size - 1e-6, size - 1e-6)
+    # Clipping is exact up to rounding, which may leave coordinates a hair outside the tile
+    clipped = np.clip(clipped, 0, size - 1e-6)
+    classes = classes[keep]
+    order = np.argsort(classes, kind='stable')
+    clipped, classes = clipped[order], classes[order]
+    lengths = np.abs(clipped[:, [0, 1]] - clipped[:, [2, 3]]).max(axis=1) + 2
+
+    keys = []
+    counts = []
+    class_ids, starts = np.unique(classes, return_index=True)
+    ends = np.append(starts[1:], len(classes))
+    for cls, start, end in zip(class_ids.tolist(), starts.tolist(), ends.tolist()):
+        # Each class is accumulated on a dense grid of one tile, in batches of bounded sample count
+        grid = np.zeros(size * size, dtype=np.int64)
+        cumulative = np.cumsum(lengths[start:end])
+        batch_start = 0
+        while batch_start < end - start:
+            done = cumulative[batch_start - 1] if batch_start else 0
+            batch_end = max(int(np.searchsorted(cumulative, done + SAMPLE_BATCH, side='right')), batch_start + 1)
+            grid += np.bincount(rasterize(clipped[start + batch_start:start + batch_end], size), minlength=size * size)
+            batch_start = batch_end
+        pixels = np.flatnonzero(grid)
+        keys.append(cls * size * size + pixels)
+        counts.append(grid[pixels])
+
+    if not keys:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(keys), np.concatenate(counts)
+
+def count_histogram(keys: np.ndarray, counts: np.ndarray, size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Sparse (class, capped count, number of pixels) triples, cheap to send back to the parent
+    classes = keys // (size * size)
+    bins, pixels = np.unique(classes * (HIST_CAP + 1) + np.minimum(counts, HIST_CAP), return_counts=True)
+    return bins // (HIST_CAP + 1), bins % (HIST_CAP + 1), pixels
+
+def equalization_table(histogram: np.ndarray) -> np.ndarray:
+    # Per class cumulative distribution of the counts over the pixels each class covers
+    cumulative = np.cumsum(histogram, axis=1).astype(np.float64)
+    table = cumulative / np.maximum(cumulative[:, -1:], 1)
+    table[:, 0] = 0
+    return table
+
+def relative_density(classes: np.ndarray, counts: np.ndarray, scale: str, maxima: np.ndarray, table: np.ndarray | None) -> np.ndarray:
+    if scale == 'log':
+        return np.log1p(counts) / np.log1p(np.maximum(maxima[classes], 1))
+    if scale == 'hist':
+        return table[classes, np.minimum(counts, HIST_CAP)]
+    raise ValueError(f"Unknown density scale: {scale}. Expected one of {DENSITY_SCALES}.")
+
+def shade_counts(keys: np.ndarray, counts: np.ndarray, class_colors: np.ndarray, scale: str, maxima: np.ndarray,
+                 table: np.ndarray | None, size: int, alpha: float) -> np.ndarray:
+    # Premultiplied RGBA. Where classes overlap, the colour is their mix weighted by edge counts and
+    # the opacities combine as independent layers, so no class hides another by drawing order.
+    classes = keys // (size * size)
+    pixels = keys % (size * size)
+    opacity = np.clip(relative_density(classes, counts, scale, maxima, table), 0, 1) * alpha
+
+    total = np.bincount(pixels, weights=counts, minlength=size * size)
+    transparency = np.exp(np.bincount(pixels, weights=np.log(np.maximum(1 - opacity, 1e-12)), minlength=size * size))
+    coverage = (1 - transparency) / np.maximum(total, 1)
+    image = np.empty((size * size, 4))
+    for channel in range(3):
+        image[:, channel] = np.bincount(pixels, weights=counts * class_colors[classes, channel], minlength=size * size) * coverage
+    image[:, 3] = 1 - transparency
+    return image.reshape(size, size, 4)
@@ -1,66 +1,165 @@
-# This script extends the crossref 2023 public data file to include records from 2024. 
+# This script extends the crossref 2023 public data file to include records from 2024.
 # The file is over 170 GiB, so it is not included in the repo, but you can easily torrent it from
-# https://academictorrents.com/details/d9e554f4f0c3047d9f49e448a7004f7aa1701b69 
+# https://academictorrents.com/details/d9e554f4f0c3047d9f49e448a7004f7aa1701b69
+#
+# The index-date range is split into slices that are harvested concurrently, each following its own
+# cursor. Progress is checkpointed after every saved page, so rerunning the same command resumes
+# an interrupted harvest. The checkpoint keeps the end date it was started with, so resuming on a
+# later day continues the same slices instead of starting a new last slice.
 
-import requests
+import aiohttp
+import asyncio
+import argparse
+import datetime
 import json
 import os
 import gzip
-import sys
+import random
+from instrumentation import Progress, stage
 
-def fetch_entries(cursor, email) -> requests.Response:
-    url = "https://api.crossref.org/works"
+CROSSREF_URL = "https://api.crossref.org/works"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class HarvestError(Exception):
+    pass
+
+def date_slices(start_date: datetime.date, end_date: datetime.date, slice_days: int) -> list[tuple[str, str]]:
+    slices = []
+    slice_start = start_date
+    while slice_start <= end_date:
+        slice_end = min(slice_start + datetime.timedelta(days=slice_days - 1), end_date)
+        slices.append((slice_start.isoformat(), slice_end.isoformat()))
+        slice_start = slice_end + datetime.timedelta(days=1)
+    return slices
+
+def load_checkpoint(checkpoint_path) -> dict:
+    if not os.path.exists(checkpoint_path):
+        return {"end_date": None, "slices": {}}
+    with open(checkpoint_path, "r", encoding="utf-8") as file:
+        checkpoint = json.load(file)
+    # Older checkpoints only held the slice states
+    return checkpoint if "slices" in checkpoint else {"end_date": None, "slices": checkpoint}
+
+def save_checkpoint(checkpoint, checkpoint_path) -> None:
+    with open(checkpoint_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(checkpoint, file, indent=1)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+def save_entries(items, file_path) -> None:
+    # Compact separators: indentation made the shards bigger and slower to write and parse
+    with gzip.open(file_path + ".tmp", 'wt', encoding="UTF-8") as zipfile:
+        json.dump({"items": items}, zipfile, separators=(",", ":"))
+    os.replace(file_path + ".tmp", file_path)
+
+async def fetch_entries(session, url, query_filter, cursor, email, rows = 1000, max_retries = 8, backoff = 1.0) -> dict:
     query_params = {
-        'filter': 'from-index-date:2023-04-01', 
-        'rows': 1000,
+        'filter': query_filter,
+        'rows': rows,
         'cursor': cursor
     }
     headers = {
         'Mailto': f'{email}'
     }
-    
-    response = requests.get(url, params=query_params, headers=headers)
-    
-    return response
 
-def save_entries(items, file_number) -> None:
-    directory = "./data/crossref_data"
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    
-    file_path = f"{directory}/{file_number}.json.gz"
-    with gzip.open(file_path, 'wt', encoding="UTF-8") as zipfile:
-        json.dump({"items": items}, zipfile, indent=4)
-    print(f"Data successfully saved to: {file_path}")
+    for attempt in range(max_retries + 1):
+        delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+        try:
+            async with session.get(url, params=query_params, headers=headers) as response:
+                if response.status == 200:
+                    return await response.json()
+                if response.status not in RETRY_STATUSES:
+                    raise HarvestError(f"Failed to fetch data: {response.status} for filter {query_filter}")
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                reason = f"status {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            reason = repr(e)
+        if attempt < max_retries:
+            print(f"Retrying {query_filter} in {delay:.1f}s after {reason}")
+            await asyncio.sleep(delay)
+    raise HarvestError(f"Giving up on filter {query_filter} after {max_retries + 1} attempts ({reason})")
 
+def slice_key(date_slice) -> str:
+    return f"{date_slice[0]}_{date_slice[1]}"
 
+async def harvest_slice(session, semaphore, checkpoint, checkpoint_path, date_slice, directory, email, url, progress = None,
+                        **fetch_options) -> int:
+    key = slice_key(date_slice)
+    state = checkpoint["slices"].setdefault(key, {"cursor": "*", "page": 0, "done": False})
+    query_filter = f"from-index-date:{date_slice[0]},until-index-date:{date_slice[1]}"
+    loop = asyncio.get_running_loop()
+    saved = 0
 
-def main():
-    try:
-        email = str(sys.argv[1])
-    except:
-        print("Please provide an email address as the first argument for the http request header.")
-        sys.exit(1)
-
-    initial_cursor = "*"
-    file_number = 1
-    
-    while True:
-        response = fetch_entries(cursor=initial_cursor, email)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            if data['message']['items']:
-                save_entries(data['message']['items'], file_number)
-                file_number += 1
-                initial_cursor = data['message']['next-cursor']
-            else:
-                print("No more data available.")
-                break
+    while not state["done"]:
+        async with semaphore:
+            data = await fetch_entries(session, url, query_filter, state["cursor"], email, **fetch_options)
+
+        items = data['message']['items']
+        if items:
+            file_path = os.path.join(directory, f"{key}_{state['page']:05d}.json.gz")
+            # Compression and disk writes run in a thread so other slices keep fetching meanwhile
+            await loop.run_in_executor(None, save_entries, items, file_path)
+            state["page"] += 1
+            state["cursor"] = data['message']['next-cursor']
+            saved += 1
+            if progress is not None:
+                progress.update(done=0, items=1)
         else:
-            print("Failed to fetch data:", response.status_code)
-            break
+            state["done"] = True
+        save_checkpoint(checkpoint, checkpoint_path)
+
+    print(f"Slice {key} complete ({state['page']} pages).")
+    return saved
+
+async def harvest(email, start_date, end_date = None, directory = "./data/crossref_data", slice_days = 7,
+                  concurrency = 4, url = CROSSREF_URL, **fetch_options) -> int:
+    os.makedirs(directory, exist_ok=True)
+    checkpoint_path = os.path.join(directory, "checkpoint.json")
+    checkpoint = load_checkpoint(checkpoint_path)
+    if end_date is None:
+        # Without an explicit end date an unfinished harvest is resumed up to its own end date, since the
+        # slice keys and cursors depend on it; otherwise the harvest runs up to today
+        stored = checkpoint["end_date"] and datetime.date.fromisoformat(checkpoint["end_date"])
+        unfinished = stored and any(not checkpoint["slices"].get(slice_key(s), {}).get("done")
+                                    for s in date_slices(start_date, stored, slice_days))
+        end_date = stored if unfinished else datetime.date.today()
+    checkpoint["end_date"] = end_date.isoformat()
+    slices = date_slices(start_date, end_date, slice_days)
+    pending = [s for s in slices if not checkpoint["slices"].get(slice_key(s), {}).get("done")]
+    print(f"Harvesting {len(pending)} of {len(slices)} date slices ({len(slices) - len(pending)} already complete).")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    timeout = aiohttp.ClientTimeout(total=300)
+    # Counts finished slices; the rate is in pages, updated as each page is saved
+    progress = Progress(len(pending), "Harvesting slices", unit="pages")
+
+    async def tracked(date_slice) -> int:
+        pages = await harvest_slice(session, semaphore, checkpoint, checkpoint_path, date_slice, directory, email, url, progress,
+                                    **fetch_options)
+        progress.update()
+        return pages
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        saved = await asyncio.gather(*(tracked(s) for s in pending))
+    print(f"Saved {sum(saved)} pages to {directory}.")
+    return sum(saved)
+
+def main():
+    parser = argparse.ArgumentParser(description="Harvest Crossref records indexed after the public data file was released.")
+    parser.add_argument("email", help="email address for the http request header")
+    parser.add_argument("--start-date", default="2023-04-01", type=datetime.date.fromisoformat)
+    parser.add_argument("--end-date", default=None, type=datetime.date.fromisoformat,
+                        help="defaults to today, or to the end date of an unfinished harvest being resumed")
+    parser.add_argument("--slice-days", default=7, type=int, help="days of index dates per concurrently harvested slice")
+    parser.add_argument("--concurrency", default=4, type=int, help="maximum number of requests in flight")
+    parser.add_argument("--directory", default="./data/crossref_data")
+    parser.add_argument("--url", default=CROSSREF_URL, help="API endpoint, e.g. a local stub server for testing")
+    args = parser.parse_args()
+
+    with stage("harvest") as record:
+        record["pages"] = asyncio.run(harvest(args.email, args.start_date, args.end_date, args.directory, args.slice_days,
+                                              args.concurrency, args.url))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,21 +1,31 @@
 import csv
+import os
 import igraph as ig
 import pickle
 import random
 import math
 import colorsys
-import os
-import sys
 import leidenalg as la
-from PIL import Image
-Image.MAX_IMAGE_PIXELS = None
+import argparse
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import shutil
+import numpy as np
+from node_index import NodeIndex, factorize_edges, join_indices, save_node_index, save_edge_arrays, load_edge_arrays
+from stage_cache import run_stages
+from metadata_store import METADATA_DIR, MetadataStore
+from graph_store import STORE_DIR, build_graph_store, counting_sort_order, gather_incident_edges, unique_unsorted
+from edge_density import DENSITY_SCALES
+from tile_renderer import EDGE_MODES, TILE_SIZE, render_tiled
+from multilevel_layout import multilevel_layout, warm_start_layout
 
 def read_dois_from_file(filepath='./data/dois.txt') -> set[str]:
     with open(filepath, 'r', encoding='utf-8') as file:
         dois = {line.strip() for line in file} 
     return dois
 
-def filter_edges_and_save(valid_dois: list[str], input_filepath: str ='./data/edges.csv', output_filepath:str ='./data/edges_filtered.csv'):
+def filter_edges_and_save(valid_dois: set[str], input_filepath: str ='./data/edges.csv', output_filepath:str ='./data/edges_filtered.csv'):
     with open(input_filepath, 'r', encoding='utf-8') as infile, \
          open(output_filepath, 'w', encoding='utf-8', newline='') as outfile:
       
@@ -26,72 +36,185 @@ def filter_edges_and_save(valid_dois: list[str], input_filepath: str ='./data/ed
             if len(row) >= 2 and row[1] in valid_dois:  
                 writer.writerow(row)
 
-
-def get_node_ids() -> dict[str, int|int, str]:
-    node_count = 0
-    node_ids = {}
-    with open('./data/edges.csv', encoding="utf-8") as links_file:
-        reader = csv.reader(links_file)
-
-
-        for row in reader:
-            if row[0] not in node_ids:
-                node_ids[row[0]] = node_count
-                node_ids[node_count] = row[0]
-                node_count += 1
-            if row[1] not in node_ids:
-                node_ids[row[1]] = node_count
-                node_ids[node_count] = row[1]
-                node_count += 1
-
-    with open('./data/node_ids.pkl', 'wb') as node_file:
-        pickle.dump(node_ids, node_file)
-    return node_ids
-
-def get_edges(node_ids: dict) -> list[tuple[int, int]]:
-    edges = []
-
-    with open('./data/edges.csv', encoding="utf-8") as links_file:
-        reader = csv.reader(links_file)
-        next(reader, None)
-
-        link_count = 0
-        for row in reader:                    
-            edges.append((node_ids[row[0]], node_ids[row[1]]))
-    return edges
-
-def create_graph(node_ids: dict, edges: list[tuple[int, int]]) -> ig.Graph:
-    node_count = int(len(node_ids)/2)
-    graph = ig.Graph(node_count, edges=edges, directed=True)
+def prune_deadends(sources: np.ndarray, targets: np.ndarray, num_nodes: int, strip_uncited: bool = True, strip_nonciting: bool = True) -> tuple[np.ndarray, np.ndarray, list[int]]:
+    out_degree = np.bincount(sources, minlength=num_nodes)
+    in_degree = np.bincount(targets, minlength=num_nodes)
+    out_offsets = np.concatenate(([0], np.cumsum(out_degree)))
+    in_offsets = np.concatenate(([0], np.cumsum(in_degree)))
+    out_order = counting_sort_order(sources)
+    in_order = counting_sort_order(targets)
+
+    def is_deadend(nodes):
+        return (strip_uncited & (in_degree[nodes] == 0)) | (strip_nonciting & (out_degree[nodes] == 0))
+
+    removed = np.zeros(num_nodes, dtype=bool)
+    stamp = np.zeros(num_nodes, dtype=np.int64)
+    edge_alive = np.ones(len(sources), dtype=bool)
+    frontier = np.flatnonzero(is_deadend(np.arange(num_nodes)))
+    removed_per_round = []
+
+    # Each edge is dropped exactly once and only nodes touching dropped edges are re-checked, and
+    # nothing inside the loop sorts, so the total work is linear in the number of edges
+    while len(frontier):
+        removed[frontier] = True
+        removed_per_round.append(len(frontier))
+        print(f"Round {len(removed_per_round)}: removed {len(frontier)} nodes")
+
+        # An edge between two frontier nodes is taken from its source's side only
+        cited_by_frontier = gather_incident_edges(in_order, in_offsets, frontier)
+        incident = np.concatenate((gather_incident_edges(out_order, out_offsets, frontier),
+                                   cited_by_frontier[~removed[sources[cited_by_frontier]]]))
+        incident = incident[edge_alive[incident]]
+        edge_alive[incident] = False
+
+        np.subtract.at(out_degree, sources[incident], 1)
+        np.subtract.at(in_degree, targets[incident], 1)
+
+        touched = np.concatenate((sources[incident], targets[incident]))
+        touched = unique_unsorted(touched[~removed[touched]], stamp)
+        frontier = touched[is_deadend(touched)]
+
+    return edge_alive, removed, removed_per_round
+
+def remove_disguised_deadends(input_filepath: str = './data/edges_filtered.csv', links_filepath: str = './data/links.csv', deadends_filepath: str = './data/deadends.txt', strip_uncited: bool = True, strip_nonciting: bool = True) -> tuple[int, int]:
+    sources, targets, dois = factorize_edges(input_filepath)
+    edge_alive, removed, removed_per_round = prune_deadends(sources, targets, len(dois), strip_uncited, strip_nonciting)
+
+    with open(links_filepath, 'w', encoding='utf-8', newline='') as links_file:
+        writer = csv.writer(links_file)
+        for source, target in zip(sources[edge_alive].tolist(), targets[edge_alive].tolist()):
+            writer.writerow((dois[source], dois[target]))
+
+    with open(deadends_filepath, 'w', encoding='utf-8') as deadends_file:
+        for node in np.flatnonzero(removed).tolist():
+            deadends_file.write(dois[node] + '\n')
+
+    print(f"Removed {int(removed.sum())} dead-end nodes in {len(removed_per_round)} rounds, kept {int(edge_alive.sum())} of {len(sources)} edges.")
+    return int(removed.sum()), int(edge_alive.sum())
+
+def get_node_ids(edges_filepath: str = './data/edges.csv', directory: str = './data/node_index') -> NodeIndex:
+    # Single pass: DOIs are factorized into int32 edge arrays while the id -> DOI table is built
+    sources, targets, dois = factorize_edges(edges_filepath)
+    save_node_index(dois, directory)
+    save_edge_arrays(sources, targets, directory)
+    print(f"Indexed {len(dois)} nodes and {len(sources)} edges.")
+    return NodeIndex(directory)
+
+def get_edges(directory: str = './data/node_index') -> tuple[np.ndarray, np.ndarray]:
+    return load_edge_arrays(directory)
+
+def create_graph(num_nodes: int, sources: np.ndarray, targets: np.ndarray) -> ig.Graph:
+    graph = ig.Graph(num_nodes, edges=list(zip(sources.tolist(), targets.tolist())), directed=True)
 
     with open('./data/graph.pkl', 'wb') as graph_file:
         pickle.dump(graph, graph_file)
     return graph
 
-def get_layout(graph: ig.Graph) -> ig.layout:
-    print("Generating layout... This may take a few hours to days, depending on the number of edges")
-    #Note: It took me 130 minutes for 7.7 million edges
-    layout = graph.layout('drl')
+def get_layout(graph: ig.Graph, algorithm: str = 'drl', membership: np.ndarray | None = None, previous: tuple[np.ndarray, np.ndarray] | None = None, seed: int = 0) -> ig.Layout:
+    if previous is not None:
+        print("Warm-starting layout from the previous layout...")
+        sources, targets = graph_edge_arrays(graph)
+        coords = warm_start_layout(sources, targets, graph.vcount(), *previous, membership, seed)
+        layout = ig.Layout(coords.tolist())
+    elif algorithm == 'multilevel':
+        print("Generating multilevel layout from the community structure...")
+        sources, targets = graph_edge_arrays(graph)
+        layout = ig.Layout(multilevel_layout(sources, targets, membership, seed=seed).tolist())
+    else:
+        print("Generating layout... This may take a few hours to days, depending on the number of edges")
+        #Note: It took me 130 minutes for 7.7 million edges
+        random.seed(seed)
+        layout = graph.layout(algorithm)
 
     with open('./data/layout.pkl', 'wb') as layout_file:
         pickle.dump(layout, layout_file)
     return layout
 
-
-def get_partition(graph: ig.Graph):
-    partition = la.find_partition(graph, la.RBConfigurationVertexPartition, resolution_parameter = 1)
-
-    partition_list = []
-    for p in partition:
-        partition_list.append(p)
-
-    partition_dict = {}
-    for i in range(len(partition)):
-        for j in partition[i]:
-            partition_dict[j] = i
+def map_previous_nodes(node_ids: NodeIndex, snapshot_dir: str) -> tuple[np.ndarray, np.ndarray] | None:
+    # Node ids change whenever the edge list does, so results are carried over through the DOI
+    # table that was current when they were computed
+    if not os.path.exists(snapshot_dir):
+        return None
+    old_nodes = NodeIndex(snapshot_dir)
+    new_ids = join_indices(old_nodes, node_ids)
+    found = new_ids >= 0
+    return np.flatnonzero(found), new_ids[found]
+
+def previous_layout_positions(node_ids: NodeIndex, layout_path: str = './data/layout.pkl', layout_nodes_dir: str = './data/layout_nodes') -> tuple[np.ndarray, np.ndarray] | None:
+    mapping = map_previous_nodes(node_ids, layout_nodes_dir)
+    if mapping is None or not os.path.exists(layout_path):
+        return None
+    old_ids, new_ids = mapping
+    with open(layout_path, 'rb') as file:
+        old_coords = np.array(pickle.load(file).coords, dtype=np.float64).reshape(-1, 2)
+    return new_ids, old_coords[old_ids]
+
+def snapshot_node_index(snapshot_dir: str, node_index_dir: str = './data/node_index') -> None:
+    os.makedirs(snapshot_dir, exist_ok=True)
+    for filename in ('offsets.npy', 'strings.npy', 'index.npy'):
+        shutil.copyfile(os.path.join(node_index_dir, filename), os.path.join(snapshot_dir, filename))
+
+def optimise_partition(task) -> tuple[float, list[int], float]:
+    num_nodes, sources, targets, resolution, seed, initial_membership = task
+    graph = ig.Graph(num_nodes, edges=list(zip(sources.tolist(), targets.tolist())), directed=True)
+    partition = la.RBConfigurationVertexPartition(graph, initial_membership=initial_membership, resolution_parameter=resolution)
+    optimiser = la.Optimiser()
+    optimiser.set_rng_seed(seed)
+    optimiser.optimise_partition(partition, n_iterations=2)
+    # Largest community first, so the top-k communities are simply 0..k-1
+    partition.renumber_communities()
+    return resolution, partition.membership, partition.quality()
+
+def partition_statistics(resolution: float, membership: list[int], quality: float, top: int = 10) -> dict:
+    sizes = np.sort(np.bincount(membership))[::-1]
+    return {
+        'resolution': resolution,
+        'quality': quality,
+        'communities': int(len(sizes)),
+        'singletons': int((sizes == 1).sum()),
+        'largest': sizes[:top].tolist(),
+        'top_coverage': float(sizes[:top].sum() / sizes.sum()),
+    }
+
+def get_partition(graph: ig.Graph, resolution: float = 1, seed: int = 0, resolutions: list[float] | None = None, initial_membership: np.ndarray | None = None, workers: int | None = None):
+    # Every resolution in the sweep is optimised in its own process; the one at `resolution` is returned
+    resolutions = sorted(set(resolutions or []) | {resolution})
+    sources, targets = graph_edge_arrays(graph)
+    initial = initial_membership.tolist() if initial_membership is not None else None
+    tasks = [(graph.vcount(), sources, targets, r, seed, initial) for r in resolutions]
+    if len(tasks) == 1:
+        results = [optimise_partition(tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=min(len(tasks), workers or multiprocessing.cpu_count())) as executor:
+            results = list(executor.map(optimise_partition, tasks))
+
+    statistics = [partition_statistics(*result) for result in results]
+    for stats in statistics:
+        print(f"Resolution {stats['resolution']}: {stats['communities']} communities, quality {stats['quality']:.2f}, "
+              f"top {len(stats['largest'])} cover {stats['top_coverage']:.1%}")
+    membership = next(m for r, m, _ in results if r == resolution)
+
+    partition_list = [[] for _ in range(max(membership) + 1)]
+    for node, community in enumerate(membership):
+        partition_list[community].append(node)
+    partition_dict = dict(enumerate(membership))
     print(f"Number of partitions: {len(partition_list)}")
 
-    return partition, partition_list, partition_dict
+    return membership, partition_list, partition_dict, statistics
+
+def warm_start_membership(node_ids: NodeIndex, num_nodes: int, partition_path: str = './data/partition_dict.pkl', partition_nodes_dir: str = './data/partition_nodes') -> np.ndarray | None:
+    mapping = map_previous_nodes(node_ids, partition_nodes_dir)
+    if mapping is None or not os.path.exists(partition_path):
+        return None
+    old_ids, new_ids = mapping
+    with open(partition_path, 'rb') as file:
+        previous = pickle.load(file)
+    old_membership = membership_array(previous, max(previous) + 1)
+    # Nodes that were not partitioned before start out as singleton communities
+    membership = np.arange(num_nodes, dtype=np.int64) + int(old_membership.max(initial=-1)) + 1
+    membership[new_ids] = old_membership[old_ids]
+    print(f"Warm-starting partition: {len(new_ids)} of {num_nodes} nodes keep their previous community.")
+    return np.unique(membership, return_inverse=True)[1]
 
 def find_factors(num_vertices: int) -> tuple[int, int]:
     for i in range(int(math.sqrt(num_vertices)), 0, -1):
@@ -99,7 +222,7 @@ def find_factors(num_vertices: int) -> tuple[int, int]:
             return (num_vertices // i, i)
     return (num_vertices, 1)
 
-def generate_colors_exact(num_partitions: int, overwrite_top_ten: bool = True):
+def generate_colors_exact(num_partitions: int, overwrite_top_ten: bool = True, colors_path: str | None = './data/colors.txt'):
     num_hues, num_saturations = find_factors(num_partitions)
     v = 0.8
     node_colors = []
@@ -158,148 +281,285 @@ def generate_colors_exact(num_partitions: int, overwrite_top_ten: bool = True):
         node_colors[:10] = new_node_colors
         edge_colors[:10] = new_edge_colors
 
-    with open('./data/colors.txt', 'w') as color_file:
-        for i in range(len(node_colors)):
-            color_file.write(f'{node_colors[i]}\n')
+    if colors_path:
+        with open(colors_path, 'w') as color_file:
+            for i in range(len(node_colors)):
+                color_file.write(f'{node_colors[i]}\n')
     
     return node_colors, edge_colors
 
 
-def truncate_graph(graph: ig.Graph, partition_dict: dict[int, str], node_ids, included_partitions) -> ig.Graph:
-    graph.delete_edges()
+def membership_array(partition_dict: dict[int, int], num_nodes: int) -> np.ndarray:
+    membership = np.full(num_nodes, -1, dtype=np.int32)
+    membership[np.fromiter(partition_dict.keys(), dtype=np.int64, count=len(partition_dict))] = \
+        np.fromiter(partition_dict.values(), dtype=np.int32, count=len(partition_dict))
+    return membership
 
-    edges = []
+def graph_edge_arrays(graph: ig.Graph) -> tuple[np.ndarray, np.ndarray]:
+    edges = np.array(graph.get_edgelist(), dtype=np.int32).reshape(-1, 2)
+    return edges[:, 0], edges[:, 1]
 
-    with open('./data/links.csv', encoding="utf-8") as links_file:
-        reader = csv.reader(links_file)
-        next(reader, None)
+def truncate_graph(graph: ig.Graph, membership: np.ndarray, included_partitions, inter_community_fraction: float = 0.0, seed: int = 0) -> ig.Graph:
+    sources, targets = graph_edge_arrays(graph)
+    source_partition = membership[sources]
+    target_partition = membership[targets]
+    included = np.isin(source_partition, included_partitions) & np.isin(target_partition, included_partitions)
 
-        link_count = 0
-        for row in reader:
-            source_partition = partition_dict[node_ids[row[0]]]
-            target_partition = partition_dict[node_ids[row[1]]]
+    # Keep edges that start and end in the same included partition, plus an optional random
+    # sample of the edges running between included partitions
+    keep = included & (source_partition == target_partition)
+    if inter_community_fraction > 0:
+        rng = np.random.default_rng(seed)
+        keep |= included & (source_partition != target_partition) & (rng.random(len(sources)) < inter_community_fraction)
 
-            # Only add edge if it starts and ends in the same partition and the partition is included
-            if source_partition == target_partition and source_partition in included_partitions:
-                    edges.append((node_ids[row[0]], node_ids[row[1]]))
-    graph.add_edges(edges)
+    graph.delete_edges(np.flatnonzero(~keep).tolist())
     return graph
 
-
-def set_colors(graph, partition, partition_dict, node_colors, edge_colors) -> ig.Graph:
-    for i in range(len(partition)):
-        for node in partition[i]:
-            graph.vs[node]['color'] = node_colors[i]
-            graph.vs[node]['frame_color'] = 'rgba(0, 0, 0, 0.5)'
-            
-            size = 168 * math.log10(0.00005 * graph.vs[node].indegree() + 1) + 3
-            graph.vs[node]['size'] = size
-            frame_size = 0.1 + (6.56/197) * (size-3)
-            graph.vs[node]['frame_width'] = frame_size
-    for edge in range(graph.ecount()):
-        source_partition = partition_dict[graph.es[edge].source]
-        target_partition = partition_dict[graph.es[edge].target]
-        if source_partition == target_partition:
-            graph.es[edge]['color'] = edge_colors[source_partition]
-    
-    with open('./data/graph_styled.pkl', 'wb') as graph_file:
-        pickle.dump(graph, graph_file)
+def indegree_to_size(indegree: np.ndarray) -> np.ndarray:
+    return 168 * np.log10(0.00005 * indegree + 1) + 3
+
+def size_by_indegree(graph: ig.Graph, years: np.ndarray | None = None) -> np.ndarray:
+    return indegree_to_size(np.asarray(graph.indegree(), dtype=np.float64))
+
+def size_by_pagerank(graph: ig.Graph, years: np.ndarray | None = None) -> np.ndarray:
+    # PageRank sums to one; scaling by the edge count puts it on the same footing as indegree
+    return indegree_to_size(np.asarray(graph.pagerank(), dtype=np.float64) * graph.ecount())
+
+def size_by_year(graph: ig.Graph, years: np.ndarray | None = None) -> np.ndarray:
+    # Older papers are drawn larger
+    return 3 + 20 * (1 - normalize_years(years))
+
+def normalize_years(years: np.ndarray) -> np.ndarray:
+    if years is None:
+        raise ValueError("Year-based mappings need the publication year of every node.")
+    known = years[years > 0]
+    if len(known) == 0:
+        return np.zeros(len(years))
+    first, last = known.min(), known.max()
+    return np.clip((np.where(years > 0, years, first) - first) / max(last - first, 1), 0, 1)
+
+def color_by_partition(membership: np.ndarray, node_colors: list[str], edge_colors: list[str], years: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    return np.asarray(node_colors, dtype=object)[membership], np.asarray(edge_colors, dtype=object)[membership]
+
+def year_color_bases(years: np.ndarray) -> np.ndarray:
+    # Blue for the oldest papers through to yellow for the newest, as 'rgba(r,g,b,' awaiting the alpha
+    hues, inverse = np.unique(np.round(0.66 - 0.5 * normalize_years(years), 3), return_inverse=True)
+    rgb = (np.array([colorsys.hsv_to_rgb(hue, 0.9, 0.9) for hue in hues]) * 255).astype(int).reshape(-1, 3)
+    return np.array([f'rgba({r},{g},{b},' for r, g, b in rgb.tolist()], dtype=object)[inverse]
+
+def color_by_year(membership: np.ndarray, node_colors: list[str], edge_colors: list[str], years: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    base = year_color_bases(years)
+    return base + '0.8)', base + '0.05)'
+
+def year_legend(years: np.ndarray, num_entries: int = 6) -> list[tuple[str, str]]:
+    # Evenly spaced years from the first to the last, coloured as color_by_year colours them
+    known = years[years > 0]
+    if len(known) == 0:
+        return []
+    marks = np.unique(np.round(np.linspace(known.min(), known.max(), num_entries)).astype(int))
+    return [(str(year), base + '0.8)') for year, base in zip(marks.tolist(), year_color_bases(marks).tolist())]
+
+def save_color_key(color_by: str, years: np.ndarray | None = None, filepath: str = './data/color_key.json') -> None:
+    # What the node colours stand for, so annotate_graph.py draws a legend that matches the image.
+    # Partition colours are listed in colors.txt; other mappings list their legend entries here
+    key = {'color_by': color_by}
+    if color_by == 'year':
+        key['legend'] = year_legend(years)
+    with open(filepath, 'w', encoding='utf-8') as file:
+        json.dump(key, file, indent=1)
+
+SIZE_MAPPINGS = {'indegree': size_by_indegree, 'pagerank': size_by_pagerank, 'year': size_by_year}
+COLOR_MAPPINGS = {'partition': color_by_partition, 'year': color_by_year}
+
+def node_years(node_ids: NodeIndex, metadata: MetadataStore) -> np.ndarray:
+    # 0 where a node has no metadata
+    return metadata.years_for(metadata.rows_for_index(node_ids))
+
+def set_colors(graph: ig.Graph, membership: np.ndarray, node_colors: list[str], edge_colors: list[str], size_by: str = 'indegree', color_by: str = 'partition', years: np.ndarray | None = None,
+               styled_path: str | None = './data/graph_styled.pkl') -> ig.Graph:
+    # Every attribute is computed for all vertices/edges at once and assigned as a whole list
+    sizes = SIZE_MAPPINGS[size_by](graph, years)
+    vertex_colors, vertex_edge_colors = COLOR_MAPPINGS[color_by](membership, node_colors, edge_colors, years)
+
+    graph.vs['color'] = vertex_colors.tolist()
+    graph.vs['frame_color'] = ['rgba(0, 0, 0, 0.5)'] * graph.vcount()
+    graph.vs['size'] = sizes.tolist()
+    graph.vs['frame_width'] = (0.1 + (6.56/197) * (sizes - 3)).tolist()
+
+    # Edges take the colour of the citing node
+    sources, _ = graph_edge_arrays(graph)
+    graph.es['color'] = vertex_edge_colors[sources].tolist()
+
+    if styled_path:
+        with open(styled_path, 'wb') as graph_file:
+            pickle.dump(graph, graph_file)
     return graph
 
-def plot_graph(graph, layout, width = 19200, height = 10800) -> None:
-    visual_style = {}
-
-    visual_style["bbox"] = (height, width) # Dimension of the image (has to be rotated after creation)
-    visual_style["margin"] = 50 # Margin of pixels from the borders
-    visual_style["layout"] = layout
-    visual_style["background"] = 'rgba(0, 0, 0, 0)' # Transparent background
-    visual_style["edge_arrow_size"] = 0
-    visual_style["edge_width"] = 0.25
-    visual_style["node_order_by"] = 'size' # Draw nodes in order of their size, larger nodes will be drawn last
-
-    image_path = "./data/graph.png"
-
-    plot = ig.plot(graph, image_path, **visual_style)
-
-    # Rotate the image
-    img = Image.open(image_path)
-    img = img.rotate(90, expand=True)
-    img.save(image_path)
-    print(f"Graph saved to {image_path}")
-
-
-# I apologize for the messiness of this main function, some steps take very long, and this was a convenient way to avoid them
-def main():
-    redo_everything = bool(sys.argv[1])
-    if not redo_everything:
-        print("Running in normal mode, skipping already generated files. Use 'python graph_psych.py True' to redo everything.")
-    valid_dois = read_dois_from_file()
-
-    if not os.path.exists('./data/edges_filtered.csv') and not redo_everything:
-        print("Filtering edges file...")
-        filter_edges_and_save(valid_dois)
-    else:
-        print("Filtered edges file already exists, skipping edge filtering.")
-
-    if (not os.path.exists('./data/links.csv') or not os.path.exists('./data/deadends.txt')) and not redo_everything:
-        print("Generating links file...")
-        remove_disguised_deadends()
-    else:
-        print("Link file already exists, skipping link generation.")
-
-    if not os.path.exists('./data/node_ids.pkl') and not redo_everything:
-        print("Generating node IDs file...")
-        node_ids = get_node_ids()
-    else:
-        print("Loading existing node IDs file...")
-        with open('./data/node_ids.pkl', 'rb') as file:
-            node_ids = pickle.load(file)
-
-    if not os.path.exists('./data/graph.pkl') and not redo_everything:
-        print("Generating graph object file...")
-        if 'node_ids' not in locals():
-            with open('./data/node_ids.pkl', 'rb') as file:
-                node_ids = pickle.load(file)
-        edges = get_edges(node_ids)
-        graph = create_graph(node_ids, edges)
-    else:
-        print("Loading existing graph object...")
+def plot_graph(graph, layout, width = 19200, height = 10800, tile_size = TILE_SIZE, workers = None, edge_mode = 'strokes', density_scale = 'log') -> None:
+    # Drawn directly in landscape orientation, tile by tile in parallel; the tiles also make up
+    # a zoom pyramid in ./data/pyramid for interactive viewing. edge_mode='density' shades per
+    # pixel edge counts in the community colours instead of stroking every edge
+    render_tiled(graph, layout, image_path="./data/graph.png", pyramid_dir="./data/pyramid", width=width, height=height,
+                 margin=50, tile_size=tile_size, edge_width=0.25, workers=workers, edge_mode=edge_mode, density_scale=density_scale)
+
+def load_pickle(filepath: str, artifacts: dict):
+    # Stages run in one process share loaded artifacts instead of unpickling them again
+    if filepath not in artifacts:
+        with open(filepath, 'rb') as file:
+            artifacts[filepath] = pickle.load(file)
+    return artifacts[filepath]
+
+def save_pickle(obj, filepath: str, artifacts: dict) -> None:
+    with open(filepath, 'wb') as file:
+        pickle.dump(obj, file)
+    artifacts[filepath] = obj
+
+def build_stages(args) -> dict:
+    artifacts = {}
+    graph_edges = './data/links.csv'
+    node_index_dir = './data/node_index'
+    node_index_files = [os.path.join(node_index_dir, f) for f in ('offsets.npy', 'strings.npy', 'index.npy')]
+    edge_array_files = [os.path.join(node_index_dir, f) for f in ('sources.npy', 'targets.npy')]
+    metadata_files = [os.path.join(METADATA_DIR, f) for f in ('years.npy', 'offsets.npy', 'strings.npy', 'index.npy')]
+    store_files = [os.path.join(STORE_DIR, f) for f in ('store.json', 'out_offsets.npy', 'out_neighbors.npy', 'in_offsets.npy', 'in_neighbors.npy',
+                                                         'membership.npy', 'community_offsets.npy', 'community_nodes.npy', 'strings.npy')]
+
+    def filter_stage():
+        filter_edges_and_save(read_dois_from_file())
+
+    def deadends_stage():
+        remove_disguised_deadends(strip_uncited=args.deadends in ('both', 'uncited'),
+                                  strip_nonciting=args.deadends in ('both', 'nonciting'))
+
+    def node_ids_stage():
+        get_node_ids(graph_edges, node_index_dir)
+
+    def graph_stage():
+        sources, targets = get_edges(node_index_dir)
+        artifacts['./data/graph.pkl'] = create_graph(len(NodeIndex(node_index_dir)), sources, targets)
+
+    def layout_stage():
+        graph = load_pickle('./data/graph.pkl', artifacts)
+        membership = None
+        if args.layout == 'multilevel' or args.warm_start_layout:
+            membership = membership_array(load_pickle('./data/partition_dict.pkl', artifacts), graph.vcount())
+        previous = previous_layout_positions(NodeIndex(node_index_dir)) if args.warm_start_layout else None
+        artifacts['./data/layout.pkl'] = get_layout(graph, args.layout, membership, previous, args.seed)
+        snapshot_node_index('./data/layout_nodes', node_index_dir)
+
+    def partition_stage():
+        graph = load_pickle('./data/graph.pkl', artifacts)
+        initial_membership = None
+        if args.warm_start_partition:
+            initial_membership = warm_start_membership(NodeIndex(node_index_dir), graph.vcount())
+        membership, partition_list, partition_dict, statistics = get_partition(
+            graph, args.resolution, args.seed, args.resolutions, initial_membership)
+        save_pickle(partition_list, './data/partition_list.pkl', artifacts)
+        save_pickle(partition_dict, './data/partition_dict.pkl', artifacts)
+        with open('./data/partition_sweep.json', 'w', encoding='utf-8') as file:
+            json.dump(statistics, file, indent=1)
+        snapshot_node_index('./data/partition_nodes', node_index_dir)
+
+    def store_stage():
+        sources, targets = get_edges(node_index_dir)
+        membership = membership_array(load_pickle('./data/partition_dict.pkl', artifacts), len(NodeIndex(node_index_dir)))
+        build_graph_store(sources, targets, membership, node_index_dir, STORE_DIR)
+
+    def style_stage():
+        partition_list = load_pickle('./data/partition_list.pkl', artifacts)
+        partition_dict = load_pickle('./data/partition_dict.pkl', artifacts)
+        # truncate_graph edits the graph in place, so work on a fresh copy
         with open('./data/graph.pkl', 'rb') as file:
             graph = pickle.load(file)
 
-    if not os.path.exists('./data/layout.pkl') and not redo_everything:
-        print("Generating layout file...")
-        layout = get_layout(graph)
-    else:
-        print("Loading existing layout...")
-        with open('./data/layout.pkl', 'rb') as file:
-            layout = pickle.load(file)
-
-
-    print("Generating partition files...")
-    partition, partition_list, partition_dict = get_partition(graph)
-    with open('./data/partition_list.pkl', 'wb') as file:
-        pickle.dump(partition_list, file)
-    with open('./data/partition_dict.pkl', 'wb') as file:
-        pickle.dump(partition_dict, file)
-
-
-    print("Generating colors file...")
-    node_colors, edge_colors = generate_colors_exact(len(partition_list))
-
-    print("Removing edges from graph...")
-    graph = truncate_graph(graph, partition_dict, node_ids, included_partitions=list(range(10)))
-
-    print("Generating styled graph...")
-    graph = set_colors(graph, partition, partition_dict, node_colors, edge_colors)
+        node_colors, edge_colors = generate_colors_exact(len(partition_list))
+        membership = membership_array(partition_dict, graph.vcount())
+        graph = truncate_graph(graph, membership, list(range(args.top_partitions)), args.inter_community_fraction, args.seed)
+        years = None
+        if 'year' in (args.size_by, args.color_by):
+            years = node_years(NodeIndex(node_index_dir), MetadataStore(METADATA_DIR))
+        artifacts['./data/graph_styled.pkl'] = set_colors(graph, membership, node_colors, edge_colors, args.size_by, args.color_by, years)
+        save_color_key(args.color_by, years)
+
+    def render_stage():
+        plot_graph(load_pickle('./data/graph_styled.pkl', artifacts), load_pickle('./data/layout.pkl', artifacts), tile_size=args.tile_size,
+                   edge_mode=args.edge_mode, density_scale=args.density_scale)
+
+    layout_uses_partition = args.layout == 'multilevel' or args.warm_start_layout
+
+    # Declared in topological order; inputs are hashed to decide whether a stage is stale
+    return {
+        'filter': {'deps': [], 'inputs': ['./data/dois.txt', './data/edges.csv'],
+                   'outputs': ['./data/edges_filtered.csv'], 'run': filter_stage},
+        'deadends': {'deps': ['filter'], 'inputs': ['./data/edges_filtered.csv'], 'params': {'deadends': args.deadends},
+                     'outputs': [graph_edges, './data/deadends.txt'], 'run': deadends_stage},
+        'node_ids': {'deps': ['deadends'], 'inputs': [graph_edges],
+                     'outputs': node_index_files + edge_array_files, 'run': node_ids_stage},
+        'graph': {'deps': ['node_ids'], 'inputs': node_index_files[:1] + edge_array_files,
+                  'outputs': ['./data/graph.pkl'], 'run': graph_stage},
+        'partition': {'deps': ['graph'], 'inputs': ['./data/graph.pkl', *node_index_files],
+                      'params': {'resolution': args.resolution, 'resolutions': sorted(args.resolutions), 'seed': args.seed,
+                                 'warm_start': args.warm_start_partition},
+                      'outputs': ['./data/partition_list.pkl', './data/partition_dict.pkl', './data/partition_sweep.json'],
+                      'run': partition_stage},
+        'store': {'deps': ['partition'], 'inputs': [*node_index_files, *edge_array_files, './data/partition_dict.pkl'],
+                  'outputs': store_files, 'run': store_stage},
+        'layout': {'deps': ['graph'] + (['partition'] if layout_uses_partition else []),
+                   'inputs': ['./data/graph.pkl', *node_index_files] + (['./data/partition_dict.pkl'] if layout_uses_partition else []),
+                   'params': {'algorithm': args.layout, 'seed': args.seed, 'warm_start': args.warm_start_layout},
+                   'outputs': ['./data/layout.pkl'], 'run': layout_stage},
+        'style': {'deps': ['partition'], 'inputs': ['./data/graph.pkl', './data/partition_list.pkl', './data/partition_dict.pkl']
+                                                   + (metadata_files + node_index_files if 'year' in (args.size_by, args.color_by) else []),
+                  'params': {'top_partitions': args.top_partitions, 'inter_community_fraction': args.inter_community_fraction,
+                             'seed': args.seed, 'size_by': args.size_by, 'color_by': args.color_by},
+                  'outputs': ['./data/colors.txt', './data/color_key.json', './data/graph_styled.pkl'], 'run': style_stage},
+        'render': {'deps': ['style', 'layout'], 'inputs': ['./data/graph_styled.pkl', './data/layout.pkl'],
+                   'params': {'tile_size': args.tile_size, 'edge_mode': args.edge_mode, 'density_scale': args.density_scale},
+                   'outputs': ['./data/graph.png', './data/pyramid/pyramid.json'], 'run': render_stage},
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build, partition, lay out and render the citation graph.")
+    parser.add_argument('--stage', action='append', default=[],
+                        help="run only this stage and whatever it depends on (repeatable); default is all stages")
+    parser.add_argument('--force', action='append', default=[],
+                        help="rerun this stage even if its cache key is unchanged (repeatable)")
+    parser.add_argument('--redo-everything', action='store_true', help="rerun every selected stage")
+    parser.add_argument('--list', action='store_true', help="list the stages and exit")
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE, help="edge length in pixels of the rendered and pyramid tiles")
+    parser.add_argument('--edge-mode', choices=EDGE_MODES, default='strokes',
+                        help="'density' shades per pixel edge counts instead of stroking every edge, for graphs with millions of edges")
+    parser.add_argument('--density-scale', choices=DENSITY_SCALES, default='log',
+                        help="how edge counts map to opacity in density mode: log scale or histogram equalization")
+    parser.add_argument('--deadends', choices=('both', 'uncited', 'nonciting', 'none'), default='both',
+                        help="which nodes are stripped repeatedly: never cited, citing nothing in the corpus, or both")
+    parser.add_argument('--layout', default='drl',
+                        help="'multilevel' lays out the community quotient graph and then each community in parallel; any other value is passed to igraph's Graph.layout")
+    parser.add_argument('--warm-start-layout', action='store_true',
+                        help="keep the positions of nodes from the existing layout.pkl and only place new nodes")
+    parser.add_argument('--resolution', type=float, default=1.0, help="Leiden resolution parameter")
+    parser.add_argument('--resolutions', type=float, nargs='*', default=[],
+                        help="additional Leiden resolutions to sweep in parallel; statistics go to partition_sweep.json")
+    parser.add_argument('--warm-start-partition', action='store_true',
+                        help="start Leiden from the communities in the existing partition_dict.pkl")
+    parser.add_argument('--top-partitions', type=int, default=10, help="number of largest communities kept in the image")
+    parser.add_argument('--inter-community-fraction', type=float, default=0.0,
+                        help="fraction of edges between the kept communities to draw as well")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for layout, partitioning and sampling")
+    parser.add_argument('--size-by', choices=sorted(SIZE_MAPPINGS), default='indegree', help="what node size represents")
+    parser.add_argument('--color-by', choices=sorted(COLOR_MAPPINGS), default='partition', help="what node and edge colour represent")
+    return parser.parse_args(argv)
 
+def main():
+    args = parse_args()
+    stages = build_stages(args)
+    if args.list:
+        for name, stage in stages.items():
+            print(f"{name}: depends on {', '.join(stage['deps']) or 'nothing'} -> {', '.join(stage['outputs'])}")
+        return
 
-    print("Generating graph image, this might take a few minutes to hours...")
-    plot_graph(graph, layout)
+    force = set(stages) if args.redo_everything else set(args.force)
+    run_stages(stages, args.stage or None, force)
 
 if __name__ == "__main__":
     main()
-
-
-
-
@@ -0,0 +1,171 @@
+# On-disk citation graph store: CSR (citing -> cited) and CSC (cited -> citing) offset and
+# neighbour arrays, the DOI string table and the community membership, all saved as .npy files and
+# memory-mapped on open, so a query only reads the pages it touches.
+
+import json
+import os
+import shutil
+import numpy as np
+from node_index import NodeIndex
+
+STORE_DIR = './data/graph_store'
+DIRECTIONS = ('out', 'in', 'both')
+
+def gather_incident_edges(order: np.ndarray, offsets: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+    # CSR gather: the edge ids stored in order[offsets[v]:offsets[v + 1]] for every v in nodes
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=order.dtype)
+    shifts = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return order[shifts + np.arange(total)]
+
+def counting_sort_order(keys: np.ndarray) -> np.ndarray:
+    # Stable order of non-negative int32 keys in linear time: two radix passes over 16-bit digits,
+    # which numpy's stable argsort sorts by counting
+    keys = keys.astype(np.uint32, copy=False)
+    order = np.argsort((keys & 0xFFFF).astype(np.uint16), kind='stable')
+    return order[np.argsort((keys[order] >> 16).astype(np.uint16), kind='stable')]
+
+def unique_unsorted(values: np.ndarray, stamp: np.ndarray) -> np.ndarray:
+    # Distinct values in linear time, using a scratch array indexed by value instead of a sort
+    positions = np.arange(len(values))
+    stamp[values] = positions
+    return values[stamp[values] == positions]
+
+def build_adjacency(rows: np.ndarray, columns: np.ndarray, num_nodes: int) -> tuple[np.ndarray, np.ndarray]:
+    # Neighbour lists are sorted, so membership of a single edge is a binary search
+    order = np.lexsort((columns, rows))
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=offsets[1:])
+    return offsets, columns[order].astype(np.int32)
+
+def build_graph_store(sources: np.ndarray, targets: np.ndarray, membership: np.ndarray, node_index_dir: str = './data/node_index',
+                      directory: str = STORE_DIR) -> None:
+    os.makedirs(directory, exist_ok=True)
+    num_nodes = len(membership)
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    out_offsets, out_neighbors = build_adjacency(sources, targets, num_nodes)
+    in_offsets, in_neighbors = build_adjacency(targets, sources, num_nodes)
+
+    # Members of every community, most cited first, so a top-k query is a slice
+    indegree = np.diff(in_offsets)
+    grouped = membership >= 0
+    num_communities = int(membership.max()) + 1 if grouped.any() else 0
+    community_nodes = np.lexsort((-indegree, membership))[np.count_nonzero(~grouped):]
+    community_offsets = np.zeros(num_communities + 1, dtype=np.int64)
+    np.cumsum(np.bincount(membership[grouped], minlength=num_communities), out=community_offsets[1:])
+
+    arrays = {
+        'out_offsets': out_offsets,
+        'out_neighbors': out_neighbors,
+        'in_offsets': in_offsets,
+        'in_neighbors': in_neighbors,
+        'membership': membership.astype(np.int32),
+        'community_offsets': community_offsets,
+        'community_nodes': community_nodes.astype(np.int32),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+    # The DOI string table and hash index are copied so the store is self-contained
+    for name in ('offsets.npy', 'strings.npy', 'index.npy'):
+        shutil.copyfile(os.path.join(node_index_dir, name), os.path.join(directory, name))
+    with open(os.path.join(directory, 'store.json'), 'w', encoding='utf-8') as file:
+        json.dump({'nodes': num_nodes, 'edges': len(sources), 'communities': num_communities}, file)
+    print(f"Graph store with {num_nodes} nodes, {len(sources)} edges and {num_communities} communities saved to {directory}")
+
+class GraphStore:
+    def __init__(self, directory: str = STORE_DIR, mmap_mode: str | None = 'r'):
+        with open(os.path.join(directory, 'store.json'), 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        self.num_nodes = meta['nodes']
+        self.num_edges = meta['edges']
+        self.num_communities = meta['communities']
+        self.nodes = NodeIndex(directory, mmap_mode)
+        self.out_offsets = np.load(os.path.join(directory, 'out_offsets.npy'), mmap_mode=mmap_mode)
+        self.out_neighbors = np.load(os.path.join(directory, 'out_neighbors.npy'), mmap_mode=mmap_mode)
+        self.in_offsets = np.load(os.path.join(directory, 'in_offsets.npy'), mmap_mode=mmap_mode)
+        self.in_neighbors = np.load(os.path.join(directory, 'in_neighbors.npy'), mmap_mode=mmap_mode)
+        self.membership = np.load(os.path.join(directory, 'membership.npy'), mmap_mode=mmap_mode)
+        self.community_offsets = np.load(os.path.join(directory, 'community_offsets.npy'), mmap_mode=mmap_mode)
+        self.community_nodes = np.load(os.path.join(directory, 'community_nodes.npy'), mmap_mode=mmap_mode)
+
+    def node_id(self, node: int | str) -> int:
+        return self.nodes[node] if isinstance(node, str) else int(node)
+
+    def dois(self, node_ids) -> list[str]:
+        return self.nodes.dois(np.asarray(node_ids).tolist())
+
+    def out_neighbors_of(self, node: int | str) -> np.ndarray:
+        # Papers cited by the node
+        node_id = self.node_id(node)
+        return np.asarray(self.out_neighbors[self.out_offsets[node_id]:self.out_offsets[node_id + 1]])
+
+    def in_neighbors_of(self, node: int | str) -> np.ndarray:
+        # Papers citing the node
+        node_id = self.node_id(node)
+        return np.asarray(self.in_neighbors[self.in_offsets[node_id]:self.in_offsets[node_id + 1]])
+
+    def indegree(self, node: int | str) -> int:
+        node_id = self.node_id(node)
+        return int(self.in_offsets[node_id + 1] - self.in_offsets[node_id])
+
+    def outdegree(self, node: int | str) -> int:
+        node_id = self.node_id(node)
+        return int(self.out_offsets[node_id + 1] - self.out_offsets[node_id])
+
+    def has_edge(self, source: int | str, target: int | str) -> bool:
+        neighbors = self.out_neighbors_of(source)
+        target_id = self.node_id(target)
+        position = np.searchsorted(neighbors, target_id)
+        return bool(position < len(neighbors) and neighbors[position] == target_id)
+
+    def neighbors(self, nodes: np.ndarray, direction: str = 'out') -> np.ndarray:
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Unknown direction: {direction}. Expected one of {DIRECTIONS}.")
+        nodes = np.asarray(nodes, dtype=np.int64)
+        found = []
+        if direction in ('out', 'both'):
+            found.append(gather_incident_edges(self.out_neighbors, self.out_offsets, nodes))
+        if direction in ('in', 'both'):
+            found.append(gather_incident_edges(self.in_neighbors, self.in_offsets, nodes))
+        return np.unique(np.concatenate(found))
+
+    def k_hop(self, seeds, k: int, direction: str = 'out') -> np.ndarray:
+        # Every node within k citation steps of the seeds, the seeds included
+        if isinstance(seeds, (int, str, np.integer)):
+            seeds = [seeds]
+        reached = np.unique(np.array([self.node_id(seed) for seed in seeds], dtype=np.int64))
+        frontier = reached
+        for _ in range(k):
+            if len(frontier) == 0:
+                break
+            frontier = np.setdiff1d(self.neighbors(frontier, direction), reached, assume_unique=True)
+            reached = np.union1d(reached, frontier)
+        return reached
+
+    def community(self, community: int) -> np.ndarray:
+        # Members, most cited first
+        return np.asarray(self.community_nodes[self.community_offsets[community]:self.community_offsets[community + 1]])
+
+    def community_of(self, node: int | str) -> int:
+        return int(self.membership[self.node_id(node)])
+
+    def top_cited(self, community: int, k: int = 10) -> list[tuple[str, int]]:
+        members = self.community(community)[:k]
+        indegrees = np.asarray(self.in_offsets[members + 1] - self.in_offsets[members])
+        return list(zip(self.dois(members), indegrees.tolist()))
+
+    def subgraph(self, nodes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Returns the sorted node ids and the edges among them, renumbered to positions in that array
+        if not isinstance(nodes, np.ndarray):
+            nodes = [self.node_id(node) for node in nodes]
+        nodes = np.unique(np.asarray(nodes, dtype=np.int64))
+        counts = np.asarray(self.out_offsets[nodes + 1] - self.out_offsets[nodes])
+        sources = np.repeat(np.arange(len(nodes)), counts)
+        targets = gather_incident_edges(self.out_neighbors, self.out_offsets, nodes).astype(np.int64)
+        positions = np.minimum(np.searchsorted(nodes, targets), max(len(nodes) - 1, 0))
+        inside = nodes[positions] == targets if len(nodes) else np.zeros(0, dtype=bool)
+        return nodes, sources[inside], positions[inside]
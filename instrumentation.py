@@ -0,0 +1,196 @@
+# Run instrumentation shared by the scripts. stage() measures a block's wall time, CPU time (its own
+# plus that of worker processes which exit during it) and peak RSS, prints them and appends them to a
+# JSON-lines run log; earlier records of the same stage give the ETA of long stages. measure_task()
+# does the same inside pool workers, and Progress prints live progress with an ETA for pools.
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+RUN_LOG = './data/run_log.jsonl'
+RUN_ID = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+PROGRESS_INTERVAL = 10.0
+HEARTBEAT_INTERVAL = 60.0
+SLOWEST_TASKS = 5
+
+# Stages currently open in this process, innermost last
+_open_stages = []
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+def high_water_mb() -> float:
+    # VmHWM can be reset (see reset_high_water), so it gives the peak of a single stage
+    try:
+        with open('/proc/self/status', 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+def reset_high_water() -> None:
+    # Linux only; elsewhere the peak of a stage is the process peak so far
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf-8') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+def read_run_log(log_path: str = RUN_LOG) -> list[dict]:
+    if not log_path or not os.path.exists(log_path):
+        return []
+    with open(log_path, 'r', encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def append_run_log(record: dict, log_path: str = RUN_LOG) -> None:
+    os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+    with open(log_path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record) + '\n')
+
+def estimate_seconds(name: str, units: float | None, log_path: str = RUN_LOG) -> float | None:
+    # Duration of the last successful run of the stage by the same script, scaled linearly by its units of work
+    script = os.path.basename(sys.argv[0])
+    for record in reversed(read_run_log(log_path)):
+        if record.get('stage') != name or record.get('script') != script or record.get('status') != 'ok':
+            continue
+        if units and record.get('units'):
+            return record['wall_seconds'] * units / record['units']
+        return record['wall_seconds']
+    return None
+
+def heartbeat(name: str, start: float, estimate: float | None, interval: float, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        elapsed = time.perf_counter() - start
+        remaining = f", about {format_duration(max(estimate - elapsed, 0))} left" if estimate else ""
+        print(f"[{name}] {format_duration(elapsed)} elapsed{remaining}")
+
+@contextmanager
+def stage(name: str, log_path: str | None = RUN_LOG, units: float | None = None, heartbeat_interval: float | None = None, **fields):
+    # Yields the record; the block may add counts such as 'items' or 'edges', and per second rates
+    # are added for them on exit
+    record = {'run': RUN_ID, 'script': os.path.basename(sys.argv[0]), 'stage': name,
+              'time': datetime.now().isoformat(timespec='seconds'), **fields}
+    if units is not None:
+        record['units'] = units
+    estimate = estimate_seconds(name, units, log_path) if log_path else None
+    if estimate and estimate >= PROGRESS_INTERVAL:
+        print(f"[{name}] expected to take about {format_duration(estimate)}, judging by the last run")
+
+    # An enclosing stage keeps the peak reached so far before the counter is reset for this one
+    outer_peak = high_water_mb()
+    for open_stage in _open_stages:
+        open_stage['peak'] = max(open_stage['peak'], outer_peak)
+    reset_high_water()
+    state = {'peak': 0.0}
+    _open_stages.append(state)
+    children_peak = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    children_cpu = children_cpu_seconds()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    stop = threading.Event()
+    if heartbeat_interval:
+        threading.Thread(target=heartbeat, args=(name, start, estimate, heartbeat_interval, stop), daemon=True).start()
+
+    record['status'] = 'failed'
+    try:
+        yield record
+        record['status'] = 'ok'
+    finally:
+        stop.set()
+        wall = time.perf_counter() - start
+        _open_stages.pop()
+        peak = max(state['peak'], high_water_mb())
+        for open_stage in _open_stages:
+            open_stage['peak'] = max(open_stage['peak'], peak)
+        record.update({
+            'wall_seconds': wall,
+            'cpu_seconds': time.process_time() - cpu_start,
+            'children_cpu_seconds': children_cpu_seconds() - children_cpu,
+            'peak_rss_mb': peak,
+        })
+        # Worker processes that exited during the stage and outgrew every earlier child
+        if peak_rss_mb(resource.RUSAGE_CHILDREN) > children_peak:
+            record['children_peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        for count in ('items', 'edges'):
+            if record.get(count) is not None and wall > 0:
+                record[f'{count}_per_s'] = record[count] / wall
+        print(f"[{name}] {record['status']} in {format_duration(wall)}: {record['cpu_seconds'] + record['children_cpu_seconds']:.1f} s CPU, "
+              f"peak RSS {peak:,.0f} MB")
+        if log_path:
+            append_run_log(record, log_path)
+
+@contextmanager
+def measure_task(**fields):
+    # For pool workers: the parent gets the record back with the task's result and summarizes it
+    record = dict(fields)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    yield record
+    record['seconds'] = time.perf_counter() - start
+    record['cpu_seconds'] = time.process_time() - cpu_start
+    record['worker_peak_rss_mb'] = peak_rss_mb()
+    if record.get('items') is not None and record['seconds'] > 0:
+        record['items_per_s'] = record['items'] / record['seconds']
+
+def summarize_tasks(tasks: list[dict], label: str = 'file') -> dict:
+    # Totals, throughput spread and the slowest tasks, rather than one record per shard in the log
+    if not tasks:
+        return {'count': 0}
+    rates = sorted(task['items_per_s'] for task in tasks if 'items_per_s' in task)
+    summary = {
+        'count': len(tasks),
+        'items': sum(task.get('items', 0) for task in tasks),
+        'task_seconds': sum(task['seconds'] for task in tasks),
+        'worker_peak_rss_mb': max(task['worker_peak_rss_mb'] for task in tasks),
+        'slowest': [{label: task.get(label), 'seconds': task['seconds']}
+                    for task in sorted(tasks, key=lambda task: task['seconds'], reverse=True)[:SLOWEST_TASKS]],
+    }
+    if rates:
+        summary['items_per_s'] = {'min': rates[0], 'median': rates[len(rates) // 2], 'max': rates[-1]}
+    return summary
+
+class Progress:
+    # Prints how many tasks are done, the rate and an ETA, at most once per interval
+    def __init__(self, total: int, label: str, unit: str = 'items', interval: float = PROGRESS_INTERVAL):
+        self.total = total
+        self.label = label
+        self.unit = unit
+        self.interval = interval
+        self.done = 0
+        self.items = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, done: int = 1, items: int = 0) -> None:
+        self.done += done
+        self.items += items
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or self.done == self.total:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now: float) -> None:
+        elapsed = now - self.start
+        rate = f", {self.items / elapsed:,.0f} {self.unit}/s" if self.items and elapsed > 0 else ""
+        eta = ""
+        if 0 < self.done < self.total:
+            eta = f", ETA {format_duration(elapsed / self.done * (self.total - self.done))}"
+        print(f"{self.label}: {self.done}/{self.total} ({self.done / max(self.total, 1):.0%}) in {format_duration(elapsed)}{rate}{eta}")
@@ -0,0 +1,85 @@
+from functools import lru_cache
+
+MATCH_MODES = ("exact", "fuzzy")
+TITLE_CACHE_SIZE = 1 << 16
+
+def normalize_title(title: str) -> str:
+    return " ".join(title.casefold().split())
+
+def build_automaton(patterns: list[str]) -> tuple[list[dict[str, int]], list[bool]]:
+    # Aho-Corasick: a trie over all patterns plus failure links, flattened into a full
+    # transition table so matching is a single dict lookup per character
+    goto = [{}]
+    terminal = [False]
+    for pattern in patterns:
+        state = 0
+        for char in pattern:
+            next_state = goto[state].get(char)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][char] = next_state
+                goto.append({})
+                terminal.append(False)
+            state = next_state
+        terminal[state] = True
+
+    fail = [0] * len(goto)
+    transitions = [dict(edges) for edges in goto]
+    queue = list(goto[0].values())
+    head = 0
+    while head < len(queue):
+        state = queue[head]
+        head += 1
+        terminal[state] = terminal[state] or terminal[fail[state]]
+        for char, next_state in goto[state].items():
+            fallback = fail[state]
+            while fallback and char not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(char, 0) if state else 0
+            queue.append(next_state)
+        # inherit the failure state's transitions for characters this state does not define
+        if state:
+            for char, target in transitions[fail[state]].items():
+                transitions[state].setdefault(char, target)
+    return transitions, terminal
+
+class JournalMatcher:
+    def __init__(self, keywords: list[str], mode: str = "exact"):
+        if mode not in MATCH_MODES:
+            raise ValueError(f"Unknown match mode: {mode}. Expected one of {MATCH_MODES}.")
+        self.mode = mode
+        self.keywords = sorted({normalize_title(keyword) for keyword in keywords if keyword.strip()})
+        self.exact_titles = frozenset(self.keywords)
+        self.transitions, self.terminal = build_automaton(self.keywords)
+        self._cache = {}
+
+    def contains_keyword(self, normalized_title: str) -> bool:
+        transitions = self.transitions
+        terminal = self.terminal
+        state = 0
+        for char in normalized_title:
+            state = transitions[state].get(char, 0)
+            if terminal[state]:
+                return True
+        return False
+
+    def match_title(self, title: str) -> bool:
+        # Journal titles repeat across millions of articles, so results are memoized per raw title
+        result = self._cache.get(title)
+        if result is None:
+            normalized = normalize_title(title)
+            if self.mode == "exact":
+                result = normalized in self.exact_titles
+            else:
+                result = self.contains_keyword(normalized)
+            if len(self._cache) >= TITLE_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[title] = result
+        return result
+
+    def matches(self, titles) -> bool:
+        return any(self.match_title(title) for title in titles)
+
+@lru_cache(maxsize=8)
+def compile_matcher(keywords: tuple[str, ...], mode: str = "exact") -> JournalMatcher:
+    return JournalMatcher(list(keywords), mode)
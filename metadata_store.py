@@ -0,0 +1,160 @@
+# Columnar article metadata: int16 years, titles in one UTF-8 string table, subjects interned once
+# and listed per row as ids, and a DOI hash index (the node_index format) mapping DOIs to rows. Every
+# column is a .npy file, so a store opens memory-mapped and only the columns read are paged in.
+#
+# Rows come from full records (matched articles) and placeholders (DOIs only seen as references,
+# with the year given by the citing article). Full records beat placeholders; otherwise the first
+# record seen for a DOI wins.
+
+import json
+import os
+from array import array
+import numpy as np
+from node_index import NodeIndex, build_string_table, join_indices, save_node_index
+
+METADATA_DIR = './data/metadata'
+NO_YEAR = 0
+
+def compact_heap(heap: np.ndarray, ends: np.ndarray, full_rows: np.ndarray, num_rows: int) -> tuple[np.ndarray, np.ndarray]:
+    # Reorders the heap from arrival order to row order; rows without data get empty slices
+    starts = np.zeros_like(ends)
+    starts[1:] = ends[:-1]
+    lengths = np.zeros(num_rows, dtype=np.int64)
+    lengths[full_rows] = ends - starts
+    row_starts = np.zeros(num_rows, dtype=np.int64)
+    row_starts[full_rows] = starts
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    shifts = np.repeat(row_starts - offsets[:-1], lengths)
+    return offsets, heap[shifts + np.arange(offsets[-1])]
+
+class MetadataBuilder:
+    def __init__(self):
+        self.rows = {}
+        self.years = array('h')
+        self.full = bytearray()
+        # Titles and subjects are appended to heaps as full records arrive. A DOI gets at most one
+        # full record, so nothing is ever overwritten; save() only puts the heaps in row order.
+        self.full_rows = array('q')
+        self.title_heap = bytearray()
+        self.title_ends = array('q')
+        self.subject_ids = {}
+        self.subject_heap = array('i')
+        self.subject_ends = array('q')
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, doi: str, title: str, subjects: list[str], year: int | None) -> None:
+        row = self.rows.get(doi)
+        if row is None:
+            row = self.rows[doi] = len(self.years)
+            self.years.append(year or NO_YEAR)
+            self.full.append(True)
+        elif self.full[row]:
+            return
+        else:
+            self.years[row] = year or NO_YEAR
+            self.full[row] = True
+        self.full_rows.append(row)
+        self.title_heap += title.encode('utf-8')
+        self.title_ends.append(len(self.title_heap))
+        self.subject_heap.extend([self.subject_ids.setdefault(subject, len(self.subject_ids)) for subject in subjects])
+        self.subject_ends.append(len(self.subject_heap))
+
+    def add_placeholder(self, doi: str, year: int | None) -> None:
+        if doi not in self.rows:
+            self.rows[doi] = len(self.years)
+            self.years.append(year or NO_YEAR)
+            self.full.append(False)
+
+    def save(self, directory: str = METADATA_DIR) -> None:
+        os.makedirs(directory, exist_ok=True)
+        save_node_index(list(self.rows), directory)
+        full_rows = np.frombuffer(self.full_rows, dtype=np.int64)
+        title_offsets, titles = compact_heap(np.frombuffer(bytes(self.title_heap), dtype=np.uint8),
+                                             np.frombuffer(self.title_ends, dtype=np.int64), full_rows, len(self.rows))
+        subject_offsets, subjects = compact_heap(np.frombuffer(self.subject_heap, dtype=np.int32),
+                                                 np.frombuffer(self.subject_ends, dtype=np.int64), full_rows, len(self.rows))
+        name_offsets, names = build_string_table(list(self.subject_ids))
+        arrays = {
+            'years': np.frombuffer(self.years, dtype=np.int16),
+            'full': np.frombuffer(bytes(self.full), dtype=np.bool_),
+            'title_offsets': title_offsets,
+            'titles': titles,
+            'subject_offsets': subject_offsets,
+            'subjects': subjects,
+            'subject_name_offsets': name_offsets,
+            'subject_names': names,
+        }
+        for name, values in arrays.items():
+            np.save(os.path.join(directory, f'{name}.npy'), values)
+        with open(os.path.join(directory, 'metadata.json'), 'w', encoding='utf-8') as file:
+            json.dump({'rows': len(self.rows), 'full': self.full.count(1), 'subjects': len(self.subject_ids)}, file)
+
+class MetadataStore:
+    def __init__(self, directory: str = METADATA_DIR, mmap_mode: str | None = 'r'):
+        self.directory = directory
+        self.dois = NodeIndex(directory, mmap_mode)
+        self.mmap_mode = mmap_mode
+        self._columns = {}
+        self._subjects = None
+
+    def column(self, name: str) -> np.ndarray:
+        # Columns are opened on first use
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.directory, f'{name}.npy'), mmap_mode=self.mmap_mode)
+        return self._columns[name]
+
+    def __len__(self) -> int:
+        return len(self.dois)
+
+    def __contains__(self, doi: str) -> bool:
+        return doi in self.dois
+
+    def row(self, doi: str) -> int | None:
+        return self.dois.get(doi)
+
+    def rows(self, dois) -> np.ndarray:
+        # Row of every DOI, -1 where the DOI has no metadata
+        return np.fromiter((self.dois.get(doi, -1) for doi in dois), dtype=np.int64)
+
+    def rows_for_index(self, node_ids: NodeIndex) -> np.ndarray:
+        # rows() for every node of a node index, joining the two string tables with numpy
+        return join_indices(node_ids, self.dois)
+
+    def subject_names(self) -> list[str]:
+        if self._subjects is None:
+            offsets, strings = self.column('subject_name_offsets'), bytes(self.column('subject_names'))
+            self._subjects = [strings[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+        return self._subjects
+
+    def year(self, row: int) -> int | None:
+        year = int(self.column('years')[row])
+        return None if year == NO_YEAR else year
+
+    def title(self, row: int) -> str:
+        offsets = self.column('title_offsets')
+        return bytes(self.column('titles')[offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def subject_ids(self, row: int) -> np.ndarray:
+        offsets = self.column('subject_offsets')
+        return np.asarray(self.column('subjects')[offsets[row]:offsets[row + 1]])
+
+    def subjects(self, row: int) -> list[str]:
+        names = self.subject_names()
+        return [names[i] for i in self.subject_ids(row).tolist()]
+
+    def is_placeholder(self, row: int) -> bool:
+        return not self.column('full')[row]
+
+    def get(self, doi: str, default=None):
+        # The (title, subjects, year) tuple metadata.pkl used to hold
+        row = self.row(doi)
+        if row is None:
+            return default
+        return self.title(row), self.subjects(row), self.year(row)
+
+    def years_for(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows)
+        return np.where(rows >= 0, self.column('years')[np.maximum(rows, 0)], NO_YEAR).astype(np.int16)
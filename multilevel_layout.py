@@ -0,0 +1,211 @@
+# Multilevel layout: the community quotient graph is laid out first, then every community is
+# laid out on its own (in parallel) and placed around its community's coordinates. Finished
+# communities are checkpointed, so an interrupted run only redoes the unfinished ones.
+
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import igraph as ig
+import numpy as np
+from instrumentation import Progress
+
+# Communities above this size use DrL, smaller ones Fruchterman-Reingold
+DRL_THRESHOLD = 1000
+# Small communities are batched together so each pool task carries a reasonable amount of work
+TARGET_CHUNK_NODES = 50000
+# Bounded Fruchterman-Reingold pass after a warm start: the starting temperature in median edge
+# lengths, and the share of its displacement a node of the previous layout keeps
+REFINE_TEMPERATURE = 0.5
+REFINE_DAMPING = 0.2
+
+def normalize_coords(coords: np.ndarray, radius: float) -> np.ndarray:
+    coords = coords - coords.mean(axis=0)
+    extent = np.sqrt((coords ** 2).sum(axis=1)).max()
+    return coords * (radius / extent) if extent > 0 else coords
+
+def community_radius(size: int | np.ndarray):
+    return np.sqrt(size)
+
+def layout_quotient(sources: np.ndarray, targets: np.ndarray, membership: np.ndarray, num_communities: int, seed: int = 0) -> np.ndarray:
+    between = membership[sources] != membership[targets]
+    pairs = np.unique(np.stack((membership[sources][between], membership[targets][between]), axis=1), axis=0)
+    quotient = ig.Graph(num_communities, edges=pairs.tolist(), directed=False)
+    random.seed(seed)
+    algorithm = 'drl' if num_communities > DRL_THRESHOLD else 'fr'
+    coords = np.array(quotient.layout(algorithm).coords, dtype=np.float64).reshape(-1, 2)
+
+    # Spread the quotient layout so its area roughly matches the total area of the communities
+    total_nodes = len(membership)
+    return normalize_coords(coords, 2 * community_radius(total_nodes))
+
+def layout_communities(task) -> tuple[int, list[tuple[int, np.ndarray]]]:
+    chunk_id, communities, seed = task
+    placed = []
+    for community, size, local_sources, local_targets in communities:
+        if size == 1:
+            placed.append((community, np.zeros((1, 2))))
+            continue
+        random.seed(seed + community)
+        graph = ig.Graph(size, edges=list(zip(local_sources.tolist(), local_targets.tolist())), directed=False)
+        coords = np.array(graph.layout('drl' if size > DRL_THRESHOLD else 'fr').coords, dtype=np.float64)
+        placed.append((community, normalize_coords(coords, community_radius(size))))
+    return chunk_id, placed
+
+def build_tasks(sources: np.ndarray, targets: np.ndarray, membership: np.ndarray, num_communities: int, seed: int) -> tuple[list, np.ndarray, np.ndarray]:
+    # Members of each community are contiguous in `order`; local ids are positions within that run
+    order = np.argsort(membership, kind='stable')
+    sizes = np.bincount(membership, minlength=num_communities)
+    starts = np.concatenate(([0], np.cumsum(sizes)))
+    local_ids = np.empty(len(membership), dtype=np.int64)
+    local_ids[order] = np.arange(len(membership)) - np.repeat(starts[:-1], sizes)
+
+    intra = membership[sources] == membership[targets]
+    intra_sources, intra_targets = sources[intra], targets[intra]
+    edge_order = np.argsort(membership[intra_sources], kind='stable')
+    intra_sources, intra_targets = intra_sources[edge_order], intra_targets[edge_order]
+    edge_starts = np.concatenate(([0], np.cumsum(np.bincount(membership[intra_sources], minlength=num_communities))))
+
+    tasks = []
+    chunk = []
+    chunk_nodes = 0
+    for community in np.argsort(-sizes, kind='stable').tolist():
+        edge_slice = slice(edge_starts[community], edge_starts[community + 1])
+        chunk.append((community, int(sizes[community]), local_ids[intra_sources[edge_slice]], local_ids[intra_targets[edge_slice]]))
+        chunk_nodes += sizes[community]
+        if chunk_nodes >= TARGET_CHUNK_NODES:
+            tasks.append((len(tasks), chunk, seed))
+            chunk, chunk_nodes = [], 0
+    if chunk:
+        tasks.append((len(tasks), chunk, seed))
+    return tasks, order, starts
+
+def checkpoint_signature(sources: np.ndarray, targets: np.ndarray, membership: np.ndarray, seed: int) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (sources, targets, membership):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(str(seed).encode())
+    return digest.hexdigest()
+
+def open_checkpoint(checkpoint_dir: str, signature: str) -> None:
+    meta_path = os.path.join(checkpoint_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            if json.load(file).get('signature') == signature:
+                return
+        print("Layout checkpoint belongs to a different graph or partition, discarding it.")
+        shutil.rmtree(checkpoint_dir)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(meta_path, 'w', encoding='utf-8') as file:
+        json.dump({'signature': signature}, file)
+
+def save_chunk(checkpoint_dir: str, chunk_id: int, placed: list[tuple[int, np.ndarray]]) -> None:
+    path = os.path.join(checkpoint_dir, f'chunk_{chunk_id:06d}.npz')
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, communities=np.array([c for c, _ in placed], dtype=np.int64),
+                 sizes=np.array([len(coords) for _, coords in placed], dtype=np.int64),
+                 coords=np.concatenate([coords for _, coords in placed]))
+    os.replace(path + '.tmp', path)
+
+def load_chunk(checkpoint_dir: str, chunk_id: int) -> list[tuple[int, np.ndarray]] | None:
+    path = os.path.join(checkpoint_dir, f'chunk_{chunk_id:06d}.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as chunk:
+        offsets = np.concatenate(([0], np.cumsum(chunk['sizes'])))
+        return [(int(c), chunk['coords'][offsets[i]:offsets[i + 1]]) for i, c in enumerate(chunk['communities'])]
+
+def multilevel_layout(sources: np.ndarray, targets: np.ndarray, membership: np.ndarray, checkpoint_dir: str = './data/layout_checkpoint',
+                      seed: int = 0, workers: int | None = None) -> np.ndarray:
+    num_communities = int(membership.max()) + 1
+    open_checkpoint(checkpoint_dir, checkpoint_signature(sources, targets, membership, seed))
+
+    quotient_path = os.path.join(checkpoint_dir, 'quotient.npy')
+    if os.path.exists(quotient_path):
+        centers = np.load(quotient_path)
+    else:
+        print(f"Laying out the quotient graph of {num_communities} communities...")
+        centers = layout_quotient(sources, targets, membership, num_communities, seed)
+        np.save(quotient_path, centers)
+
+    tasks, order, starts = build_tasks(sources, targets, membership, num_communities, seed)
+    coords = np.zeros((len(membership), 2))
+
+    def place(placed):
+        for community, local in placed:
+            coords[order[starts[community]:starts[community + 1]]] = local + centers[community]
+
+    pending = []
+    for task in tasks:
+        placed = load_chunk(checkpoint_dir, task[0])
+        if placed is None:
+            pending.append(task)
+        else:
+            place(placed)
+    print(f"Laying out communities: {len(tasks) - len(pending)} of {len(tasks)} chunks restored from checkpoint.")
+
+    progress = Progress(len(pending), "Laying out community chunks", unit="nodes")
+    with ProcessPoolExecutor(max_workers=workers or multiprocessing.cpu_count()) as executor:
+        futures = [executor.submit(layout_communities, task) for task in pending]
+        for future in as_completed(futures):
+            chunk_id, placed = future.result()
+            save_chunk(checkpoint_dir, chunk_id, placed)
+            place(placed)
+            progress.update(items=sum(len(local) for _, local in placed))
+    return coords
+
+def warm_start_layout(sources: np.ndarray, targets: np.ndarray, num_nodes: int, known: np.ndarray, known_coords: np.ndarray,
+                      membership: np.ndarray | None = None, seed: int = 0) -> np.ndarray:
+    # Nodes from the previous layout keep their coordinates; new nodes are placed at the mean of
+    # their already placed neighbours, repeating until no more nodes can be reached
+    rng = np.random.default_rng(seed)
+    coords = np.zeros((num_nodes, 2))
+    placed = np.zeros(num_nodes, dtype=bool)
+    coords[known] = known_coords
+    placed[known] = True
+    jitter = 0.01 * (known_coords.max(axis=0) - known_coords.min(axis=0)).max() if len(known_coords) else 1.0
+
+    ends = np.concatenate((sources, targets))
+    others = np.concatenate((targets, sources))
+    while True:
+        frontier = ~placed[ends] & placed[others]
+        if not frontier.any():
+            break
+        counts = np.bincount(ends[frontier], minlength=num_nodes)
+        new = counts > 0
+        for axis in range(2):
+            coords[new, axis] = np.bincount(ends[frontier], weights=coords[others[frontier], axis], minlength=num_nodes)[new] / counts[new]
+        coords[new] += rng.normal(scale=jitter, size=(int(new.sum()), 2))
+        placed |= new
+
+    unplaced = np.flatnonzero(~placed)
+    if len(unplaced):
+        if membership is not None and placed.any():
+            # Fall back to the centroid of the node's community, or the overall centroid
+            sums = np.stack([np.bincount(membership[placed], weights=coords[placed, axis], minlength=membership.max() + 1) for axis in range(2)], axis=1)
+            counts = np.bincount(membership[placed], minlength=membership.max() + 1)
+            centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], coords[placed].mean(axis=0))
+            coords[unplaced] = centroids[membership[unplaced]]
+        elif placed.any():
+            coords[unplaced] = coords[placed].mean(axis=0)
+        coords[unplaced] += rng.normal(scale=jitter, size=(len(unplaced), 2))
+    print(f"Warm start: kept {len(known)} positions, placed {num_nodes - len(known)} new nodes.")
+    return coords
+
+def refine_layout(sources: np.ndarray, targets: np.ndarray, coords: np.ndarray, num_known: int, iterations: int,
+                  seed: int = 0) -> np.ndarray:
+    # A short force-directed pass seeded from the warm-started coordinates, so new nodes settle under
+    # the layout's forces rather than staying at the mean of their neighbours. Fruchterman-Reingold's
+    # natural edge length is about one, so the layout is scaled by its median edge length and back; the
+    # temperature bounds how far any node moves, and nodes of the previous layout are damped
+    lengths = np.sqrt(((coords[sources] - coords[targets]) ** 2).sum(axis=1))
+    scale = float(np.median(lengths[lengths > 0])) if (lengths > 0).any() else 1.0
+    graph = ig.Graph(len(coords), edges=list(zip(sources.tolist(), targets.tolist())))
+    random.seed(seed)
+    refined = np.array(graph.layout_fruchterman_reingold(seed=(coords / scale).tolist(), niter=iterations,
+                                                         start_temp=REFINE_TEMPERATURE).coords, dtype=np.float64) * scale
+    refined[:num_known] = coords[:num_known] + REFINE_DAMPING * (refined[:num_known] - coords[:num_known])
+    return refined
@@ -0,0 +1,173 @@
+# Compact DOI <-> node id mapping. DOIs are stored once in a contiguous UTF-8 string table
+# (id -> DOI) next to an open-addressing hash table (DOI -> id); all arrays are .npy files that
+# can be memory-mapped, so opening the index does not load it into memory.
+
+import csv
+import os
+import re
+import zlib
+from array import array
+import numpy as np
+
+EMPTY_SLOT = -1
+JOIN_CHUNK = 1 << 20
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+DOI_PREFIX = re.compile(r'^(?:https?://)?(?:dx\.)?doi\.org/|^doi:\s*')
+
+def normalize_doi(doi: str) -> str:
+    # DOIs are case-insensitive, and Crossref spells some of them as resolver URLs or with a doi: prefix
+    doi = doi.strip().lower()
+    return doi if doi.startswith('10.') else DOI_PREFIX.sub('', doi)
+
+def factorize_edges(edges_filepath: str) -> tuple[np.ndarray, np.ndarray, list[str]]:
+    # One pass over the edge list: every DOI gets the next free id the first time it is seen
+    node_ids = {}
+    sources = array('i')
+    targets = array('i')
+    with open(edges_filepath, encoding="utf-8") as links_file:
+        for row in csv.reader(links_file):
+            if len(row) < 2:
+                continue
+            sources.append(node_ids.setdefault(row[0], len(node_ids)))
+            targets.append(node_ids.setdefault(row[1], len(node_ids)))
+    return np.frombuffer(sources, dtype=np.int32), np.frombuffer(targets, dtype=np.int32), list(node_ids)
+
+def build_string_table(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, data
+
+def hash_string(value: bytes) -> int:
+    return zlib.crc32(value)
+
+def build_hash_index(strings: list[str]) -> np.ndarray:
+    size = 1 << max(4, (2 * len(strings) - 1).bit_length())
+    mask = size - 1
+    table = np.full(size, EMPTY_SLOT, dtype=np.int32)
+    pending = np.arange(len(strings), dtype=np.int64)
+    slots = np.fromiter((hash_string(s.encode('utf-8')) for s in strings), dtype=np.int64, count=len(strings)) & mask
+
+    # Linear probing, resolved a round at a time: the first id claiming an empty slot keeps it,
+    # everyone else moves one slot on
+    while len(pending):
+        free = table[slots] == EMPTY_SLOT
+        candidates, first = np.unique(slots[free], return_index=True)
+        winners = pending[free][first]
+        table[candidates] = winners
+        placed = np.zeros(len(pending), dtype=bool)
+        placed[np.flatnonzero(free)[first]] = True
+        pending = pending[~placed]
+        slots = (slots[~placed] + 1) & mask
+    return table
+
+def string_ranges(offsets: np.ndarray, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Byte positions of the given strings in the string table, concatenated, and each string's length
+    starts = np.asarray(offsets[rows], dtype=np.int64)
+    lengths = np.asarray(offsets[rows + 1], dtype=np.int64) - starts
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return shifts + np.arange(int(lengths.sum())), lengths
+
+def string_hashes(offsets: np.ndarray, strings: np.ndarray, start: int = 0, stop: int | None = None) -> np.ndarray:
+    # Polynomial hash mod 2**64 of strings start..stop, computed for all of them at once: each byte is
+    # weighted by a power of the multiplier and the weights are summed per string with a cumulative sum
+    stop = len(offsets) - 1 if stop is None else stop
+    hashes = np.empty(stop - start, dtype=np.uint64)
+    for chunk in range(start, stop, JOIN_CHUNK):
+        bounds = np.asarray(offsets[chunk:min(chunk + JOIN_CHUNK, stop) + 1], dtype=np.int64)
+        lengths = np.diff(bounds)
+        within = np.arange(bounds[-1] - bounds[0]) - np.repeat(bounds[:-1] - bounds[0], lengths)
+        powers = np.cumprod(np.full(int(lengths.max(initial=0)) + 1, HASH_MULTIPLIER, dtype=np.uint64))
+        weighted = np.asarray(strings[bounds[0]:bounds[-1]], dtype=np.uint64) * powers[within]
+        sums = np.concatenate(([np.uint64(0)], np.cumsum(weighted, dtype=np.uint64)))
+        hashes[chunk - start:chunk - start + len(lengths)] = (sums[bounds[1:] - bounds[0]] - sums[bounds[:-1] - bounds[0]]) ^ lengths.astype(np.uint64)
+    return hashes
+
+def join_indices(left: 'NodeIndex', right: 'NodeIndex') -> np.ndarray:
+    # Id in right of every string of left, -1 where it is missing. Both tables are hashed with numpy
+    # and matched by sorted hash; matches are confirmed byte by byte, and the rare string whose hash
+    # collides with a different one falls back to the hash index lookup
+    right_hashes = string_hashes(right.offsets, right.strings)
+    order = np.argsort(right_hashes, kind='stable')
+    sorted_hashes = right_hashes[order]
+    ids = np.full(len(left), -1, dtype=np.int64)
+    for start in range(0, len(left), JOIN_CHUNK):
+        stop = min(start + JOIN_CHUNK, len(left))
+        rows = np.arange(start, stop)
+        hashes = string_hashes(left.offsets, left.strings, start, stop)
+        positions = np.minimum(np.searchsorted(sorted_hashes, hashes), max(len(order) - 1, 0))
+        found = sorted_hashes[positions] == hashes if len(order) else np.zeros(len(rows), dtype=bool)
+        rows, candidates = rows[found], order[positions[found]]
+
+        left_positions, left_lengths = string_ranges(left.offsets, rows)
+        right_lengths = np.asarray(right.offsets[candidates + 1] - right.offsets[candidates], dtype=np.int64)
+        same_length = left_lengths == right_lengths
+        right_positions, _ = string_ranges(right.offsets, candidates[same_length])
+        mismatches = np.concatenate(([0], np.cumsum(np.asarray(left.strings[left_positions[np.repeat(same_length, left_lengths)]])
+                                                     != np.asarray(right.strings[right_positions]))))
+        ends = np.cumsum(left_lengths[same_length])
+        equal = np.zeros(len(rows), dtype=bool)
+        equal[same_length] = mismatches[ends] == mismatches[ends - left_lengths[same_length]]
+        ids[rows[equal]] = candidates[equal]
+        for row in rows[~equal].tolist():
+            ids[row] = right.get(left.doi(row), -1)
+    return ids
+
+def save_node_index(dois: list[str], directory: str = './data/node_index') -> None:
+    os.makedirs(directory, exist_ok=True)
+    offsets, data = build_string_table(dois)
+    np.save(os.path.join(directory, 'offsets.npy'), offsets)
+    np.save(os.path.join(directory, 'strings.npy'), data)
+    np.save(os.path.join(directory, 'index.npy'), build_hash_index(dois))
+
+def save_edge_arrays(sources: np.ndarray, targets: np.ndarray, directory: str = './data/node_index') -> None:
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'sources.npy'), sources)
+    np.save(os.path.join(directory, 'targets.npy'), targets)
+
+def load_edge_arrays(directory: str = './data/node_index', mmap_mode: str | None = 'r') -> tuple[np.ndarray, np.ndarray]:
+    return (np.load(os.path.join(directory, 'sources.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, 'targets.npy'), mmap_mode=mmap_mode))
+
+class NodeIndex:
+    def __init__(self, directory: str = './data/node_index', mmap_mode: str | None = 'r'):
+        self.directory = directory
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode=mmap_mode)
+        self.strings = np.load(os.path.join(directory, 'strings.npy'), mmap_mode=mmap_mode)
+        self.index = np.load(os.path.join(directory, 'index.npy'), mmap_mode=mmap_mode)
+        self.mask = len(self.index) - 1
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def doi(self, node_id: int) -> str:
+        return bytes(self.strings[self.offsets[node_id]:self.offsets[node_id + 1]]).decode('utf-8')
+
+    def dois(self, node_ids) -> list[str]:
+        return [self.doi(node_id) for node_id in node_ids]
+
+    def get(self, doi: str, default: int | None = None) -> int | None:
+        # Every lookup (get, [], in, and the stores built on the index) accepts any spelling of a DOI
+        encoded = normalize_doi(doi).encode('utf-8')
+        slot = hash_string(encoded) & self.mask
+        while True:
+            node_id = int(self.index[slot])
+            if node_id == EMPTY_SLOT:
+                return default
+            if bytes(self.strings[self.offsets[node_id]:self.offsets[node_id + 1]]) == encoded:
+                return node_id
+            slot = (slot + 1) & self.mask
+
+    def __getitem__(self, doi: str) -> int:
+        node_id = self.get(doi)
+        if node_id is None:
+            raise KeyError(doi)
+        return node_id
+
+    def __contains__(self, doi: str) -> bool:
+        return self.get(doi) is not None
+
+    def __iter__(self):
+        for node_id in range(len(self)):
+            yield self.doi(node_id)
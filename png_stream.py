@@ -0,0 +1,154 @@
+# Minimal streaming PNG writer and reader: rows are filtered and compressed (or decompressed) as
+# they go, so images far larger than memory can be processed one band of rows at a time.
+
+import struct
+import zlib
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+COLOR_TYPES = {3: 2, 4: 6} # channels -> PNG colour type (RGB, RGBA)
+IDAT_SIZE = 1 << 20
+# Upper bound on the decompressed bytes held at once while reading; black canvases compress very well
+DECOMPRESS_SIZE = 1 << 22
+
+def png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+def sub_filter(rows: np.ndarray) -> bytes:
+    # PNG filter type 1: every byte minus the same channel of the pixel to its left
+    height, width, channels = rows.shape
+    flat = rows.reshape(height, width * channels)
+    filtered = np.empty((height, width * channels + 1), dtype=np.uint8)
+    filtered[:, 0] = 1
+    filtered[:, 1:channels + 1] = flat[:, :channels]
+    np.subtract(flat[:, channels:], flat[:, :-channels], out=filtered[:, channels + 1:])
+    return filtered.tobytes()
+
+def unfilter_row(filter_type: int, line: np.ndarray, previous: np.ndarray, bpp: int) -> np.ndarray:
+    # Undoes the PNG filter of one scanline given the previous unfiltered one (uint8 arithmetic wraps)
+    if filter_type == 0:
+        return line.copy()
+    if filter_type == 1:
+        return np.cumsum(line.reshape(-1, bpp), axis=0, dtype=np.uint8).reshape(-1)
+    if filter_type == 2:
+        return line + previous
+    # Average and Paeth depend on the byte just reconstructed to the left, so they go byte by byte
+    raw = bytearray(line.tobytes())
+    above = previous.tobytes()
+    for i in range(len(raw)):
+        left = raw[i - bpp] if i >= bpp else 0
+        if filter_type == 3:
+            raw[i] = (raw[i] + ((left + above[i]) >> 1)) & 0xFF
+        elif filter_type == 4:
+            upper_left = above[i - bpp] if i >= bpp else 0
+            estimate = left + above[i] - upper_left
+            pa, pb, pc = abs(estimate - left), abs(estimate - above[i]), abs(estimate - upper_left)
+            predictor = left if pa <= pb and pa <= pc else above[i] if pb <= pc else upper_left
+            raw[i] = (raw[i] + predictor) & 0xFF
+        else:
+            raise ValueError(f"Invalid PNG filter type {filter_type}.")
+    return np.frombuffer(bytes(raw), dtype=np.uint8)
+
+class PNGReader:
+    # Supports what PNGWriter produces: 8 bit RGB or RGBA, not interlaced
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        if self.file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            self.file.close()
+            raise ValueError(f"{path} is not a PNG file.")
+        tag, data = self._read_chunk()
+        self.width, self.height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', data)
+        channels = {color: count for count, color in COLOR_TYPES.items()}.get(color_type)
+        if tag != b'IHDR' or bit_depth != 8 or channels is None or interlace:
+            self.file.close()
+            raise ValueError(f"{path}: only 8 bit, non-interlaced RGB and RGBA images can be streamed.")
+        self.channels = channels
+
+    def _read_chunk(self) -> tuple[bytes, bytes]:
+        length, tag = struct.unpack('>I4s', self.file.read(8))
+        data = self.file.read(length)
+        self.file.read(4)
+        return tag, data
+
+    def filtered_rows(self):
+        # Yields every scanline still filtered: the filter type byte followed by the row bytes
+        row_bytes = self.width * self.channels + 1
+        decompressor = zlib.decompressobj()
+        buffer = bytearray()
+        while True:
+            tag, data = self._read_chunk()
+            if tag == b'IEND':
+                break
+            if tag != b'IDAT':
+                continue
+            while data:
+                buffer += decompressor.decompress(data, DECOMPRESS_SIZE)
+                data = decompressor.unconsumed_tail
+                start = 0
+                while len(buffer) - start >= row_bytes:
+                    yield bytes(buffer[start:start + row_bytes])
+                    start += row_bytes
+                del buffer[:start]
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+class PNGWriter:
+    def __init__(self, path: str, width: int, height: int, channels: int = 4, level: int = 6):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(level)
+        self.pending = []
+        self.pending_size = 0
+        self.file.write(PNG_SIGNATURE)
+        self.file.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, COLOR_TYPES[channels], 0, 0, 0)))
+
+    def write_chunk(self, tag: bytes, data: bytes) -> None:
+        self.file.write(png_chunk(tag, data))
+
+    def write_filtered(self, data: bytes, num_rows: int) -> None:
+        # Already filtered scanlines (filter byte + row bytes each)
+        self._append(self.compressor.compress(data))
+        self.rows_written += num_rows
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        self.write_filtered(sub_filter(np.ascontiguousarray(rows, dtype=np.uint8)), len(rows))
+
+    def _append(self, data: bytes) -> None:
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= IDAT_SIZE:
+            self._flush_idat()
+
+    def _flush_idat(self) -> None:
+        if self.pending_size:
+            self.write_chunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self) -> None:
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG declares {self.height} rows but {self.rows_written} were written.")
+        self._append(self.compressor.flush())
+        self._flush_idat()
+        self.write_chunk(b'IEND', b'')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
@@ -0,0 +1,82 @@
+# Content-addressed cache for multi-stage pipelines. A stage's key is the hash of its name, its
+# parameters and the contents of its input files, so a stage reruns exactly when something it
+# reads changes, and stages downstream of it rerun only if its outputs actually changed.
+
+import hashlib
+import json
+import os
+from instrumentation import HEARTBEAT_INTERVAL, stage as timed_stage
+
+CACHE_PATH = './data/stage_cache.json'
+
+def load_cache(cache_path: str = CACHE_PATH) -> dict:
+    if not os.path.exists(cache_path):
+        return {"files": {}, "stages": {}}
+    with open(cache_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_cache(cache: dict, cache_path: str = CACHE_PATH) -> None:
+    with open(cache_path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(cache, file, indent=1)
+    os.replace(cache_path + '.tmp', cache_path)
+
+def file_digest(path: str, cache: dict) -> str | None:
+    if not os.path.exists(path):
+        return None
+    # Hashing multi-GB artifacts on every run would defeat the purpose, so digests are reused
+    # while size and mtime are unchanged
+    stat = os.stat(path)
+    known = cache["files"].get(path)
+    if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["digest"]
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    cache["files"][path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest.hexdigest()}
+    return digest.hexdigest()
+
+def stage_key(name: str, stage: dict, cache: dict) -> str:
+    payload = {
+        "name": name,
+        "params": stage.get("params", {}),
+        "inputs": {path: file_digest(path, cache) for path in stage["inputs"]},
+    }
+    return hashlib.blake2b(json.dumps(payload, sort_keys=True, default=str).encode('utf-8'), digest_size=20).hexdigest()
+
+def upstream_closure(stages: dict, targets: list[str]) -> list[str]:
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in stages:
+            raise KeyError(f"Unknown stage: {name}. Available stages: {', '.join(stages)}")
+        if name not in needed:
+            needed.add(name)
+            pending.extend(stages[name].get("deps", []))
+    # stages are declared in topological order
+    return [name for name in stages if name in needed]
+
+def run_stages(stages: dict, targets: list[str] | None = None, force: set[str] = frozenset(), cache_path: str = CACHE_PATH) -> None:
+    cache = load_cache(cache_path)
+    order = upstream_closure(stages, targets or list(stages))
+
+    for name in order:
+        stage = stages[name]
+        key = stage_key(name, stage, cache)
+        cached = cache["stages"].get(name, {})
+        outputs_exist = all(os.path.exists(path) for path in stage["outputs"])
+
+        if name not in force and cached.get("key") == key and outputs_exist:
+            print(f"[{name}] up to date, skipping.")
+            continue
+
+        reason = "forced" if name in force else "outputs missing" if not outputs_exist else "inputs or parameters changed"
+        print(f"[{name}] running ({reason})...")
+        # Input size is the unit of work, so the ETA of a stage scales with how much it reads
+        units = sum(os.path.getsize(path) for path in stage["inputs"] if os.path.exists(path))
+        with timed_stage(name, units=units, heartbeat_interval=HEARTBEAT_INTERVAL):
+            stage["run"]()
+        cache["stages"][name] = {"key": key, "outputs": stage["outputs"]}
+        save_cache(cache, cache_path)
@@ -0,0 +1,192 @@
+# Synthetic Crossref-shaped corpus for benchmarks. Shards are .json.gz files with an "items" array,
+# like the public data file. Journals mix titles from data/keywords.txt with made-up ones, and
+# citations follow a power law over a fixed DOI universe (the corpus itself plus external DOIs), so
+# some papers are cited heavily and most rarely. Every shard depends only on the seed and its number,
+# so shards are written in parallel and a corpus is reproducible from its config.
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import string
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from doi_retrieval import read_keywords
+
+CORPUS_FILENAME = 'corpus.json'
+ITEM_TYPES = ['journal-article', 'book-chapter', 'proceedings-article', 'posted-content']
+SUBJECTS = ['Psychology', 'Clinical Psychology', 'Social Psychology', 'Applied Psychology', 'Neuroscience', 'Education',
+            'Psychiatry and Mental health', 'Developmental and Educational Psychology', 'Sociology and Political Science']
+WORDS = ['cognitive', 'behaviour', 'anxiety', 'memory', 'adolescents', 'therapy', 'stress', 'attention', 'personality',
+         'depression', 'wellbeing', 'motivation', 'emotion', 'learning', 'social', 'identity', 'sleep', 'trauma']
+
+def default_config(**overrides) -> dict:
+    config = {
+        'shards': 4,
+        'items_per_shard': 5000,
+        'match_share': 0.3,         # share of items published in a journal from the keyword list
+        'keyword_journals': 0,      # how many keyword journals are used; 0 uses all of them
+        'other_journals': 2000,
+        'journal_exponent': 1.0,    # Zipf exponent of journal sizes
+        'article_share': 0.9,       # share of items of type journal-article
+        'mean_references': 25,
+        'citation_exponent': 0.7,   # Zipf exponent of citation popularity; higher is more skewed
+        'field_share': 0.6,         # share of references to articles in keyword journals
+        'external_share': 0.5,      # DOIs outside the corpus, relative to the corpus size
+        'missing_doi_share': 0.15,  # references without a DOI
+        'first_year': 2005,
+        'last_year': 2024,
+        'seed': 0,
+    }
+    config.update(overrides)
+    return config
+
+def corpus_size(config: dict) -> int:
+    return config['shards'] * config['items_per_shard']
+
+def universe_size(config: dict) -> int:
+    return corpus_size(config) + int(corpus_size(config) * config['external_share'])
+
+def doi_for(index: int, num_corpus: int) -> str:
+    return f"10.5555/synth.{index}" if index < num_corpus else f"10.5556/ext.{index - num_corpus}"
+
+def in_keyword_journals(indices: np.ndarray, match_share: float) -> np.ndarray:
+    # Decided by the DOI index alone (a golden-ratio sequence has an exact share in every stretch of
+    # indices), so any shard knows which articles of the other shards are in keyword journals
+    return (indices * 0.6180339887498949) % 1 < match_share
+
+def journal_titles(config: dict, keywords: list[str]) -> tuple[list[str], list[str]]:
+    rng = np.random.default_rng(config['seed'])
+    matched = keywords[:config['keyword_journals']] if config['keyword_journals'] else list(keywords)
+    letters = np.array(list(string.ascii_lowercase))
+    other = ["Journal of " + " ".join("".join(rng.choice(letters, rng.integers(4, 11))).title() for _ in range(rng.integers(1, 4)))
+             for _ in range(config['other_journals'])]
+    return matched, other
+
+def zipf_choice(rng: np.random.Generator, num_values: int, exponent: float, size: int) -> np.ndarray:
+    # Inverse CDF of a continuous power law over ranks 1..num_values, so no table of weights is needed
+    u = rng.random(size)
+    if abs(exponent - 1) < 1e-9:
+        ranks = num_values ** u
+    else:
+        ranks = ((num_values ** (1 - exponent) - 1) * u + 1) ** (1 / (1 - exponent))
+    return np.minimum(ranks.astype(np.int64), num_values) - 1
+
+def popularity_permutation(num_values: int) -> int:
+    # Rank r maps to DOI (r * step) % num_values; any step coprime to num_values is a permutation,
+    # which keeps the most cited papers spread over shards and years
+    step = 2654435761 % num_values or 1
+    while np.gcd(step, num_values) != 1:
+        step += 1
+    return step
+
+def generate_shard(params) -> tuple[str, int, int]:
+    config, shard, matched, other, path = params
+    rng = np.random.default_rng([config['seed'], shard])
+    num_items = config['items_per_shard']
+    num_corpus = corpus_size(config)
+    num_universe = universe_size(config)
+    step = popularity_permutation(num_universe)
+
+    in_keywords = in_keyword_journals(np.arange(shard * num_items, (shard + 1) * num_items), config['match_share'])
+    journal_ranks = np.where(in_keywords, zipf_choice(rng, len(matched), config['journal_exponent'], num_items),
+                             zipf_choice(rng, len(other), config['journal_exponent'], num_items))
+    types = np.where(rng.random(num_items) < config['article_share'], 0, rng.integers(1, len(ITEM_TYPES), num_items))
+    years = rng.integers(config['first_year'], config['last_year'] + 1, num_items)
+    num_refs = rng.poisson(rng.gamma(2.0, config['mean_references'] / 2, num_items))
+    targets = (zipf_choice(rng, num_universe, config['citation_exponent'], int(num_refs.sum())) * step) % num_universe
+    # Papers mostly cite their own field, here the articles in keyword journals
+    field = np.flatnonzero(in_keyword_journals(np.arange(num_corpus), config['match_share']))
+    in_field = rng.random(len(targets)) < config['field_share'] if len(field) else np.zeros(len(targets), dtype=bool)
+    field_ranks = zipf_choice(rng, len(field), config['citation_exponent'], int(in_field.sum()))
+    targets[in_field] = field[(field_ranks * popularity_permutation(len(field))) % len(field)] if len(field) else 0
+    has_doi = rng.random(len(targets)) >= config['missing_doi_share']
+    # Mostly recent references, occasionally without a year
+    ages = rng.geometric(0.25, len(targets)) - 1
+    has_year = rng.random(len(targets)) >= 0.05
+
+    months = rng.integers(1, 13, num_items)
+    title_words = rng.integers(0, len(WORDS), (num_items, 6))
+    subject_counts = rng.integers(1, 4, num_items)
+    subject_picks = np.argsort(rng.random((num_items, len(SUBJECTS))), axis=1)[:, :3]
+    authors = rng.integers(0, 10000, (num_items, 3))
+    reference_dois = [doi_for(target, num_corpus) if found else None for target, found in zip(targets.tolist(), has_doi.tolist())]
+    reference_years = np.where(has_year, np.repeat(years, num_refs) - ages, 0).tolist()
+
+    num_edges = 0
+    position = 0
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as file:
+        file.write('{"status":"ok","items":[')
+        for i in range(num_items):
+            journal = matched[journal_ranks[i]] if in_keywords[i] else other[journal_ranks[i]]
+            references = []
+            for k in range(position, position + int(num_refs[i])):
+                reference = {"key": f"ref{k - position}", "unstructured": "Author A. Some cited work."}
+                if reference_dois[k]:
+                    reference["DOI"] = reference_dois[k]
+                    num_edges += 1
+                if reference_years[k]:
+                    reference["year"] = str(reference_years[k])
+                references.append(reference)
+            position += int(num_refs[i])
+            item = {
+                "DOI": doi_for(shard * num_items + i, num_corpus),
+                "type": ITEM_TYPES[types[i]],
+                "container-title": [journal],
+                "short-container-title": [journal[:24]],
+                "published": {"date-parts": [[int(years[i]), int(months[i])]]},
+                "title": [" ".join(WORDS[w] for w in title_words[i].tolist()).capitalize()],
+                "subject": [SUBJECTS[s] for s in subject_picks[i, :subject_counts[i]].tolist()],
+                "author": [{"given": "A.", "family": f"Author{a}", "sequence": "additional"} for a in authors[i].tolist()],
+                "reference-count": len(references),
+                "reference": references,
+            }
+            if i:
+                file.write(',')
+            file.write(json.dumps(item))
+        file.write(']}')
+    return path, num_items, num_edges
+
+def generate_corpus(directory: str, config: dict, keywords: list[str], workers: int | None = None) -> list[str]:
+    # A directory that already holds a corpus with the same config is reused as is
+    os.makedirs(directory, exist_ok=True)
+    config_path = os.path.join(directory, CORPUS_FILENAME)
+    paths = [os.path.join(directory, f"synthetic_{shard:04d}.json.gz") for shard in range(config['shards'])]
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as file:
+            existing = json.load(file)
+        if existing['config'] == config and all(os.path.exists(path) for path in paths):
+            return paths
+    for name in os.listdir(directory):
+        if name.endswith('.json.gz'):
+            os.remove(os.path.join(directory, name))
+
+    matched, other = journal_titles(config, keywords)
+    tasks = [(config, shard, matched, other, path) for shard, path in enumerate(paths)]
+    with ProcessPoolExecutor(max_workers=min(len(tasks), workers or multiprocessing.cpu_count())) as executor:
+        results = list(executor.map(generate_shard, tasks))
+    num_items = sum(items for _, items, _ in results)
+    num_edges = sum(edges for _, _, edges in results)
+    with open(config_path, 'w', encoding='utf-8') as file:
+        json.dump({'config': config, 'items': num_items, 'references': num_edges}, file, indent=1)
+    print(f"Generated {num_items} items with {num_edges} DOI references in {len(paths)} shards in {directory}")
+    return paths
+
+def parse_args(argv=None):
+    defaults = default_config()
+    parser = argparse.ArgumentParser(description="Write a synthetic Crossref-shaped corpus of .json.gz shards.")
+    parser.add_argument('directory', help="output directory for the shards")
+    parser.add_argument('--keywords', default='./data/keywords.txt', help="journal titles the matched share is drawn from")
+    parser.add_argument('--workers', type=int, default=None)
+    for name, value in defaults.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    config = {name: getattr(args, name) for name in default_config()}
+    generate_corpus(args.directory, config, read_keywords(args.keywords), args.workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# Temporal mode: cumulative yearly snapshots of the citation graph. Edges are sorted by the year of
+# the citing paper and nodes are numbered in order of first appearance, so every year's graph is the
+# previous one with vertices and edges appended, and last year's node ids stay valid. Each year's
+# partition starts from last year's communities. Its layout starts from last year's coordinates with
+# the new nodes placed among their neighbours, followed by a short force-directed pass in which old
+# nodes only move a little. Communities get persistent labels, matched by overlap with the previous
+# year, so a community keeps its colour in every year's image.
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import igraph as ig
+import numpy as np
+from graph_psych import generate_colors_exact, get_partition, node_years, set_colors, truncate_graph
+from instrumentation import stage
+from metadata_store import METADATA_DIR, NO_YEAR, MetadataStore
+from multilevel_layout import multilevel_layout, refine_layout, warm_start_layout
+from node_index import NodeIndex, load_edge_arrays, save_node_index
+from tile_renderer import EDGE_MODES, TILE_SIZE, render_tiled
+
+TEMPORAL_DIR = './data/temporal'
+STATE_FILENAME = 'temporal.json'
+
+def order_edges_by_year(sources: np.ndarray, targets: np.ndarray, years: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Returns the edges sorted by citing year in first-appearance node ids, their years, the global
+    # id of every local node, and the position in the edge stream where each local node first appears
+    edge_years = years[sources]
+    dated = np.flatnonzero(edge_years != NO_YEAR)
+    if len(dated) < len(sources):
+        print(f"Skipping {len(sources) - len(dated)} edges whose citing paper has no publication year.")
+    order = dated[np.argsort(edge_years[dated], kind='stable')]
+    sources, targets, edge_years = sources[order], targets[order], edge_years[order]
+
+    nodes, first = np.unique(np.stack((sources, targets), axis=1).ravel(), return_index=True)
+    by_appearance = np.argsort(first, kind='stable')
+    global_ids = nodes[by_appearance]
+    local = np.full(int(global_ids.max(initial=-1)) + 1, -1, dtype=np.int64)
+    local[global_ids] = np.arange(len(global_ids))
+    return local[sources], local[targets], edge_years, global_ids, first[by_appearance] // 2
+
+def extend_membership(previous: np.ndarray, num_nodes: int) -> np.ndarray:
+    # New nodes start out as singleton communities
+    membership = np.arange(num_nodes, dtype=np.int64) - len(previous) + int(previous.max(initial=-1)) + 1
+    membership[:len(previous)] = previous
+    return membership
+
+def track_communities(previous_labels: np.ndarray | None, membership: np.ndarray, next_label: int) -> tuple[np.ndarray, int]:
+    # Every community takes the label of the previous community it shares most nodes with, largest
+    # overlaps first; communities without a match get new labels, largest first
+    num_communities = int(membership.max()) + 1
+    community_labels = np.full(num_communities, -1, dtype=np.int64)
+    if previous_labels is not None and len(previous_labels):
+        pairs, overlaps = np.unique(membership[:len(previous_labels)] * next_label + previous_labels, return_counts=True)
+        taken = set()
+        for pair in pairs[np.argsort(-overlaps, kind='stable')].tolist():
+            community, label = divmod(pair, next_label)
+            if community_labels[community] < 0 and label not in taken:
+                community_labels[community] = label
+                taken.add(label)
+    sizes = np.bincount(membership, minlength=num_communities)
+    unmatched = np.flatnonzero(community_labels < 0)
+    unmatched = unmatched[np.argsort(-sizes[unmatched], kind='stable')]
+    community_labels[unmatched] = np.arange(next_label, next_label + len(unmatched))
+    return community_labels, next_label + len(unmatched)
+
+def first_layout(graph: ig.Graph, sources: np.ndarray, targets: np.ndarray, membership: np.ndarray, algorithm: str, seed: int,
+                 checkpoint_dir: str) -> np.ndarray:
+    if algorithm == 'multilevel':
+        return multilevel_layout(sources, targets, membership, checkpoint_dir, seed)
+    random.seed(seed)
+    return np.array(graph.layout(algorithm).coords, dtype=np.float64).reshape(-1, 2)
+
+def load_state(output_dir: str) -> dict:
+    path = os.path.join(output_dir, STATE_FILENAME)
+    if not os.path.exists(path):
+        return {'params': None, 'years': []}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_state(state: dict, output_dir: str) -> None:
+    path = os.path.join(output_dir, STATE_FILENAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=1)
+    os.replace(path + '.tmp', path)
+
+def year_files(output_dir: str, year: int) -> dict[str, str]:
+    year_dir = os.path.join(output_dir, str(year))
+    return {name: os.path.join(year_dir, f'{name}.npy') for name in ('membership', 'labels', 'coords')}
+
+def build_snapshots(args) -> tuple[list[dict], np.ndarray, np.ndarray, int]:
+    node_ids = NodeIndex(args.node_index_dir)
+    sources, targets = (np.asarray(array, dtype=np.int64) for array in load_edge_arrays(args.node_index_dir))
+    years = node_years(node_ids, MetadataStore(args.metadata_dir))
+    sources, targets, edge_years, global_ids, first_edge = order_edges_by_year(sources, targets, years)
+    if len(edge_years) == 0:
+        raise ValueError("No dated edges to build snapshots from.")
+    save_node_index(node_ids.dois(global_ids.tolist()), os.path.join(args.output_dir, 'nodes'))
+
+    start_year = args.start_year or int(edge_years[0])
+    end_year = args.end_year or int(edge_years[-1])
+    # The digest identifies the input graph, so snapshots of a rebuilt node index are never reused
+    digest = hashlib.blake2b(digest_size=20)
+    for array in (sources, targets, edge_years):
+        digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+    params = {'resolution': args.resolution, 'seed': args.seed, 'layout': args.layout, 'start_year': start_year,
+              'refine_iterations': args.refine_iterations, 'edges_digest': digest.hexdigest()}
+    state = load_state(args.output_dir)
+    # Years are reused while everything they were warm-started from is unchanged
+    previous_years = {entry['year']: entry for entry in state['years']} if state['params'] == params else {}
+    state = {'params': params, 'years': []}
+
+    membership = labels = coords = None
+    next_label = 0
+    graph = ig.Graph(directed=True)
+    for year in range(start_year, end_year + 1):
+        num_edges = int(np.searchsorted(edge_years, year, side='right'))
+        num_nodes = int(np.searchsorted(first_edge, num_edges))
+        if num_edges == 0:
+            continue
+        # The graph only ever grows: this year's vertices and edges are appended to last year's
+        new_edges = num_edges - graph.ecount()
+        new_nodes = num_nodes - graph.vcount()
+        graph.add_vertices(new_nodes)
+        graph.add_edges(list(zip(sources[graph.ecount():num_edges].tolist(), targets[graph.ecount():num_edges].tolist())))
+
+        files = year_files(args.output_dir, year)
+        entry = previous_years.get(year)
+        if entry and entry['edges'] == num_edges and all(os.path.exists(path) for path in files.values()):
+            membership, labels, coords = (np.load(files[name]) for name in ('membership', 'labels', 'coords'))
+            next_label = max(next_label, int(labels.max(initial=-1)) + 1)
+            print(f"{year}: reusing the snapshot with {num_nodes} nodes and {num_edges} edges.")
+            state['years'].append(entry)
+            continue
+        previous_years = {}
+
+        print(f"{year}: {num_nodes} nodes (+{new_nodes}), {num_edges} edges (+{new_edges}).")
+        previous_labels = labels
+        with stage('temporal_partition', units=num_edges, year=year) as partition_record:
+            initial = extend_membership(membership, num_nodes) if membership is not None else None
+            membership, _, _, statistics = get_partition(graph, args.resolution, args.seed, initial_membership=initial)
+            membership = np.asarray(membership, dtype=np.int64)
+        community_labels, next_label = track_communities(previous_labels, membership, next_label)
+        labels = community_labels[membership]
+
+        with stage('temporal_layout', units=num_edges, year=year) as layout_record:
+            if coords is None:
+                coords = first_layout(graph, sources[:num_edges], targets[:num_edges], membership, args.layout, args.seed,
+                                      os.path.join(args.output_dir, 'layout_checkpoint'))
+            else:
+                num_known = len(coords)
+                coords = warm_start_layout(sources[:num_edges], targets[:num_edges], num_nodes, np.arange(num_known), coords,
+                                           membership, args.seed)
+                if args.refine_iterations:
+                    coords = refine_layout(sources[:num_edges], targets[:num_edges], coords, num_known, args.refine_iterations, args.seed)
+
+        os.makedirs(os.path.dirname(files['coords']), exist_ok=True)
+        for name, array in (('membership', membership), ('labels', labels), ('coords', coords)):
+            np.save(files[name], array)
+
+        sizes = np.bincount(labels)
+        largest = np.argsort(-sizes, kind='stable')[:args.top_partitions]
+        entry = {
+            'year': year,
+            'nodes': num_nodes,
+            'edges': num_edges,
+            'new_nodes': new_nodes,
+            'new_edges': new_edges,
+            'communities': statistics[0]['communities'],
+            'quality': statistics[0]['quality'],
+            'top_coverage': statistics[0]['top_coverage'],
+            'largest': [{'label': int(label), 'size': int(sizes[label])} for label in largest],
+            # Share of last year's nodes that are still in a community with the same label
+            'retained': float((labels[:len(previous_labels)] == previous_labels).mean()) if previous_labels is not None else None,
+            'partition_seconds': partition_record['wall_seconds'],
+            'layout_seconds': layout_record['wall_seconds'],
+        }
+        state['years'].append(entry)
+        save_state(state, args.output_dir)
+
+    save_state(state, args.output_dir)
+    return state['years'], sources, targets, next_label
+
+def render_snapshots(args, years: list[dict], sources: np.ndarray, targets: np.ndarray, num_labels: int) -> None:
+    # All years share one frame, covering every year's coordinates, and one palette indexed by
+    # persistent label
+    extents = [np.load(year_files(args.output_dir, entry['year'])['coords']) for entry in years]
+    bounds = (np.min([coords.min(axis=0) for coords in extents], axis=0), np.max([coords.max(axis=0) for coords in extents], axis=0))
+    random.seed(args.seed)
+    node_colors, edge_colors = generate_colors_exact(max(num_labels, 1), colors_path=os.path.join(args.output_dir, 'colors.txt'))
+
+    for entry in years:
+        files = year_files(args.output_dir, entry['year'])
+        labels = np.load(files['labels'])
+        coords = np.load(files['coords'])
+        with stage('temporal_render', units=entry['edges'], year=entry['year']):
+            graph = ig.Graph(entry['nodes'], edges=list(zip(sources[:entry['edges']].tolist(), targets[:entry['edges']].tolist())), directed=True)
+            graph = truncate_graph(graph, labels, [item['label'] for item in entry['largest']], seed=args.seed)
+            graph = set_colors(graph, labels, node_colors, edge_colors, styled_path=None)
+            year_dir = os.path.dirname(files['coords'])
+            render_tiled(graph, ig.Layout(coords.tolist()), image_path=os.path.join(year_dir, 'graph.png'), pyramid_dir=os.path.join(year_dir, 'pyramid'),
+                         width=args.width, height=args.height, margin=50, tile_size=args.tile_size, edge_width=0.25,
+                         edge_mode=args.edge_mode, bounds=bounds)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build cumulative yearly snapshots of the citation graph with warm-started partitions and layouts.")
+    parser.add_argument('--start-year', type=int, default=None, help="first snapshot year; default is the first year with citations")
+    parser.add_argument('--end-year', type=int, default=None, help="last snapshot year; default is the last year with citations")
+    parser.add_argument('--resolution', type=float, default=1.0, help="Leiden resolution parameter")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--layout', default='drl', help="layout of the first snapshot: 'multilevel' or an igraph layout name")
+    parser.add_argument('--refine-iterations', type=int, default=50,
+                        help="force-directed iterations after each year's warm start; 0 keeps old nodes fixed and only places new ones")
+    parser.add_argument('--top-partitions', type=int, default=10, help="communities listed in the statistics and drawn in the images")
+    parser.add_argument('--no-render', action='store_true', help="only compute the snapshots and statistics")
+    parser.add_argument('--width', type=int, default=3840)
+    parser.add_argument('--height', type=int, default=2160)
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE)
+    parser.add_argument('--edge-mode', choices=EDGE_MODES, default='strokes')
+    parser.add_argument('--node-index-dir', default='./data/node_index')
+    parser.add_argument('--metadata-dir', default=METADATA_DIR)
+    parser.add_argument('--output-dir', default=TEMPORAL_DIR)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    years, sources, targets, num_labels = build_snapshots(args)
+    for entry in years:
+        print(f"{entry['year']}: {entry['nodes']} nodes, {entry['edges']} edges, {entry['communities']} communities, "
+              f"top {len(entry['largest'])} cover {entry['top_coverage']:.1%}"
+              + (f", {entry['retained']:.1%} of last year's nodes kept their community" if entry['retained'] is not None else ""))
+    if not args.no_render:
+        render_snapshots(args, years, sources, targets, num_labels)
+    print(f"Yearly snapshots, statistics ({STATE_FILENAME}) and images saved to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
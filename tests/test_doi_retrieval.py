@@ -0,0 +1,33 @@
+# Runs process_files on small generated shards to check what the shard cache hands to the merge
+
+import gzip
+import json
+import os
+from doi_retrieval import iter_shard_records, process_files
+
+JOURNAL = 'Journal of Testing'
+
+def write_shard(path: str, name: str, years: list[int]) -> None:
+    items = [{'DOI': f'10.1/{name}.{year}', 'type': 'journal-article', 'container-title': [JOURNAL],
+              'title': [f'{name} {year}'], 'published': {'date-parts': [[year]]}} for year in years]
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        json.dump({'items': items}, file)
+
+def cached_dois(shard_files: list[str]) -> set[str]:
+    return {record[1] for shard_file in shard_files for record in iter_shard_records(shard_file) if record[0] == 'd'}
+
+def test_changed_shard_that_fails_is_not_merged(tmp_path):
+    shards = tmp_path / 'shards'
+    shards.mkdir()
+    cache_dir = str(tmp_path / 'cache')
+    write_shard(str(shards / '0.json.gz'), 'a', [2014, 2016])
+    write_shard(str(shards / '1.json.gz'), 'b', [2014, 2016])
+    first = process_files([str(shards)], [JOURNAL], 2014, 2023, cache_dir=cache_dir)
+    assert cached_dois(first) == {'10.1/a.2014', '10.1/a.2016', '10.1/b.2014', '10.1/b.2016'}
+
+    # The corrupted shard's old cache was built from other contents and for other years
+    with open(shards / '1.json.gz', 'wb') as file:
+        file.write(b'not a gzip file')
+    second = process_files([str(shards)], [JOURNAL], 2016, 2023, cache_dir=cache_dir)
+    assert cached_dois(second) == {'10.1/a.2016'}
+    assert len(second) == 1 and not any(os.path.exists(path) for path in set(first) - set(second))
@@ -0,0 +1,114 @@
+# Runs the harvester against a local aiohttp stub of the Crossref works endpoint
+
+import asyncio
+import datetime
+import gzip
+import json
+import os
+import pytest
+from aiohttp import web
+from extend_crossref import HarvestError, harvest, load_checkpoint
+
+PAGES = 3
+FETCH_OPTIONS = {'rows': 2, 'max_retries': 3, 'backoff': 0.01}
+
+class StubCrossref:
+    # Every filter has PAGES pages of two items, chained by cursors "*", "1", "2", ...; failures maps a
+    # (filter, cursor) pair to the statuses returned before the page is served
+    def __init__(self, failures=None, broken_after=None):
+        self.failures = {key: list(statuses) for key, statuses in (failures or {}).items()}
+        self.broken_after = broken_after
+        self.requests = []
+        self.served = 0
+
+    async def works(self, request: web.Request) -> web.Response:
+        query_filter = request.query['filter']
+        cursor = request.query['cursor']
+        self.requests.append((query_filter, cursor))
+        pending = self.failures.get((query_filter, cursor))
+        if pending:
+            return web.Response(status=pending.pop(0), headers={'Retry-After': '0'})
+        if self.broken_after is not None and self.served >= self.broken_after:
+            return web.Response(status=503)
+        self.served += 1
+        page = 0 if cursor == '*' else int(cursor)
+        items = [{'DOI': f'10.1/{query_filter}/{page}.{i}'} for i in range(2)] if page < PAGES else []
+        return web.json_response({'message': {'items': items, 'next-cursor': str(page + 1)}})
+
+async def run_harvest(stub: StubCrossref, directory: str, end_date=datetime.date(2024, 1, 14), **options) -> int:
+    app = web.Application()
+    app.router.add_get('/works', stub.works)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    port = runner.addresses[0][1]
+    try:
+        return await harvest('test@example.org', datetime.date(2024, 1, 1), end_date, directory,
+                             slice_days=7, concurrency=2, url=f'http://127.0.0.1:{port}/works', **FETCH_OPTIONS, **options)
+    finally:
+        await runner.cleanup()
+
+def saved_dois(directory: str) -> list[str]:
+    dois = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json.gz'):
+            with gzip.open(os.path.join(directory, name), 'rt', encoding='utf-8') as file:
+                dois.extend(item['DOI'] for item in json.load(file)['items'])
+    return dois
+
+FIRST_SLICE = 'from-index-date:2024-01-01,until-index-date:2024-01-07'
+
+def test_harvest_saves_every_page(tmp_path):
+    stub = StubCrossref()
+    assert asyncio.run(run_harvest(stub, str(tmp_path))) == 2 * PAGES
+    assert len(saved_dois(str(tmp_path))) == 2 * PAGES * 2
+    checkpoint = load_checkpoint(os.path.join(tmp_path, 'checkpoint.json'))
+    assert checkpoint['end_date'] == '2024-01-14'
+    assert all(state['done'] and state['page'] == PAGES for state in checkpoint['slices'].values())
+
+def test_harvest_retries_rate_limits_and_server_errors(tmp_path):
+    stub = StubCrossref(failures={(FIRST_SLICE, '*'): [429, 503], (FIRST_SLICE, '1'): [500, 502, 504]})
+    assert asyncio.run(run_harvest(stub, str(tmp_path))) == 2 * PAGES
+    assert stub.requests.count((FIRST_SLICE, '*')) == 3
+    assert stub.requests.count((FIRST_SLICE, '1')) == 4
+    assert len(set(saved_dois(str(tmp_path)))) == 2 * PAGES * 2
+
+def test_harvest_gives_up_on_other_statuses(tmp_path):
+    stub = StubCrossref(failures={(FIRST_SLICE, '*'): [404]})
+    with pytest.raises(HarvestError):
+        asyncio.run(run_harvest(stub, str(tmp_path)))
+    assert stub.requests.count((FIRST_SLICE, '*')) == 1
+
+def test_harvest_resumes_from_checkpoint(tmp_path):
+    # The first run dies once the server keeps failing; the checkpoint holds the pages saved so far
+    broken = StubCrossref(broken_after=3)
+    with pytest.raises(HarvestError):
+        asyncio.run(run_harvest(broken, str(tmp_path)))
+    checkpoint = load_checkpoint(os.path.join(tmp_path, 'checkpoint.json'))
+    pages_before = sum(state['page'] for state in checkpoint['slices'].values())
+    assert pages_before == 3 and len(saved_dois(str(tmp_path))) == 2 * pages_before
+
+    # The second run starts every slice at its saved cursor and fetches only the missing pages
+    stub = StubCrossref()
+    assert asyncio.run(run_harvest(stub, str(tmp_path))) == 2 * PAGES - pages_before
+    for slice_key, state in checkpoint['slices'].items():
+        query_filter = 'from-index-date:{},until-index-date:{}'.format(*slice_key.split('_'))
+        assert (query_filter, state['cursor']) in stub.requests
+        if state['page']:
+            assert (query_filter, '*') not in stub.requests
+    dois = saved_dois(str(tmp_path))
+    assert len(dois) == len(set(dois)) == 2 * PAGES * 2
+
+def test_harvest_resumes_with_the_stored_end_date(tmp_path):
+    # The last slice ends on the first run's end date; a resume without --end-date on a later day
+    # continues that slice at its cursor instead of starting one that ends today
+    broken = StubCrossref(broken_after=4)
+    with pytest.raises(HarvestError):
+        asyncio.run(run_harvest(broken, str(tmp_path), end_date=datetime.date(2024, 1, 10)))
+    pages_before = sum(state['page'] for state in load_checkpoint(os.path.join(tmp_path, 'checkpoint.json'))['slices'].values())
+    stub = StubCrossref()
+    assert asyncio.run(run_harvest(stub, str(tmp_path), end_date=None)) == 2 * PAGES - pages_before
+    checkpoint = load_checkpoint(os.path.join(tmp_path, 'checkpoint.json'))
+    assert checkpoint['end_date'] == '2024-01-10'
+    assert sorted(checkpoint['slices']) == ['2024-01-01_2024-01-07', '2024-01-08_2024-01-10']
+    assert all(query_filter.endswith(('2024-01-07', '2024-01-10')) for query_filter, _ in stub.requests)
@@ -0,0 +1,294 @@
+# Tiled graph renderer. The canvas is drawn directly in landscape orientation and split into
+# square tiles; every tile is rendered in a worker process with only the nodes and edges whose
+# bounding boxes overlap it. The rendered tiles form the most detailed level of a zoom pyramid,
+# coarser levels are built by merging 2x2 tiles, and the full image is streamed out band by band.
+# With edge_mode='density' edges are not stroked but counted per pixel and shaded (edge_density).
+
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import igraph as ig
+import numpy as np
+from PIL import Image, ImageColor
+from instrumentation import Progress
+from edge_density import DENSITY_SCALES, HIST_CAP, count_histogram, count_segments, equalization_table, shade_counts
+from png_stream import PNGWriter
+
+TILE_SIZE = 512
+# igraph's defaults for unstyled graphs
+DEFAULT_VERTEX_SIZE = 20
+DEFAULT_VERTEX_COLOR = 'red'
+DEFAULT_FRAME_COLOR = 'black'
+DEFAULT_EDGE_COLOR = '#444444'
+EDGE_MODES = ('strokes', 'density')
+
+def parse_color(color: str | None, default: str) -> tuple[float, float, float, float]:
+    color = color or default
+    if color.startswith('rgba('):
+        r, g, b, a = (float(part) for part in color[5:-1].split(','))
+        return r / 255, g / 255, b / 255, a
+    rgb = ImageColor.getrgb(color)
+    return rgb[0] / 255, rgb[1] / 255, rgb[2] / 255, (rgb[3] / 255 if len(rgb) == 4 else 1.0)
+
+def color_palette(colors: list[str | None], default: str) -> tuple[np.ndarray, np.ndarray]:
+    # Styled graphs use a handful of distinct colour strings, so each is parsed only once
+    unique, inverse = np.unique(np.array([c or default for c in colors], dtype=object), return_inverse=True)
+    palette = np.array([parse_color(c, default) for c in unique], dtype=np.float32).reshape(-1, 4)
+    return palette, inverse.reshape(-1).astype(np.int32)
+
+def parse_colors(colors: list[str | None], default: str) -> np.ndarray:
+    palette, inverse = color_palette(colors, default)
+    return palette[inverse]
+
+def vertex_attribute(graph: ig.Graph, name: str, default) -> list:
+    return graph.vs[name] if name in graph.vs.attributes() else [default] * graph.vcount()
+
+def edge_attribute(graph: ig.Graph, name: str, default) -> list:
+    return graph.es[name] if name in graph.es.attributes() else [default] * graph.ecount()
+
+def canvas_coordinates(coords: np.ndarray, width: int, height: int, margin: int, bounds: tuple[np.ndarray, np.ndarray] | None = None) -> np.ndarray:
+    # Equivalent to fitting the layout into a (height, width) portrait box and rotating the image
+    # 90 degrees counterclockwise afterwards: layout y runs left to right, layout x bottom to top.
+    # Fixed (low, high) bounds keep a series of layouts in the same frame.
+    low, high = bounds if bounds is not None else (coords.min(axis=0), coords.max(axis=0))
+    low = np.asarray(low, dtype=np.float64)
+    extent = np.asarray(high, dtype=np.float64) - low
+    scaled = np.where(extent > 0, (coords - low) / np.where(extent > 0, extent, 1), 0.5)
+    canvas = np.empty_like(scaled)
+    canvas[:, 0] = margin + scaled[:, 1] * (width - 2 * margin)
+    canvas[:, 1] = height - margin - scaled[:, 0] * (height - 2 * margin)
+    return canvas
+
+def bucket_by_tile(xmin: np.ndarray, ymin: np.ndarray, xmax: np.ndarray, ymax: np.ndarray, tiles_x: int, tiles_y: int, tile_size: int) -> tuple[np.ndarray, np.ndarray]:
+    # Every item is listed once for each tile its bounding box overlaps; a stable sort by tile
+    # keeps the original drawing order within each tile
+    tx0 = np.clip(np.floor(xmin / tile_size), 0, tiles_x - 1).astype(np.int64)
+    tx1 = np.clip(np.floor(xmax / tile_size), 0, tiles_x - 1).astype(np.int64)
+    ty0 = np.clip(np.floor(ymin / tile_size), 0, tiles_y - 1).astype(np.int64)
+    ty1 = np.clip(np.floor(ymax / tile_size), 0, tiles_y - 1).astype(np.int64)
+    spans_x = tx1 - tx0 + 1
+    counts = spans_x * (ty1 - ty0 + 1)
+
+    items = np.repeat(np.arange(len(xmin), dtype=np.int64), counts)
+    local = np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts, counts)
+    tiles = (ty0[items] + local // spans_x[items]) * tiles_x + tx0[items] + local % spans_x[items]
+
+    order = np.argsort(tiles, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(tiles, minlength=tiles_x * tiles_y))))
+    return items[order], offsets
+
+def build_scene(graph: ig.Graph, layout, scene_dir: str, width: int, height: int, margin: int, tile_size: int, edge_width: float,
+                edge_mode: str = 'strokes', bounds: tuple[np.ndarray, np.ndarray] | None = None) -> dict:
+    os.makedirs(scene_dir, exist_ok=True)
+    tiles_x = math.ceil(width / tile_size)
+    tiles_y = math.ceil(height / tile_size)
+    coords = canvas_coordinates(np.array(layout.coords, dtype=np.float64).reshape(-1, 2), width, height, margin, bounds)
+
+    sizes = np.asarray(vertex_attribute(graph, 'size', DEFAULT_VERTEX_SIZE), dtype=np.float64)
+    frame_widths = np.asarray(vertex_attribute(graph, 'frame_width', 1.0), dtype=np.float64)
+    # Nodes are drawn in order of their size, larger nodes last
+    node_order = np.argsort(sizes, kind='stable')
+    radius = sizes[node_order] / 2 + frame_widths[node_order] / 2
+    node_xy = coords[node_order]
+    nodes, node_offsets = bucket_by_tile(node_xy[:, 0] - radius, node_xy[:, 1] - radius, node_xy[:, 0] + radius,
+                                         node_xy[:, 1] + radius, tiles_x, tiles_y, tile_size)
+
+    edge_list = np.array(graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    segments = np.concatenate((coords[edge_list[:, 0]], coords[edge_list[:, 1]]), axis=1)
+    pad = edge_width / 2
+    edges, edge_offsets = bucket_by_tile(segments[:, [0, 2]].min(axis=1) - pad, segments[:, [1, 3]].min(axis=1) - pad,
+                                         segments[:, [0, 2]].max(axis=1) + pad, segments[:, [1, 3]].max(axis=1) + pad,
+                                         tiles_x, tiles_y, tile_size)
+    # Every distinct edge colour (one per community when styled by partition) is a density class
+    class_color, edge_class = color_palette(edge_attribute(graph, 'color', None), DEFAULT_EDGE_COLOR)
+
+    arrays = {
+        'node_xy': node_xy,
+        'node_size': sizes[node_order],
+        'node_frame_width': frame_widths[node_order],
+        'node_color': parse_colors(vertex_attribute(graph, 'color', None), DEFAULT_VERTEX_COLOR)[node_order],
+        'node_frame_color': parse_colors(vertex_attribute(graph, 'frame_color', None), DEFAULT_FRAME_COLOR)[node_order],
+        'tile_nodes': nodes,
+        'tile_nodes_offsets': node_offsets,
+        'segments': segments,
+        'edge_color': class_color[edge_class],
+        'edge_class': edge_class,
+        'class_color': class_color,
+        'tile_edges': edges,
+        'tile_edges_offsets': edge_offsets,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(scene_dir, f'{name}.npy'), array)
+
+    meta = {'width': width, 'height': height, 'tile_size': tile_size, 'tiles_x': tiles_x, 'tiles_y': tiles_y,
+            'edge_width': edge_width, 'edge_mode': edge_mode, 'levels': math.ceil(math.log2(max(tiles_x, tiles_y))) + 1}
+    with open(os.path.join(scene_dir, 'scene.json'), 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
+    return meta
+
+def load_scene(scene_dir: str) -> tuple[dict, dict]:
+    with open(os.path.join(scene_dir, 'scene.json'), 'r', encoding='utf-8') as file:
+        meta = json.load(file)
+    arrays = {name[:-4]: np.load(os.path.join(scene_dir, name), mmap_mode='r')
+              for name in os.listdir(scene_dir) if name.endswith('.npy')}
+    return meta, arrays
+
+def tile_items(arrays: dict, kind: str, tile: int) -> np.ndarray:
+    offsets = arrays[f'tile_{kind}_offsets']
+    return np.asarray(arrays[f'tile_{kind}'][offsets[tile]:offsets[tile + 1]])
+
+def draw_edges(context, arrays: dict, edges: np.ndarray, edge_width: float) -> None:
+    context.set_line_width(edge_width)
+    for (ax, ay, bx, by), color in zip(arrays['segments'][edges].tolist(), arrays['edge_color'][edges].tolist()):
+        context.set_source_rgba(*color)
+        context.move_to(ax, ay)
+        context.line_to(bx, by)
+        context.stroke()
+
+def draw_nodes(context, arrays: dict, nodes: np.ndarray) -> None:
+    rows = zip(arrays['node_xy'][nodes].tolist(), arrays['node_size'][nodes].tolist(), arrays['node_frame_width'][nodes].tolist(),
+               arrays['node_color'][nodes].tolist(), arrays['node_frame_color'][nodes].tolist())
+    for (x, y), size, frame_width, color, frame_color in rows:
+        context.new_path()
+        context.arc(x, y, size / 2, 0, 2 * math.pi)
+        context.set_source_rgba(*color)
+        context.fill_preserve()
+        context.set_source_rgba(*frame_color)
+        context.set_line_width(frame_width)
+        context.stroke()
+
+def tile_path(pyramid_dir: str, level: int, x: int, y: int) -> str:
+    return os.path.join(pyramid_dir, str(level), f'{x}_{y}.png')
+
+def counts_path(scene_dir: str, x: int, y: int) -> str:
+    return os.path.join(scene_dir, 'counts', f'{x}_{y}.npz')
+
+def count_tile(task) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # First density pass: per pixel edge counts of one tile, plus what the parent needs for the
+    # global normalization (the count histogram and the largest count of every class)
+    scene_dir, x, y = task
+    meta, arrays = load_scene(scene_dir)
+    tile_size = meta['tile_size']
+    edges = tile_items(arrays, 'edges', y * meta['tiles_x'] + x)
+    keys, counts = count_segments(np.asarray(arrays['segments'][edges]), np.asarray(arrays['edge_class'][edges]),
+                                  x * tile_size, y * tile_size, tile_size)
+    np.savez(counts_path(scene_dir, x, y), keys=keys, counts=counts)
+
+    maxima = np.zeros(len(arrays['class_color']), dtype=np.int64)
+    np.maximum.at(maxima, keys // (tile_size * tile_size), counts)
+    return (*count_histogram(keys, counts, tile_size), maxima)
+
+def normalize_density(scene_dir: str, meta: dict, results, density_scale: str, density_alpha: float) -> None:
+    num_classes = len(np.load(os.path.join(scene_dir, 'class_color.npy')))
+    histogram = np.zeros((num_classes, HIST_CAP + 1), dtype=np.int64)
+    maxima = np.zeros(num_classes, dtype=np.int64)
+    for classes, bins, pixels, tile_maxima in results:
+        np.add.at(histogram, (classes, bins), pixels)
+        np.maximum(maxima, tile_maxima, out=maxima)
+    np.save(os.path.join(scene_dir, 'density_maxima.npy'), maxima)
+    if density_scale == 'hist':
+        np.save(os.path.join(scene_dir, 'density_table.npy'), equalization_table(histogram))
+    meta.update(density_scale=density_scale, density_alpha=density_alpha)
+    with open(os.path.join(scene_dir, 'scene.json'), 'w', encoding='utf-8') as file:
+        json.dump(meta, file)
+
+def density_surface(scene_dir: str, meta: dict, arrays: dict, x: int, y: int):
+    import cairo
+    tile_size = meta['tile_size']
+    with np.load(counts_path(scene_dir, x, y)) as counts:
+        shaded = shade_counts(counts['keys'], counts['counts'], arrays['class_color'], meta['density_scale'],
+                              arrays['density_maxima'], arrays.get('density_table'), tile_size, meta['density_alpha'])
+    # Cairo's ARGB32 is premultiplied and stored as native-endian 32 bit words
+    channels = [2, 1, 0, 3] if sys.byteorder == 'little' else [3, 0, 1, 2]
+    stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, tile_size)
+    buffer = np.zeros((tile_size, stride), dtype=np.uint8)
+    buffer[:, :4 * tile_size] = np.round(shaded[:, :, channels] * 255).astype(np.uint8).reshape(tile_size, -1)
+    return cairo.ImageSurface.create_for_data(buffer, cairo.FORMAT_ARGB32, tile_size, tile_size, stride)
+
+def render_tile(task) -> None:
+    # pycairo is only imported by the workers that draw, so scripts that never render do not need it
+    import cairo
+    scene_dir, pyramid_dir, level, x, y = task
+    meta, arrays = load_scene(scene_dir)
+    tile_size = meta['tile_size']
+    tile = y * meta['tiles_x'] + x
+
+    if meta['edge_mode'] == 'density':
+        surface = density_surface(scene_dir, meta, arrays, x, y)
+    else:
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, tile_size, tile_size)
+    context = cairo.Context(surface)
+    context.translate(-x * tile_size, -y * tile_size)
+    if meta['edge_mode'] == 'strokes':
+        draw_edges(context, arrays, tile_items(arrays, 'edges', tile), meta['edge_width'])
+    draw_nodes(context, arrays, tile_items(arrays, 'nodes', tile))
+    surface.write_to_png(tile_path(pyramid_dir, level, x, y))
+
+def merge_tiles(task) -> None:
+    # A tile one level up covers 2x2 tiles of this level, downsampled by two
+    pyramid_dir, level, x, y, tile_size = task
+    merged = Image.new('RGBA', (2 * tile_size, 2 * tile_size), (0, 0, 0, 0))
+    for dx in (0, 1):
+        for dy in (0, 1):
+            child = tile_path(pyramid_dir, level + 1, 2 * x + dx, 2 * y + dy)
+            if os.path.exists(child):
+                with Image.open(child) as image:
+                    merged.paste(image.convert('RGBA'), (dx * tile_size, dy * tile_size))
+    merged.reduce(2).save(tile_path(pyramid_dir, level, x, y))
+
+def assemble_image(pyramid_dir: str, level: int, meta: dict, image_path: str) -> None:
+    # One row of tiles at a time, so only a band of the canvas is ever held in memory
+    tile_size, width, height = meta['tile_size'], meta['width'], meta['height']
+    with PNGWriter(image_path, width, height) as writer:
+        for y in range(meta['tiles_y']):
+            band_height = min(tile_size, height - y * tile_size)
+            band = np.zeros((band_height, meta['tiles_x'] * tile_size, 4), dtype=np.uint8)
+            for x in range(meta['tiles_x']):
+                with Image.open(tile_path(pyramid_dir, level, x, y)) as image:
+                    band[:, x * tile_size:(x + 1) * tile_size] = np.asarray(image.convert('RGBA'))[:band_height]
+            writer.write_rows(band[:, :width])
+
+def render_tiled(graph: ig.Graph, layout, image_path: str = './data/graph.png', pyramid_dir: str = './data/pyramid', width: int = 19200,
+                 height: int = 10800, margin: int = 50, tile_size: int = TILE_SIZE, edge_width: float = 0.25, workers: int | None = None,
+                 edge_mode: str = 'strokes', density_scale: str = 'log', density_alpha: float = 0.8,
+                 bounds: tuple[np.ndarray, np.ndarray] | None = None) -> None:
+    if edge_mode not in EDGE_MODES:
+        raise ValueError(f"Unknown edge mode: {edge_mode}. Expected one of {EDGE_MODES}.")
+    if density_scale not in DENSITY_SCALES:
+        raise ValueError(f"Unknown density scale: {density_scale}. Expected one of {DENSITY_SCALES}.")
+    if os.path.exists(pyramid_dir):
+        shutil.rmtree(pyramid_dir)
+    scene_dir = os.path.join(pyramid_dir, 'scene')
+    meta = build_scene(graph, layout, scene_dir, width, height, margin, tile_size, edge_width, edge_mode, bounds)
+    top_level = meta['levels'] - 1
+
+    with ProcessPoolExecutor(max_workers=workers or multiprocessing.cpu_count()) as executor:
+        if edge_mode == 'density':
+            os.makedirs(os.path.join(scene_dir, 'counts'))
+            print(f"Counting edge density ({density_scale} scale)...")
+            cells = [(scene_dir, x, y) for y in range(meta['tiles_y']) for x in range(meta['tiles_x'])]
+            normalize_density(scene_dir, meta, executor.map(count_tile, cells, chunksize=4), density_scale, density_alpha)
+
+        os.makedirs(os.path.join(pyramid_dir, str(top_level)))
+        tiles = [(scene_dir, pyramid_dir, top_level, x, y) for y in range(meta['tiles_y']) for x in range(meta['tiles_x'])]
+        print(f"Rendering {len(tiles)} tiles of {tile_size}x{tile_size} pixels...")
+        progress = Progress(len(tiles), "Rendering tiles")
+        for _ in executor.map(render_tile, tiles, chunksize=4):
+            progress.update()
+
+        for level in range(top_level - 1, -1, -1):
+            os.makedirs(os.path.join(pyramid_dir, str(level)))
+            scale = 2 ** (top_level - level)
+            merges = [(pyramid_dir, level, x, y, tile_size)
+                      for y in range(math.ceil(meta['tiles_y'] / scale)) for x in range(math.ceil(meta['tiles_x'] / scale))]
+            list(executor.map(merge_tiles, merges, chunksize=4))
+
+    assemble_image(pyramid_dir, top_level, meta, image_path)
+    shutil.rmtree(scene_dir)
+    with open(os.path.join(pyramid_dir, 'pyramid.json'), 'w', encoding='utf-8') as file:
+        json.dump({**meta, 'tile_path': '{level}/{x}_{y}.png'}, file, indent=1)
+    print(f"Graph saved to {image_path}, zoom pyramid with {meta['levels']} levels in {pyramid_dir}")